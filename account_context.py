@@ -0,0 +1,92 @@
+import logging
+from settings import Settings
+from tracing import TRACER
+
+# Keys of a Settings.Accounts entry that describe the account itself.  Every other key overrides the setting of that name.
+ACCOUNT_KEYS = ('name', 'account_number', 'tasty_user', 'tasty_password')
+
+
+class AccountSettings(object):
+    # Settings with one account's overrides on top.  Anything not overridden reads through to Settings.
+    def __init__(self, overrides: dict):
+        self.__dict__.update(overrides)
+
+    def __getattr__(self, name):
+        return getattr(Settings, name)
+
+
+class AccountLogger(logging.LoggerAdapter):
+    # Prefixes each line with the account name when more than one account is traded.
+    def process(self, msg, kwargs):
+        if self.extra['account'] is None:
+            return msg, kwargs
+        return '[{}] {}'.format(self.extra['account'], msg), kwargs
+
+    # Logger has fatal() as an alias of critical(), LoggerAdapter doesn't.
+    fatal = logging.LoggerAdapter.critical
+
+
+def get_account_specs(settings = Settings) -> list:
+    # tasty_account_number (when set) followed by every entry in Accounts, with the name and login filled in.
+    specs = []
+    if settings.tasty_account_number:
+        specs.append({'account_number': settings.tasty_account_number})
+    specs.extend(dict(spec) for spec in settings.Accounts)
+    names = set()
+    for spec in specs:
+        spec.setdefault('name', spec['account_number'])
+        spec.setdefault('tasty_user', settings.tasty_user)
+        spec.setdefault('tasty_password', settings.tasty_password)
+        if spec['name'] in names:
+            raise Exception('The account {} is listed more than once in the settings.'.format(spec['name']))
+        names.add(spec['name'])
+    if not specs:
+        raise Exception('No account set.  Fill in tasty_account_number or Accounts in the settings.')
+    return specs
+
+
+class AccountContext(object):
+    # One broker account and what the order helpers need to trade it: its login's session, pooled gateway and quote
+    # alerts (shared by every account on that login), its own positions/orders cache and settings, and its counters.
+    # state and stops are filled in by the caller, since their broker calls are bound to this context.
+    def __init__(self, spec: dict, session, account, gateway, alerts, logger: logging.Logger, tag_logs: bool = False):
+        self.name = spec['name']
+        self.user = spec['tasty_user']
+        self.settings = AccountSettings({key: value for key, value in spec.items() if key not in ACCOUNT_KEYS})
+        self.session = session
+        self.account = account
+        self.gateway = gateway
+        self.alerts = alerts
+        self.state = None
+        self.stops = None
+        # Ticker -> the stock price stop alert this account wants.  The login's alerts are built from every account's.
+        self.stock_alerts = {}
+        self.log = AccountLogger(logger, {'account': self.name if tag_logs else None})
+        self.signals = 0
+        self.orders = 0
+        self.order_errors = 0
+        self.fills = 0
+        self.unfilled = 0
+        self.cancels = 0
+
+    def span(self, stage: str):
+        return TRACER.span('account.{}.{}'.format(self.name, stage))
+
+    def record(self, stage: str, seconds: float):
+        TRACER.record('account.{}.{}'.format(self.name, stage), seconds)
+
+    def stats(self) -> dict:
+        entries = self.fills + self.unfilled
+        return {
+            'signals': self.signals,
+            'orders': self.orders,
+            'order_errors': self.order_errors,
+            'fills': self.fills,
+            'unfilled': self.unfilled,
+            'fill_rate': round(self.fills / entries, 3) if entries else 0.0,
+            'cancels': self.cancels,
+            'fetches': self.state.fetch_count if self.state is not None else 0,
+        }
+
+    def __repr__(self):
+        return 'AccountContext({})'.format(self.name)
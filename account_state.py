@@ -0,0 +1,77 @@
+import asyncio
+from time import monotonic
+from settings import Settings
+
+
+class AccountState(object):
+    # In-memory snapshot of an account's positions and live orders, indexed by ticker.
+    # Both lists are refreshed together on one TTL.  Placing or cancelling an order should call invalidate() so the next read refetches.
+    def __init__(self, fetch_positions, fetch_orders, ttl: float = None):
+        self.fetch_positions = fetch_positions
+        self.fetch_orders = fetch_orders
+        self.ttl = Settings.AccountStateTTL if ttl is None else ttl
+        self.positions = []
+        self.orders = []
+        self.positions_by_ticker = {}
+        self.orders_by_ticker = {}
+        self.fetched_at = None
+        self.fetch_count = 0
+        self._generation = 0
+        self._inflight = None
+        self._inflight_generation = 0
+        self._loaded_generation = 0
+
+    def is_fresh(self, max_age: float = None) -> bool:
+        if self.fetched_at is None:
+            return False
+        return (monotonic() - self.fetched_at) < (self.ttl if max_age is None else max_age)
+
+    def invalidate(self):
+        self._generation += 1
+        self.fetched_at = None
+
+    async def refresh(self):
+        # Concurrent callers share the one in-flight fetch, unless it started before the last invalidate().
+        if self._inflight is None or self._inflight.done() or self._inflight_generation != self._generation:
+            self._inflight_generation = self._generation
+            self._inflight = asyncio.ensure_future(self._refresh())
+        await asyncio.shield(self._inflight)
+
+    async def _refresh(self):
+        generation = self._generation
+        started_at = monotonic()
+        self.fetch_count += 1
+        positions, orders = await asyncio.gather(self.fetch_positions(), self.fetch_orders())
+        if generation < self._loaded_generation:
+            # A fetch started after ours has already landed.
+            return
+        self._loaded_generation = generation
+        self.load(positions, orders)
+        # An invalidate() that landed while we were fetching means this data may already be out of date.
+        self.fetched_at = started_at if generation == self._generation else None
+
+    def load(self, positions: list, orders: list):
+        positions_by_ticker = {}
+        for position in positions:
+            positions_by_ticker.setdefault(position.underlying_symbol.upper(), []).append(position)
+        orders_by_ticker = {}
+        for order in orders:
+            orders_by_ticker.setdefault(order.details.ticker.upper(), []).append(order)
+        self.positions = list(positions)
+        self.orders = list(orders)
+        self.positions_by_ticker = positions_by_ticker
+        self.orders_by_ticker = orders_by_ticker
+
+    async def get_positions(self, ticker: str = None, max_age: float = None) -> list:
+        if not self.is_fresh(max_age):
+            await self.refresh()
+        if ticker is None:
+            return list(self.positions)
+        return list(self.positions_by_ticker.get(ticker.upper(), ()))
+
+    async def get_orders(self, ticker: str = None, max_age: float = None) -> list:
+        if not self.is_fresh(max_age):
+            await self.refresh()
+        if ticker is None:
+            return list(self.orders)
+        return list(self.orders_by_ticker.get(ticker.upper(), ()))
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+from decimal import Decimal
+from time import monotonic
+from settings import Settings
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_enum_value(value):
+    return getattr(value, 'value', value)
+
+def get_alert_key(alert) -> tuple:
+    # Two alerts with the same key are interchangeable, whether built locally or read back from the broker.
+    return (alert.symbol.upper(), str(get_enum_value(getattr(alert, 'field', ''))), str(get_enum_value(getattr(alert, 'operator', ''))), Decimal(str(alert.threshold)))
+
+
+class AlertManager(object):
+    # Local symbol -> alerts index of the broker's quote alerts.
+    # apply() takes the wanted alert per symbol (None for no alert), diffs it against the index and only sends the
+    # deletes and creates that differ, with every symbol in the batch reconciled at once.  sync() rebuilds the index
+    # from the broker; any failed call drops the index so the next use resyncs.  A listing that started before apply()
+    # changed a symbol keeps the index's entry for it, since the listing may not show the change yet.  One that started
+    # before an invalidate() doesn't count as a sync.
+    def __init__(self, fetch_alerts, create_alert, delete_alert, resync_interval: float = None):
+        self.fetch_alerts = fetch_alerts
+        self.create_alert = create_alert
+        self.delete_alert = delete_alert
+        self.resync_interval = Settings.AlertResyncSeconds if resync_interval is None else resync_interval
+        self.alerts_by_symbol = {}
+        self.synced_at = None
+        self.sync_count = 0
+        self.created = 0
+        self.deleted = 0
+        self.unchanged = 0
+        self._inflight = None
+        self._locks = {}
+        self._generation = 0
+        self._inflight_generation = 0
+        self._loaded_generation = 0
+        self._invalidated_generation = 0
+        # Symbol -> generation at which apply() last changed it.
+        self._changed = {}
+
+    def is_stale(self) -> bool:
+        return self.synced_at is None or (monotonic() - self.synced_at) >= self.resync_interval
+
+    def invalidate(self):
+        self._generation += 1
+        self._invalidated_generation = self._generation
+        self.synced_at = None
+
+    async def sync(self):
+        # Concurrent callers share one listing, unless it started before the last change or invalidate().
+        if self._inflight is None or self._inflight.done() or self._inflight_generation != self._generation:
+            self._inflight_generation = self._generation
+            self._inflight = asyncio.ensure_future(self._sync())
+        await asyncio.shield(self._inflight)
+
+    async def _sync(self):
+        generation = self._generation
+        started_at = monotonic()
+        alerts = await self.fetch_alerts()
+        if generation < self._loaded_generation:
+            # A listing started after ours has already landed.
+            return
+        self._loaded_generation = generation
+        kept = {symbol: self.alerts_by_symbol.get(symbol) for symbol, changed in self._changed.items() if changed > generation}
+        self._changed = dict((symbol, changed) for symbol, changed in self._changed.items() if changed > generation)
+        self.load(alerts)
+        for symbol, symbol_alerts in kept.items():
+            if symbol_alerts:
+                self.alerts_by_symbol[symbol] = symbol_alerts
+            else:
+                self.alerts_by_symbol.pop(symbol, None)
+        if self._invalidated_generation <= generation:
+            self.synced_at = started_at
+        self.sync_count += 1
+
+    def load(self, alerts: list):
+        # Replaces the index without marking it synced, e.g. to seed it from a cached copy.
+        alerts_by_symbol = {}
+        for alert in alerts:
+            alerts_by_symbol.setdefault(alert.symbol.upper(), []).append(alert)
+        self.alerts_by_symbol = alerts_by_symbol
+
+    def get_all(self) -> list:
+        return [alert for alerts in self.alerts_by_symbol.values() for alert in alerts]
+
+    def symbols(self) -> set:
+        return set(self.alerts_by_symbol)
+
+    def get_alerts(self, symbol: str) -> list:
+        return list(self.alerts_by_symbol.get(symbol.upper(), ()))
+
+    def get_triggered(self) -> list:
+        # As of the last sync.
+        return [alert for alerts in self.alerts_by_symbol.values() for alert in alerts if getattr(alert, 'triggered', False) == True]
+
+    async def apply(self, wanted: dict):
+        if self.synced_at is None:
+            await self.sync()
+        results = await asyncio.gather(*[self._reconcile(symbol.upper(), alert) for symbol, alert in wanted.items()], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    async def _reconcile(self, symbol: str, alert):
+        lock = self._locks.get(symbol)
+        if lock is None:
+            lock = self._locks[symbol] = asyncio.Lock()
+        async with lock:
+            wanted_key = get_alert_key(alert) if alert is not None else None
+            keep = None
+            stale = []
+            for existing in self.alerts_by_symbol.get(symbol, ()):
+                if keep is None and getattr(existing, 'triggered', False) != True and get_alert_key(existing) == wanted_key:
+                    keep = existing
+                else:
+                    stale.append(existing)
+            if not stale and (alert is None or keep is not None):
+                self.unchanged += 1
+                return keep
+            calls = [self.delete_alert(existing) for existing in stale]
+            if alert is not None and keep is None:
+                calls.append(self.create_alert(alert))
+            LOGGER.info('Updating alerts for %s: %s to delete, %s to create', symbol, len(stale), len(calls) - len(stale))
+            results = await asyncio.gather(*calls, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    self.invalidate()
+                    raise result
+            self._generation += 1
+            self._changed[symbol] = self._generation
+            self.deleted += len(stale)
+            if keep is None and alert is not None:
+                self.created += 1
+                # Keep the broker's copy when the create call hands one back.
+                created = results[-1]
+                keep = created if hasattr(created, 'threshold') else alert
+            if keep is None:
+                self.alerts_by_symbol.pop(symbol, None)
+            else:
+                self.alerts_by_symbol[symbol] = [keep]
+            return keep
+
+    def stats(self) -> dict:
+        return {
+            'symbols': len(self.alerts_by_symbol),
+            'syncs': self.sync_count,
+            'created': self.created,
+            'deleted': self.deleted,
+            'unchanged': self.unchanged,
+        }
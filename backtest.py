@@ -0,0 +1,287 @@
+import sys
+import json
+import asyncio
+import argparse
+import itertools
+from datetime import datetime
+from decimal import Decimal
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from settings import Settings
+from signal_parser import SignalParser
+from benchmarks import fake_modules
+from benchmarks.fake_modules import FakeBroker, OrderStatus, OrderType, OrderPriceEffect, Option, Position, TastyAPISession, TradingAccount
+
+# Replays a timestamped log of Discord signals and recorded option marks through the bot's own handlers against a simulated broker.
+#
+# The event file is JSON lines, sorted by time.  time is epoch seconds or an ISO timestamp.
+#   {"time": ..., "type": "signal", "content": "[OPEN] $AAPL [TYPE] CALL [EXP] 12/20 [STRIKE] $280 [MARK] $1.45"}
+#   {"time": ..., "type": "mark", "ticker": "AAPL", "mark": 1.52, "underlying": 281.30}
+# Like the bot, the simulation tracks one option per ticker, so marks are keyed by the underlying ticker.
+#
+#   python backtest.py signals.jsonl
+#   python backtest.py signals.jsonl --sweep AutoCloseAtProfitPercent=10,20,30 --sweep ProfitPercentExitTriggerPriceDelta=.02,.05
+#
+# Signals go through pptwbot.ProcessSignal and every mark through EvaluatePositionExit and, when a stock price alert
+# triggers, ExitPositionsForTriggeredAlert, all for one account.  The tastyworks models are the benchmarks' fake ones
+# (benchmarks/fake_modules.py), answered at once by a SimulatedBroker in place of their FakeBroker.  fake_modules.install()
+# puts them in sys.modules in place of the tastyworks package, so run the backtest in its own process.
+CENT = Decimal('0.01')
+
+
+class SimulatedBroker(FakeBroker):
+    # One account's positions, live orders and stock price alerts, with no latency and no injected errors.  Orders fill
+    # against their ticker's last recorded mark when they are placed and against every mark after that.  Cancels take
+    # effect at once.
+    def __init__(self):
+        super().__init__(latency=0.0, login_latency=0.0)
+        self.marks = {}
+        self.fills = []
+        self.trades = []
+        self.time = None
+
+    @property
+    def api_calls(self) -> int:
+        return sum(self.calls.values()) - self.calls['login']
+
+    def get_position(self, ticker: str):
+        for position in self.positions:
+            if position.underlying_symbol == ticker:
+                return position
+        return None
+
+    def execute(self, order, account_number: str = None):
+        order_id = self.next_order_id
+        self.next_order_id += 1
+        order.details.order_id = order_id
+        order.details.status = OrderStatus.LIVE
+        order.account_number = account_number
+        self.orders[order_id] = order
+        mark = self.marks.get(order.details.ticker)
+        if mark is not None:
+            self._fill_orders(order.details.ticker, mark)
+        return {'order': {'id': order_id, 'status': order.details.status.value}}
+
+    def on_mark(self, time, ticker, mark, underlying) -> bool:
+        # Returns True if a stock price alert for the ticker triggered on this mark.  A triggered alert stays listed,
+        # flagged, until it is deleted, as on the broker.
+        self.time = time
+        self.marks[ticker] = mark
+        position = self.get_position(ticker)
+        if position:
+            position.mark_price = mark
+        self._fill_orders(ticker, mark)
+        triggered = False
+        if underlying is not None:
+            for alert in self.alerts:
+                if alert.symbol == ticker and not alert.triggered and ((alert.operator == '<' and underlying <= alert.threshold) or (alert.operator == '>' and underlying >= alert.threshold)):
+                    alert.triggered = True
+                    triggered = True
+        return triggered
+
+    def _fill_orders(self, ticker, mark):
+        for order in [order for order in self.orders.values() if order.details.ticker == ticker]:
+            fill_price = self._get_fill_price(order.details, mark)
+            if fill_price is not None:
+                del self.orders[order.details.order_id]
+                order.details.status = OrderStatus.FILLED
+                self.retire(order)
+                self._fill(order, fill_price)
+
+    def _get_fill_price(self, details, mark):
+        if details.type == OrderType.MARKET:
+            return mark
+        if details.type in (OrderType.STOP, OrderType.STOP_LIMIT) and mark > details.stop_trigger:
+            return None
+        if details.type == OrderType.STOP:
+            return mark
+        if details.price_effect == OrderPriceEffect.DEBIT:
+            return details.price if mark <= details.price else None
+        return details.price if mark >= details.price else None
+
+    def _fill(self, order, price):
+        leg = order.legs[0]
+        ticker = order.details.ticker
+        self.fills.append({'time': self.time, 'ticker': ticker, 'side': order.details.price_effect.value, 'type': order.details.type.value, 'quantity': leg.quantity, 'price': price})
+        position = self.get_position(ticker)
+        if order.details.price_effect == OrderPriceEffect.DEBIT:
+            if position:
+                cost = position.average_open_price * position.quantity + price * leg.quantity
+                position.quantity += leg.quantity
+                position.average_open_price = cost / position.quantity
+            else:
+                option = Option(leg.ticker, leg.quantity, leg.expiry, leg.strike, leg.option_type, leg.underlying_type)
+                position = Position(ticker, leg.quantity, price, self.marks.get(ticker, price), option)
+                position.account_number = order.account_number
+                position.opened_at = self.time
+                self.positions.append(position)
+        elif position:
+            quantity = min(leg.quantity, position.quantity)
+            # Same fee model as get_profit_percent: $1 per contract to open, capped at $10.
+            fees = min(Decimal(quantity), Decimal('10'))
+            pnl = (price - position.average_open_price) * quantity * position.multiplier - fees
+            self.trades.append({'ticker': ticker, 'opened_at': position.opened_at, 'closed_at': self.time, 'quantity': quantity,
+                                'open_price': position.average_open_price, 'close_price': price, 'exit': order.details.type.value, 'pnl': pnl})
+            position.quantity -= quantity
+            if position.quantity <= 0:
+                self.positions.remove(position)
+                # Closing orders left for a position that no longer exists are rejected.
+                for order_id, live in list(self.orders.items()):
+                    if live.details.ticker == ticker and live.details.price_effect == OrderPriceEffect.CREDIT:
+                        live.details.status = OrderStatus.REJECTED
+                        self.retire(self.orders.pop(order_id))
+
+
+class Backtest(object):
+    # Drives the bot's handlers for one simulated account.  Exit rules run on every mark, like the streaming engine.
+    # overrides are settings for the account, on top of Settings.
+    def __init__(self, overrides: dict = None, broker: SimulatedBroker = None):
+        fake_modules.install()
+        import pptwbot
+        from alert_manager import AlertManager
+        from trade_journal import TradeJournal
+        pptwbot.import_tastyworks()
+        if pptwbot.JOURNAL is None:
+            pptwbot.JOURNAL = TradeJournal('')
+        self.bot = pptwbot
+        self.broker = fake_modules.BROKER = broker or SimulatedBroker()
+        session = TastyAPISession('backtest', '')
+        alerts = AlertManager(partial(pptwbot.FetchQuoteAlerts, session, None), partial(pptwbot.SendCreateAlert, session), partial(pptwbot.SendDeleteAlert, session))
+        # Fills happen as orders are placed, so there is nothing for WaitForFill to wait on.
+        spec = dict(overrides or {}, name='backtest', account_number='BACKTEST', tasty_user='', tasty_password='', EntryFillTimeout=0)
+        self.account = pptwbot.CreateAccount(spec, session, TradingAccount('BACKTEST'), None, alerts)
+        self.settings = self.account.settings
+        self.parser = SignalParser(self.settings.EntryRegex, self.settings.UpdateRegex, self.settings.DeactivateRegex)
+        self.signals = 0
+
+    def run(self, events):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.replay(events))
+        finally:
+            loop.close()
+        return self
+
+    async def replay(self, events):
+        for event in events:
+            self.broker.time = event['time']
+            if event['type'] == 'signal':
+                signal = self.parser.parse(event['content'])
+                if signal:
+                    self.signals += 1
+                    await self.bot.ProcessSignal(signal, self.account)
+            elif event['type'] == 'mark':
+                await self.process_mark(event['ticker'].upper(), event['mark'], event.get('underlying'))
+
+    async def process_mark(self, ticker, mark, underlying):
+        mark = Decimal(str(mark))
+        underlying = Decimal(str(underlying)) if underlying is not None else None
+        orders = len(self.broker.orders)
+        triggered = self.broker.on_mark(self.broker.time, ticker, mark, underlying)
+        if len(self.broker.orders) != orders:
+            self.account.state.invalidate()
+        if triggered and self.settings.MarketSellOnAlert:
+            await self.bot.ExitPositionsForTriggeredAlert(ticker, accounts = [self.account])
+        # As the position monitor does before each pass.
+        self.account.stops.retain(position.underlying_symbol for position in self.broker.positions)
+        position = self.broker.get_position(ticker)
+        if position:
+            await self.bot.EvaluatePositionExit(position, self.account)
+
+    def results(self) -> dict:
+        trades = self.broker.trades
+        pnl = [trade['pnl'] for trade in trades]
+        open_pnl = sum(((position.mark_price - position.average_open_price) * position.quantity * position.multiplier for position in self.broker.positions), Decimal('0'))
+        equity = peak = max_drawdown = Decimal('0')
+        for trade_pnl in pnl:
+            equity += trade_pnl
+            peak = max(peak, equity)
+            max_drawdown = max(max_drawdown, peak - equity)
+        wins = [value for value in pnl if value > 0]
+        return {
+            'signals': self.signals,
+            'fills': len(self.broker.fills),
+            'trades': len(trades),
+            'wins': len(wins),
+            'win_rate': len(wins) / len(trades) if trades else 0.0,
+            'realized_pnl': sum(pnl, Decimal('0')).quantize(CENT),
+            'open_pnl': open_pnl.quantize(CENT),
+            'max_drawdown': max_drawdown.quantize(CENT),
+            'api_calls': self.broker.api_calls,
+        }
+
+
+def parse_time(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value).timestamp()
+
+def load_events(path: str) -> list:
+    events = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                event = json.loads(line)
+                event['time'] = parse_time(event['time'])
+                events.append(event)
+    events.sort(key=lambda event: event['time'])
+    return events
+
+def run_backtest(events: list, overrides: dict = None) -> Backtest:
+    return Backtest(overrides).run(events)
+
+_worker_events = {}
+
+def _run_sweep_case(path: str, overrides: dict) -> dict:
+    # Each pool worker loads the event file once and reuses it for every case it is handed.
+    if path not in _worker_events:
+        _worker_events[path] = load_events(path)
+    results = run_backtest(_worker_events[path], overrides).results()
+    results.update(overrides)
+    return results
+
+def run_sweep(path: str, grid: dict, workers: int = None) -> list:
+    # grid maps a Settings field name to the values to try; every combination is run in a process pool.
+    names = sorted(grid)
+    cases = [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_run_sweep_case, [path] * len(cases), cases))
+
+def parse_sweep_arg(arg: str):
+    name, values = arg.split('=', 1)
+    default = getattr(Settings, name)
+    if isinstance(default, bool):
+        cast = lambda value: value.lower() in ('1', 'true', 'yes')
+    elif isinstance(default, Decimal):
+        cast = Decimal
+    else:
+        cast = type(default)
+    return name, [cast(value) for value in values.split(',')]
+
+def format_row(row: dict, columns: list) -> str:
+    return '  '.join('{:>14}'.format('{:.2f}'.format(row[column]) if isinstance(row[column], (Decimal, float)) else str(row[column])) for column in columns)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Replay a signal/mark log through the bot\'s handlers against a simulated broker.')
+    parser.add_argument('events', help='JSON-lines file of signal and mark events.')
+    parser.add_argument('--sweep', action='append', default=[], metavar='SETTING=V1,V2,...', help='Settings field to sweep.  Repeat for a grid.')
+    parser.add_argument('--workers', type=int, default=None, help='Process pool size for sweeps.')
+    parser.add_argument('--fills', action='store_true', help='Print every simulated fill.')
+    args = parser.parse_args(argv)
+    if args.sweep:
+        grid = dict(parse_sweep_arg(arg) for arg in args.sweep)
+        rows = run_sweep(args.events, grid, args.workers)
+        columns = sorted(grid) + ['trades', 'win_rate', 'realized_pnl', 'open_pnl', 'max_drawdown']
+        print('  '.join('{:>14}'.format(column[:14]) for column in columns))
+        for row in sorted(rows, key=lambda row: row['realized_pnl'], reverse=True):
+            print(format_row(row, columns))
+    else:
+        backtest = run_backtest(load_events(args.events))
+        if args.fills:
+            for fill in backtest.broker.fills:
+                print('{time:.0f} {ticker:<6} {side:<6} {type:<6} {quantity:>3} @ {price}'.format(**fill))
+        for name, value in backtest.results().items():
+            print('{:<14} {}'.format(name, value))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,70 @@
+# Compares broker call throughput and latency against the mock broker server for three clients:
+#   fresh   - a new aiohttp.request() (new TCP connection) per call, as the tastyworks models do
+#   pooled  - BrokerGateway's shared keep-alive session, every call sent
+#   dedup   - BrokerGateway with identical in-flight GETs shared
+# Each simulated signal reads live orders, quote alerts and positions at once, with --concurrency signals in flight.
+# Run from the repo root: python -m benchmarks.bench_broker_gateway [--signals N] [--concurrency N] [--latency-ms X]
+import asyncio
+import aiohttp
+import argparse
+from time import perf_counter
+from broker_gateway import BrokerGateway
+from mock_broker_server import MockBroker
+
+PATHS = ('/accounts/1/orders/live', '/quote-alerts', '/accounts/1/positions')
+
+def no_headers():
+    return {}
+
+async def fresh_get(base_url, path):
+    async with aiohttp.request('GET', base_url + path) as resp:
+        return await resp.json()
+
+async def run(name, call, args, broker):
+    latencies = []
+
+    async def timed(path):
+        t0 = perf_counter()
+        await call(path)
+        latencies.append(perf_counter() - t0)
+
+    async def signal(semaphore):
+        async with semaphore:
+            await asyncio.gather(*[timed(path) for path in PATHS])
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    requests_before = broker.requests
+    broker.connections.clear()
+    t0 = perf_counter()
+    await asyncio.gather(*[signal(semaphore) for _ in range(args.signals)])
+    elapsed = perf_counter() - t0
+    latencies.sort()
+    print('{:<7} {:>9.0f} calls/s  p50 {:>7.2f}ms  p99 {:>7.2f}ms  sent {:>6}  connections {:>5}'.format(
+        name, len(latencies) / elapsed, latencies[len(latencies) // 2] * 1e3, latencies[int(len(latencies) * 0.99)] * 1e3,
+        broker.requests - requests_before, len(broker.connections)))
+
+async def bench(args):
+    broker = MockBroker(args.latency_ms)
+    base_url = await broker.start()
+    try:
+        await run('fresh', lambda path: fresh_get(base_url, path), args, broker)
+        gateway = BrokerGateway(base_url, no_headers, pool_size=args.pool_size, keepalive=30)
+        await gateway.warm_up()
+        await run('pooled', lambda path: gateway.request('GET', path), args, broker)
+        await run('dedup', gateway.get, args, broker)
+        print('gateway:', gateway.stats())
+        await gateway.close()
+    finally:
+        await broker.stop()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--signals', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=8, help='Signals in flight at once.')
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='Server-side delay per request.')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(bench(args))
+
+if __name__ == '__main__':
+    main()
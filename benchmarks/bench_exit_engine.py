@@ -0,0 +1,112 @@
+# Measures tick-to-order latency of the streaming ExitEngine against the 2 second polling monitor, offline.  Ticks go
+# through the engine to pptwbot.EvaluatePositionExit, which sends its exit orders to the fake tastyworks module in
+# benchmarks/fake_modules.py.  Also counts the exit orders sent per position, which should be one however many ticks
+# arrive before the next position resync.
+# Ticks come from a JSON-lines recording (--ticks) or a generated random walk.
+# Run from the repo root: python -m benchmarks.bench_exit_engine [--ticks FILE] [--positions N] [--speed X]
+import os
+import math
+import random
+import asyncio
+import argparse
+import tempfile
+from time import perf_counter
+from decimal import Decimal
+from fake_streamer import ReplayStreamer
+
+POLL_INTERVAL = 2.0
+
+def generate_ticks(symbols, seconds, rate):
+    rnd = random.Random(7)
+    ticks = []
+    for symbol in symbols:
+        price = 1.0
+        t = 0.0
+        while t < seconds:
+            t += rnd.expovariate(rate)
+            price = max(0.01, price * (1 + rnd.gauss(0, 0.01)))
+            ticks.append({'time': t, 'eventSymbol': symbol, 'bidPrice': round(price - 0.01, 2), 'askPrice': round(price + 0.01, 2)})
+    return ticks
+
+async def run(pptwbot, fake_modules, args):
+    from exit_engine import ExitEngine
+    from settings import Settings
+    from strategy import get_exit_action, get_profit_percent
+    broker = fake_modules.BROKER
+    await pptwbot.StartBroker()
+    account = pptwbot.ACCOUNTS[0]
+    for index in range(args.positions):
+        broker.add_position('T{}'.format(index), fake_modules.OptionType.CALL, price=Decimal('1.00'))
+    positions = {position.get_option_obj().get_dxfeed_symbol(): position for position in await account.state.get_positions(max_age=0)}
+    if args.ticks:
+        streamer = ReplayStreamer.from_file(args.ticks, args.speed)
+    else:
+        streamer = ReplayStreamer(generate_ticks(positions, args.seconds, args.rate), args.speed)
+    engine = pptwbot.EXIT_ENGINE = ExitEngine(streamer, pptwbot.EvaluatePositionExit, pptwbot.ExitPositionsForTriggeredAlert)
+    await engine.sync_positions(list(positions.values()), account, listed_at = account.state.fetched_at)
+
+    # Time each closing order reaches the broker, by ticker.
+    sent = {}
+    execute = broker.execute
+    def record_execute(order, account_number = None):
+        if order.details.price_effect == fake_modules.OrderPriceEffect.CREDIT:
+            sent.setdefault(order.details.ticker, []).append(perf_counter())
+        return execute(order, account_number)
+    broker.execute = record_execute
+
+    crossed = {}
+    start = perf_counter()
+    async for item in streamer.listen():
+        for quote in item.data:
+            engine.on_quote(quote)
+            position = positions.get(quote['eventSymbol'])
+            if position is not None and position.underlying_symbol not in crossed and get_exit_action(get_profit_percent(position), Settings):
+                crossed[position.underlying_symbol] = (item.emitted_at, quote['time'])
+    await asyncio.sleep(args.order_latency * 4)
+    elapsed = perf_counter() - start
+    broker.execute = execute
+
+    latencies = sorted(sent[ticker][0] - emitted_at for ticker, (emitted_at, recorded_at) in crossed.items() if ticker in sent)
+    print('ticks replayed: {:,}  in {:.2f}s  ({:,.0f} ticks/s)'.format(streamer.emitted, elapsed, streamer.emitted / elapsed))
+    print('positions crossing an exit: {}  exit orders sent: {}  ({:.2f} per position)'.format(
+        len(crossed), sum(len(times) for times in sent.values()), sum(len(times) for times in sent.values()) / len(sent) if sent else 0.0))
+    if latencies:
+        print('streaming tick-to-order  p50 {:.2f}ms  p99 {:.2f}ms'.format(latencies[len(latencies) // 2] * 1e3, latencies[int(len(latencies) * 0.99)] * 1e3))
+        # The polling monitor only sees the cross at the next poll boundary of the recording's clock.
+        polled = sorted(math.ceil(recorded_at / POLL_INTERVAL) * POLL_INTERVAL - recorded_at + args.order_latency for emitted_at, recorded_at in crossed.values())
+        print('2s polling (modelled)    p50 {:.2f}ms  p99 {:.2f}ms'.format(polled[len(polled) // 2] * 1e3, polled[int(len(polled) * 0.99)] * 1e3))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ticks', help='JSON-lines file of recorded Quote ticks, for symbols .T<n>C100.')
+    parser.add_argument('--positions', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=60.0, help='Length of the generated recording.')
+    parser.add_argument('--rate', type=float, default=5.0, help='Generated ticks per second per symbol.')
+    parser.add_argument('--speed', type=float, default=10.0, help='Replay speed multiplier.  0 replays as fast as possible.')
+    parser.add_argument('--exit-percent', type=float, default=10.0, help='AutoCloseAtProfitPercent and AutoCloseAtLossPercent.')
+    parser.add_argument('--order-latency', type=float, default=0.05, help='Simulated broker round-trip in seconds.')
+    args = parser.parse_args()
+
+    from benchmarks import fake_modules
+    fake_modules.install()
+    fake_modules.BROKER.login_latency = 0.0
+    fake_modules.BROKER.latency = args.order_latency
+    import pptwbot
+    from settings import Settings
+    from state_cache import StateCache
+    from trade_journal import TradeJournal
+    Settings.StateCacheFile = ''
+    Settings.UseBrokerGateway = False
+    Settings.UseStreamingQuotes = True
+    Settings.AutoCloseAtProfitPercent = Decimal(str(args.exit_percent))
+    Settings.AutoCloseAtLossPercent = Decimal(str(args.exit_percent))
+    Settings.UseStopMarketOrderForProfitPercentExit = False
+    Settings.tasty_user = 'bench'
+    Settings.tasty_account_number = 'BENCH1'
+    pptwbot.STATE_CACHE = StateCache()
+    pptwbot.JOURNAL = TradeJournal(os.path.join(tempfile.mkdtemp(), 'journal.sqlite3'))
+    asyncio.get_event_loop().run_until_complete(run(pptwbot, fake_modules, args))
+    pptwbot.JOURNAL.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Fans entry signals out to several accounts in one process and reports each account's signal-to-order latency and
+# fills.  The accounts all share one login and one Discord connection; one of them answers every broker call slower
+# than the rest, and the per-account worker limit keeps it from holding up the others.  Runs against the fake
+# discord/tastyworks modules in benchmarks/fake_modules.py.
+# Run from the repo root: python -m benchmarks.bench_fanout [--accounts N] [--signals N] [--api-ms X] [--slow-ms X]
+import os
+import asyncio
+import argparse
+import tempfile
+from time import perf_counter
+
+TICKERS = ('SPY', 'QQQ', 'AAPL', 'MSFT', 'AMD', 'BA', 'NVDA', 'AMZN', 'FB', 'NFLX')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', type=int, default=4)
+    parser.add_argument('--signals', type=int, default=20)
+    parser.add_argument('--api-ms', type=float, default=20.0)
+    parser.add_argument('--slow-ms', type=float, default=250.0, help='Extra latency on every call for the last account.')
+    parser.add_argument('--per-account', type=int, default=None, help='MaxConcurrentSignalsPerAccount.')
+    args = parser.parse_args()
+
+    from benchmarks import fake_modules
+    fake_modules.install()
+    fake_modules.BROKER.login_latency = 0.0
+    fake_modules.BROKER.latency = args.api_ms / 1000.0
+    fake_modules.DISCORD.login_latency = 0.0
+    fake_modules.DISCORD.connect_latency = 0.0
+    import pptwbot
+    from settings import Settings
+    Settings.StateCacheFile = ''
+    Settings.JournalFile = os.path.join(tempfile.mkdtemp(), 'journal.sqlite3')
+    Settings.UseBrokerGateway = False
+    Settings.UseStreamingQuotes = False
+    Settings.MarketSellOnAlert = False
+    Settings.AutoCloseAtProfitPercent = 0
+    Settings.AutoCloseAtLossPercent = 0
+    Settings.TracingHttpPort = 0
+    Settings.tasty_user = 'bench'
+    Settings.tasty_account_number = ''
+    Settings.Accounts = tuple({'account_number': 'BENCH{}'.format(index), 'name': 'acct{}'.format(index), 'MaxBet': 100 * index, 'MaxContracts': index} for index in range(1, args.accounts + 1))
+    if args.per_account is not None:
+        Settings.MaxConcurrentSignalsPerAccount = args.per_account
+    slow = 'BENCH{}'.format(args.accounts)
+    fake_modules.BROKER.account_latency[slow] = args.slow_ms / 1000.0
+    pptwbot.STARTED_AT = perf_counter()
+    pptwbot.setup_logging()
+    pptwbot.LOGGER.setLevel('WARNING')
+
+    async def drive():
+        bot = asyncio.ensure_future(pptwbot.RunBot())
+        while pptwbot.BROKER_READY is None or not pptwbot.BROKER_READY.is_set():
+            if bot.done():
+                bot.result()
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0.05)
+        pptwbot.TRACER.reset()
+        started_at = perf_counter()
+        for index in range(args.signals):
+            ticker = TICKERS[index % len(TICKERS)]
+            fake_modules.DISCORD.post(Settings.alert_channel, '[OPEN] {} [TYPE] CALL [EXP] 12/18 [STRIKE] 350 [MARK] 0.85'.format(ticker))
+        expected = args.signals * args.accounts
+        finished_at = {}
+        while pptwbot.DISPATCHER.completed + pptwbot.DISPATCHER.failed < expected:
+            for account in pptwbot.ACCOUNTS:
+                if account.name not in finished_at and account.fills + account.unfilled >= args.signals:
+                    finished_at[account.name] = perf_counter() - started_at
+            if bot.done():
+                bot.result()
+            await asyncio.sleep(0.001)
+        elapsed = perf_counter() - started_at
+        bot.cancel()
+        await pptwbot.StopBot()
+        return elapsed, finished_at
+
+    elapsed, finished_at = asyncio.get_event_loop().run_until_complete(drive())
+    snapshot = pptwbot.TRACER.snapshot()
+    print('{} signals x {} accounts in {:.2f}s, {} broker calls'.format(args.signals, args.accounts, elapsed, sum(fake_modules.BROKER.calls.values())))
+    print('{:<10} {:>8} {:>8} {:>7} {:>14} {:>14} {:>12}'.format('account', 'orders', 'errors', 'fills', 'to order p50', 'to order p99', 'done at s'))
+    for account in pptwbot.ACCOUNTS:
+        stats = snapshot['stages'].get('account.{}.signal_to_order'.format(account.name), {'p50_ms': 0.0, 'p99_ms': 0.0})
+        name = account.name + (' (slow)' if account.account.account_number == slow else '')
+        print('{:<10} {:>8} {:>8} {:>7} {:>11.1f} ms {:>11.1f} ms {:>12.2f}'.format(name, account.orders, account.order_errors, account.fills, stats['p50_ms'], stats['p99_ms'], finished_at.get(account.name, elapsed)))
+
+if __name__ == '__main__':
+    main()
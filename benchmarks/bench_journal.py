@@ -0,0 +1,76 @@
+# Measures the trade journal's write throughput and the wait an order sees for its row to reach the disk, with group
+# commit (every row queued while the last commit was syncing goes in the next one) against one commit per row.
+# Then leaves some operations open, reopens the file and checks recover() returns exactly those.
+# Run from the repo root: python -m benchmarks.bench_journal [--events N] [--orders N] [--concurrency N]
+import os
+import asyncio
+import argparse
+import tempfile
+from time import perf_counter
+import numpy as np
+from trade_journal import TradeJournal
+
+async def write_events(journal, events):
+    # Signal-style begin/end pairs as fast as the loop can queue them, then wait for the last one to be on disk.
+    t0 = perf_counter()
+    for index in range(events // 2):
+        op = journal.begin('signal', 'acct1', type='UPDATE', ticker='SPY', option_type='CALL', exp='2020-12-18', strike='350', mark='1.50')
+        journal.end(op)
+    queued = perf_counter() - t0
+    await journal.flush()
+    return queued, perf_counter() - t0
+
+async def place_orders(journal, orders, concurrency):
+    # Each order journals its intent and waits for it to be durable before "sending", the way ExecuteOrder does.
+    waits = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def order(index):
+        async with semaphore:
+            t0 = perf_counter()
+            op = journal.begin('order', 'acct1', ticker='SPY', type='Limit', price='1.55')
+            await journal.flush()
+            waits.append(perf_counter() - t0)
+            await asyncio.sleep(0.001)
+            journal.end(op, result={'id': index})
+
+    t0 = perf_counter()
+    await asyncio.gather(*[order(index) for index in range(orders)])
+    return waits, perf_counter() - t0
+
+def run(directory, name, batch_size, args):
+    journal = TradeJournal(os.path.join(directory, name + '.sqlite3'), batch_size=batch_size)
+    loop = asyncio.get_event_loop()
+    queued, total = loop.run_until_complete(write_events(journal, args.events))
+    waits, order_time = loop.run_until_complete(place_orders(journal, args.orders, args.concurrency))
+    journal.close()
+    waits = np.array(waits) * 1000.0
+    print('{:<14} {:>10,.0f} rows/s  {:>6} commits  loop time/row {:>6.2f}us   order wait p50 {:>7.2f}ms  p99 {:>7.2f}ms  ({:,.0f} orders/s)'.format(
+        name, args.events / total, journal.batches, queued / args.events * 1e6, np.percentile(waits, 50), np.percentile(waits, 99), args.orders / order_time))
+
+def check_recovery(directory):
+    path = os.path.join(directory, 'recovery.sqlite3')
+    journal = TradeJournal(path)
+    finished = journal.begin('signal', 'acct1', ticker='SPY')
+    journal.end(finished)
+    unfinished = [journal.begin('order', 'acct1', ticker='QQQ'), journal.begin('cancel', 'acct2', order_ids=[7, 8])]
+    asyncio.get_event_loop().run_until_complete(journal.flush())
+    journal.close()
+    reopened = TradeJournal(path)
+    recovered = [operation['op'] for operation in reopened.recover()]
+    reopened.close()
+    print('recovery: {} unfinished, {} recovered, match={}'.format(len(unfinished), len(recovered), recovered == unfinished))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--orders', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        run(directory, 'group commit', 5000, args)
+        run(directory, 'commit per row', 1, args)
+        check_recovery(directory)
+
+if __name__ == '__main__':
+    main()
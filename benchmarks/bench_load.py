@@ -0,0 +1,316 @@
+# End-to-end load and soak run.  Drives pptwbot.RunBot() against the fake discord/tastyworks modules in
+# benchmarks/fake_modules.py: bursts of OPEN/UPDATE/CLOSE messages go through on_message and the real handlers while
+# the alert and position watchers run, with broker latency, jitter and injected errors.  Fake marks drift and fake
+# alerts trigger so the watchers' exits fire too.
+# By default it runs the bot's default configuration: the broker gateway talks to a mock_broker_server serving the fake
+# broker's state, and exits run on the fake quote streamer's ticks.  --no-gateway and --no-streaming turn those off.
+# Orders are read, cancelled and replaced over HTTP.  Positions and alerts can't be built from JSON by the fake models,
+# so those reads are the models' calls shared through the gateway.  At the end the gateway's live-order listing,
+# which like the real endpoint includes finished orders, is checked against the model call's.
+# Every --report-seconds it prints the interval's throughput, signal-to-order p50/p99, broker calls per signal,
+# errors, event-loop lag, dispatcher queue depth and process memory; at the end, totals and the memory growth rate.
+# --max-p99-ms / --max-lag-ms / --max-growth-mb-per-hour make it exit non-zero, for catching regressions.
+# Run from the repo root: python -m benchmarks.bench_load [--duration S] [--burst-size N] [--burst-interval S]
+#   [--api-ms X] [--jitter-ms X] [--error-rate X] [--accounts N] [--no-gateway] [--no-streaming] [--replace-stops]
+# Soak: python -m benchmarks.bench_load --duration 10800 --report-seconds 300
+import gc
+import os
+import sys
+import random
+import asyncio
+import argparse
+import types
+import tempfile
+from decimal import Decimal
+from time import perf_counter
+import numpy as np
+from aiohttp import web
+from mock_broker_server import MockBroker
+from benchmarks.fake_modules import Order, OrderDetails, OrderType, OrderPriceEffect
+
+FORMATS = {
+    'OPEN': '[OPEN] {ticker} [TYPE] {option_type} [EXP] 12/18 [STRIKE] {strike} [MARK] {mark}',
+    'UPDATE': '[UPDATE] {ticker} [TYPE] {option_type} [EXP] 12/18 [STRIKE] {strike} [MARK] {mark}',
+    'CLOSE': '[CLOSE] {ticker} [TYPE] {option_type} [EXP] 12/18 [STRIKE] {strike}',
+}
+
+
+class SignalSource(object):
+    # Walks a universe of tickers through open -> updates -> close, so each message is about a trade the bot could hold.
+    def __init__(self, tickers: int, close_rate: float, seed: int):
+        self.random = random.Random(seed)
+        self.tickers = ['T{:03d}'.format(index) for index in range(tickers)]
+        self.close_rate = close_rate
+        self.open = {}
+        self.sent = {'OPEN': 0, 'UPDATE': 0, 'CLOSE': 0}
+
+    def next(self) -> str:
+        ticker = self.random.choice(self.tickers)
+        trade = self.open.get(ticker)
+        if trade is None:
+            kind = 'OPEN'
+            trade = self.open[ticker] = {'ticker': ticker, 'option_type': self.random.choice(('CALL', 'PUT')), 'strike': self.random.randint(20, 400), 'mark': round(self.random.uniform(0.5, 3.0), 2)}
+        elif self.random.random() < self.close_rate:
+            kind = 'CLOSE'
+            del self.open[ticker]
+        else:
+            kind = 'UPDATE'
+            trade['mark'] = round(max(0.05, trade['mark'] * self.random.uniform(0.9, 1.15)), 2)
+        self.sent[kind] += 1
+        return FORMATS[kind].format(**trade)
+
+
+class FakeBrokerServer(MockBroker):
+    # mock_broker_server's endpoints, answered from the fake tastyworks broker so the gateway and the models agree.
+    # Requests pay the fake broker's latency, jitter and injected errors rather than the server's own.
+    def __init__(self, broker):
+        super().__init__(latency_ms = 0.0)
+        self.broker = broker
+
+    async def call(self, name: str, request):
+        try:
+            await self.broker.call(name, types.SimpleNamespace(account_number = request.match_info.get('account')))
+        except Exception as ex:
+            raise web.HTTPInternalServerError(text=str(ex))
+
+    async def get_positions(self, request):
+        await self.call('get_positions', request)
+        self.broker.move_marks()
+        return web.json_response({'data': {'items': [
+            {'symbol': position.get_option_obj().get_dxfeed_symbol(), 'underlying-symbol': position.underlying_symbol, 'quantity': position.quantity,
+             'average-open-price': str(position.average_open_price), 'mark-price': str(position.mark_price)}
+            for position in self.broker.positions if self.broker.owns(request.match_info['account'], position)]}})
+
+    async def get_live_orders(self, request):
+        await self.call('get_live_orders', request)
+        # Like the real endpoint, the latest finished orders are listed too.
+        orders = list(self.broker.orders.values()) + list(self.broker.done_orders.values())[-50:]
+        return web.json_response({'data': {'items': [order.to_dict() for order in orders if self.broker.owns(request.match_info['account'], order)]}})
+
+    async def get_order(self, request):
+        await self.call('get_order', request)
+        order_id = int(request.match_info['order_id'])
+        order = self.broker.orders.get(order_id) or self.broker.done_orders.get(order_id)
+        if order is None:
+            return web.json_response({'error': {'message': 'Order not found'}}, status=404)
+        return web.json_response({'data': order.to_dict()})
+
+    async def cancel_order(self, request):
+        await self.call('cancel_order', request)
+        order_id = int(request.match_info['order_id'])
+        try:
+            status = self.broker.cancel(order_id)
+        except Exception as ex:
+            return web.json_response({'error': {'message': str(ex)}}, status=404)
+        return web.json_response({'data': {'id': order_id, 'status': status.value}})
+
+    async def replace_order(self, request):
+        await self.call('replace_order', request)
+        old = self.broker.orders.get(int(request.match_info['order_id']))
+        if old is None:
+            return web.json_response({'error': {'message': 'Order not found'}}, status=404)
+        body = await request.json()
+        order = Order(OrderDetails(type=OrderType(body['order-type']), price=Decimal(body['price']) if 'price' in body else None, price_effect=OrderPriceEffect(body['price-effect']),
+            stop_trigger=Decimal(body['stop-trigger']) if 'stop-trigger' in body else None, ticker=old.details.ticker))
+        order.legs = list(old.legs)
+        try:
+            result = self.broker.replace(old.details.order_id, order, request.match_info['account'])
+        except Exception as ex:
+            return web.json_response({'error': {'message': str(ex)}}, status=404)
+        return web.json_response({'data': result['order']})
+
+    async def get_alerts(self, request):
+        await self.call('get_quote_alert', request)
+        self.broker.trigger_alerts()
+        return web.json_response({'data': {'items': [
+            {'symbol': alert.symbol, 'field': alert.field, 'operator': alert.operator, 'threshold': str(alert.threshold), 'triggered-at': 'now' if alert.triggered else None}
+            for alert in self.broker.alerts]}})
+
+
+def get_rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError):
+        # Peak rather than current, in KB on Linux and bytes on macOS.
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+async def probe_loop(lags: list, interval: float = 0.01):
+    while True:
+        t0 = perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(perf_counter() - t0 - interval)
+
+async def post_bursts(discord, channel: str, source: SignalSource, args, stop_at: float):
+    while perf_counter() < stop_at:
+        for index in range(args.burst_size):
+            discord.post(channel, source.next())
+        await asyncio.sleep(args.burst_interval)
+
+def percentiles(values, scale = 1000.0) -> tuple:
+    if not len(values):
+        return 0.0, 0.0, 0.0
+    values = np.array(values) * scale
+    return np.percentile(values, 50), np.percentile(values, 99), values.max()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=60.0, help='Seconds to keep posting signals.')
+    parser.add_argument('--report-seconds', type=float, default=10.0)
+    parser.add_argument('--burst-size', type=int, default=200)
+    parser.add_argument('--burst-interval', type=float, default=5.0)
+    parser.add_argument('--tickers', type=int, default=150)
+    parser.add_argument('--close-rate', type=float, default=0.2, help='Chance an open trade gets CLOSE rather than UPDATE.')
+    parser.add_argument('--api-ms', type=float, default=30.0)
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--mark-volatility', type=float, default=0.05)
+    parser.add_argument('--alert-trigger-rate', type=float, default=0.02)
+    parser.add_argument('--accounts', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-gateway', action='store_true', help='Call the broker through the tastyworks models only.')
+    parser.add_argument('--no-streaming', action='store_true', help='Poll positions every 2 seconds rather than streaming quotes.')
+    parser.add_argument('--replace-stops', action='store_true', help='Turn on ReplaceStopOrders, which replaces the profit stop through the gateway.')
+    parser.add_argument('--quote-interval', type=float, default=1.0, help='Seconds between the fake streamer\'s quotes.')
+    parser.add_argument('--max-p99-ms', type=float, default=0.0)
+    parser.add_argument('--max-lag-ms', type=float, default=0.0)
+    parser.add_argument('--max-growth-mb-per-hour', type=float, default=0.0)
+    args = parser.parse_args()
+
+    from benchmarks import fake_modules
+    fake_modules.install()
+    broker = fake_modules.BROKER
+    broker.random.seed(args.seed)
+    broker.login_latency = 0.0
+    broker.latency = args.api_ms / 1000.0
+    broker.jitter = args.jitter_ms / 1000.0
+    broker.error_rate = args.error_rate
+    broker.mark_volatility = args.mark_volatility
+    broker.alert_trigger_rate = args.alert_trigger_rate
+    broker.quote_interval = args.quote_interval
+    fake_modules.DISCORD.login_latency = 0.0
+    fake_modules.DISCORD.connect_latency = 0.0
+    import pptwbot
+    # Raw signal-to-order samples.  The tracer only keeps histogram buckets, whose bounds are too coarse for a gate.
+    to_order = []
+    record = pptwbot.TRACER.record
+    def record_sample(name: str, seconds: float, error: bool = False):
+        if name == 'signal_to_order':
+            to_order.append(seconds)
+        record(name, seconds, error)
+    pptwbot.TRACER.record = record_sample
+    from settings import Settings
+    Settings.UseBrokerGateway = not args.no_gateway
+    Settings.UseStreamingQuotes = not args.no_streaming
+    Settings.ReplaceStopOrders = args.replace_stops
+    Settings.TracingHttpPort = 0
+    Settings.MarketSellOnAlert = True
+    Settings.MarketSellOnDeactivate = True
+    Settings.AutoCloseAtProfitPercent = Decimal('20')
+    Settings.AutoCloseAtLossPercent = Decimal('35')
+    Settings.MaxBet = Decimal('1000')
+    Settings.EntryFillTimeout = 2.0
+    Settings.tasty_user = 'bench'
+    Settings.tasty_account_number = ''
+    Settings.Accounts = tuple({'account_number': 'LOAD{}'.format(index), 'name': 'acct{}'.format(index)} for index in range(1, args.accounts + 1))
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    pptwbot.STARTED_AT = perf_counter()
+    pptwbot.setup_logging()
+    source = SignalSource(args.tickers, args.close_rate, args.seed)
+
+    mismatches = []
+
+    async def drive():
+        server = None
+        if Settings.UseBrokerGateway:
+            server = FakeBrokerServer(broker)
+            broker.api_url = await server.start()
+        bot = asyncio.ensure_future(pptwbot.RunBot())
+        while pptwbot.BROKER_READY is None or not pptwbot.BROKER_READY.is_set():
+            if bot.done():
+                bot.result()
+            await asyncio.sleep(0.01)
+        lags = []
+        probe = asyncio.ensure_future(probe_loop(lags))
+        started_at = perf_counter()
+        poster = asyncio.ensure_future(post_bursts(fake_modules.DISCORD, Settings.alert_channel, source, args, started_at + args.duration))
+        print('{:>7} {:>7} {:>7} {:>10} {:>10} {:>9} {:>7} {:>9} {:>9} {:>6} {:>8} {:>9}'.format(
+            'time s', 'signals', 'sig/s', 'order p50', 'order p99', 'calls/sig', 'errors', 'lag p99', 'lag max', 'queue', 'rss MB', 'objects'))
+        rows = []
+        last = {'at': started_at, 'done': 0, 'calls': 0, 'errors': 0}
+        while True:
+            drained = poster.done() and pptwbot.DISPATCHER.stats()['queue_depth'] == 0 and pptwbot.DISPATCHER.stats()['in_flight_tickers'] == 0
+            await asyncio.sleep(args.report_seconds if not poster.done() else 1.0)
+            if bot.done():
+                bot.result()
+            now = perf_counter()
+            stats = pptwbot.DISPATCHER.stats()
+            done = stats['completed'] + stats['failed']
+            calls = sum(broker.calls.values())
+            errors = sum(broker.errors.values()) + stats['failed']
+            order_p50, order_p99, order_max = percentiles(to_order)
+            del to_order[:]
+            lag_p50, lag_p99, lag_max = percentiles(lags)
+            del lags[:]
+            signals = done - last['done']
+            row = {
+                'time': now - started_at, 'signals': signals, 'rate': signals / (now - last['at']), 'p50': order_p50, 'p99': order_p99,
+                'calls_per_signal': (calls - last['calls']) / signals if signals else 0.0, 'errors': errors - last['errors'],
+                'lag_p99': lag_p99, 'lag_max': lag_max, 'queue': stats['queue_depth'], 'rss': get_rss_mb(), 'objects': len(gc.get_objects()),
+            }
+            rows.append(row)
+            last = {'at': now, 'done': done, 'calls': calls, 'errors': errors}
+            print('{time:>7.0f} {signals:>7} {rate:>7.1f} {p50:>10.1f} {p99:>10.1f} {calls_per_signal:>9.2f} {errors:>7} {lag_p99:>9.2f} {lag_max:>9.2f} {queue:>6} {rss:>8.1f} {objects:>9}'.format(**row))
+            if drained:
+                break
+        probe.cancel()
+        bot.cancel()
+        if server is not None:
+            # The gateway's JSON listing, which includes finished orders, has to come back as the model call's active set.
+            # The exit tasks may still be trading, so both are listed at once and a difference has to persist.
+            broker.error_rate = broker.latency = broker.jitter = 0.0
+            for account in pptwbot.ACCOUNTS:
+                for attempt in range(3):
+                    listings = await asyncio.gather(pptwbot.FetchLiveOrders(account), fake_modules.Order.get_live_orders(account.session, account.account))
+                    listed, active = [set(order.details.order_id for order in orders) for orders in listings]
+                    if listed == active:
+                        break
+                    await asyncio.sleep(0.5)
+                else:
+                    mismatches.append('{} live orders: gateway {} vs model {}'.format(account.name, sorted(listed - active), sorted(active - listed)))
+        await pptwbot.StopBot()
+        if server is not None:
+            print('gateway: {} requests to the mock broker server over {} connection(s)'.format(server.requests, len(server.connections)))
+            await server.stop()
+        if pptwbot.EXIT_ENGINE is not None:
+            print('quote stream: {} ticks, {} symbols subscribed at the end'.format(pptwbot.EXIT_ENGINE.tick_count, len(pptwbot.EXIT_ENGINE.subscribed)))
+        return rows, perf_counter() - started_at
+
+    rows, elapsed = asyncio.get_event_loop().run_until_complete(drive())
+    signals = sum(row['signals'] for row in rows)
+    calls = sum(broker.calls.values())
+    # The first interval holds the warm-up, so growth is fitted over the rest.
+    steady = rows[1:] if len(rows) > 2 else rows
+    growth = np.polyfit([row['time'] for row in steady], [row['rss'] for row in steady], 1)[0] * 3600.0 if len(steady) > 1 else 0.0
+    worst_p99 = max(row['p99'] for row in rows)
+    worst_lag = max(row['lag_max'] for row in rows)
+    print('sent {OPEN} OPEN, {UPDATE} UPDATE, {CLOSE} CLOSE x {accounts} account(s)'.format(accounts=args.accounts, **source.sent))
+    print('{} signals handled in {:.1f}s ({:.1f}/s), {:.2f} broker calls per signal, {} injected broker errors'.format(signals, elapsed, signals / elapsed, calls / signals if signals else 0.0, sum(broker.errors.values())))
+    print('worst interval: signal-to-order p99 {:.1f}ms, loop lag max {:.1f}ms;  memory {:.1f} -> {:.1f} MB ({:+.1f} MB/hour)'.format(worst_p99, worst_lag, rows[0]['rss'], rows[-1]['rss'], growth))
+    print('broker left with {} positions, {} live orders, {} alerts'.format(len(broker.positions), len(broker.orders), len(broker.alerts)))
+    failures = list(mismatches)
+    if args.max_p99_ms and worst_p99 > args.max_p99_ms:
+        failures.append('signal-to-order p99 {:.1f}ms > {:.1f}ms'.format(worst_p99, args.max_p99_ms))
+    if args.max_lag_ms and worst_lag > args.max_lag_ms:
+        failures.append('loop lag {:.1f}ms > {:.1f}ms'.format(worst_lag, args.max_lag_ms))
+    if args.max_growth_mb_per_hour and growth > args.max_growth_mb_per_hour:
+        failures.append('memory growth {:+.1f} MB/hour > {:.1f}'.format(growth, args.max_growth_mb_per_hour))
+    if failures:
+        print('FAILED: ' + '; '.join(failures))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
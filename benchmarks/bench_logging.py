@@ -0,0 +1,77 @@
+# Measures event-loop stall caused by logging bursts, with the plain FileHandler and with AsyncLogHandler.
+# A probe task sleeps 1ms in a loop and records how late it wakes up while bursts of signal-style log lines are written.
+# Run from the repo root: python -m benchmarks.bench_logging [--bursts N] [--lines N] [--slow-disk-ms X]
+import os
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+from time import perf_counter
+from log_pipeline import enable_async_logging
+
+class SlowFileHandler(logging.FileHandler):
+    # Adds a fixed delay to every flush to stand in for a slow or contended disk.
+    def __init__(self, filename, delay_ms):
+        super().__init__(filename)
+        self.delay = delay_ms / 1000.0
+
+    def flush(self):
+        super().flush()
+        if self.delay:
+            time.sleep(self.delay)
+
+def make_logger(name, path, async_writer, slow_disk_ms):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = SlowFileHandler(path, slow_disk_ms)
+    handler.setFormatter(logging.Formatter('%(asctime)s | %(levelname)-8s | %(lineno)04d | %(message)s'))
+    logger.addHandler(handler)
+    if async_writer:
+        return logger, enable_async_logging(logger)
+    return logger, handler
+
+async def probe(lags, stop):
+    while not stop.is_set():
+        t0 = perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(perf_counter() - t0 - 0.001)
+
+async def run(logger, args):
+    lags = []
+    stop = asyncio.Event()
+    probe_task = asyncio.ensure_future(probe(lags, stop))
+    log_time = 0.0
+    for burst in range(args.bursts):
+        t0 = perf_counter()
+        for line in range(args.lines):
+            logger.info('Current profit for %s is %.3f%%. Mark: $%.3f Entry: %s @ $%.3f', 'AAPL', 12.3456, 1.55, 2, 1.38)
+        log_time += perf_counter() - t0
+        await asyncio.sleep(args.gap)
+    stop.set()
+    await probe_task
+    return lags, log_time
+
+def report(name, lags, log_time, total_lines):
+    lags.sort()
+    print('{:<8} log calls {:>8.2f}us/line   loop lag p50 {:>7.2f}ms  p99 {:>7.2f}ms  max {:>7.2f}ms'.format(
+        name, log_time / total_lines * 1e6, lags[len(lags) // 2] * 1e3, lags[int(len(lags) * 0.99)] * 1e3, lags[-1] * 1e3))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bursts', type=int, default=50)
+    parser.add_argument('--lines', type=int, default=200, help='Log lines per burst.')
+    parser.add_argument('--gap', type=float, default=0.02, help='Seconds between bursts.')
+    parser.add_argument('--slow-disk-ms', type=float, default=0.0, help='Extra delay added to each flush.')
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    with tempfile.TemporaryDirectory() as directory:
+        for name, async_writer in (('sync', False), ('async', True)):
+            logger, handler = make_logger('bench.' + name, os.path.join(directory, name + '.log'), async_writer, args.slow_disk_ms)
+            lags, log_time = loop.run_until_complete(run(logger, args))
+            handler.close()
+            report(name, lags, log_time, args.bursts * args.lines)
+
+if __name__ == '__main__':
+    main()
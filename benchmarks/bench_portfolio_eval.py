@@ -0,0 +1,68 @@
+# Compares the per-position Decimal exit checks with the batched PortfolioBatch evaluator, and checks they agree.
+# Run from the repo root: python -m benchmarks.bench_portfolio_eval [--sizes 10,1000,100000]
+import random
+import argparse
+import dataclasses
+from time import perf_counter
+from decimal import Decimal
+from settings import Settings
+from strategy import PROFIT_EXIT, get_exit_action, get_profit_percent, get_profit_stop_trigger
+import portfolio_eval
+from portfolio_eval import PortfolioBatch
+
+class FakePosition(object):
+    __slots__ = ('average_open_price', 'mark_price', 'multiplier', 'quantity')
+
+    def __init__(self, average_open_price, mark_price, multiplier, quantity):
+        self.average_open_price = average_open_price
+        self.mark_price = mark_price
+        self.multiplier = multiplier
+        self.quantity = quantity
+
+def make_positions(count):
+    rnd = random.Random(count)
+    positions = []
+    for _ in range(count):
+        open_cents = rnd.randint(5, 2000)
+        mark_cents = max(1, int(open_cents * rnd.uniform(0.4, 1.8)))
+        positions.append(FakePosition(Decimal(open_cents) / 100, Decimal(mark_cents) / 100, 100, rnd.randint(1, 20)))
+    return positions
+
+def decimal_path(positions, settings):
+    results = []
+    for position in positions:
+        profit_percent = get_profit_percent(position)
+        action = get_exit_action(profit_percent, settings)
+        stop = get_profit_stop_trigger(position.mark_price, position.average_open_price, settings) if action == PROFIT_EXIT else None
+        results.append((action, stop))
+    return results
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = perf_counter()
+        result = fn()
+        elapsed = perf_counter() - t0
+        best = elapsed if best is None or elapsed < best else best
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10,1000,100000')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    settings = dataclasses.replace(Settings(), AutoCloseAtProfitPercent=Decimal('25'), AutoCloseAtLossPercent=Decimal('30'))
+    print('numpy: {}'.format(portfolio_eval.numpy.__version__ if portfolio_eval.numpy else 'not installed (pure Python columns)'))
+    print('{:>9}  {:>12}  {:>12}  {:>12}  {:>12}  {:>8}'.format('positions', 'decimal', 'batch load', 'batch eval', 'exit rows', 'speedup'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        positions = make_positions(size)
+        decimal_time, expected = timed(lambda: decimal_path(positions, settings), args.repeat)
+        load_time, batch = timed(lambda: PortfolioBatch(positions), args.repeat)
+        eval_time, results = timed(lambda: batch.evaluate(settings), args.repeat)
+        rows_time, rows = timed(lambda: batch.get_exit_rows(settings), args.repeat)
+        assert [(action, stop) for action, _, stop in results] == expected, 'batched results differ from the Decimal path'
+        assert rows == [i for i, (action, _) in enumerate(expected) if action is not None]
+        print('{:>9,}  {:>10.3f}ms  {:>10.3f}ms  {:>10.3f}ms  {:>10.3f}ms  {:>7.1f}x'.format(size, decimal_time * 1e3, load_time * 1e3, eval_time * 1e3, rows_time * 1e3, decimal_time / rows_time))
+
+if __name__ == '__main__':
+    main()
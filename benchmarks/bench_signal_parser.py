@@ -0,0 +1,90 @@
+# Replays a corpus of signal and chatter messages through the legacy triple re.search path and the compiled SignalParser.
+# Both build the same Signal, with its Decimal and date fields, so only the matching differs.
+# Run from the repo root: python -m benchmarks.bench_signal_parser [--messages N]
+import re
+import sys
+import random
+import argparse
+from time import perf_counter
+from decimal import Decimal
+from settings import Settings
+from signal_parser import Signal, SignalParser, SignalType, get_expire_date_from_string
+
+SIGNALS = [
+    '[OPEN] $AAPL [TYPE] CALL [EXP] 12/20 [STRIKE] $280 [MARK] $1.45',
+    '[OPEN] SPY [TYPE] PUTS [EXP] 1/17 [STRIKE] 320.5 [MARK] 2.10',
+    '[UPDATE] $AAPL [TYPE] CALL [EXP] 12/20 [STRIKE] $280 [MARK] $281.30',
+    '[UPDATE] MSFT [TYPE] PUT [EXP] 12/27 [STRIKE] 155 [MARK] 153.80',
+    '[CLOSE] $AAPL [TYPE] CALL [EXP] 12/20 [STRIKE] $280',
+    '[CLOSE] NVDA [TYPE] CALLS [EXP] 1/3 [STRIKE] 240',
+]
+NOISE = [
+    'gm everyone, watching SPY at the open',
+    'AAPL looking strong today',
+    '[INFO] market closed early tomorrow',
+    'anyone else in the msft calls?',
+    '[open] tsla? not today',
+    ':rocket: :rocket:',
+]
+
+def legacy_parse(content, entry, update, deactivate):
+    # The old on_message searches, then the field conversions the old Process*Signal handlers did on the match, so
+    # both paths end with the same Signal.
+    message_ucase = content.upper()
+    Entry = re.search(entry, message_ucase)
+    Update = re.search(update, message_ucase)
+    Deactivate = re.search(deactivate, message_ucase)
+    if Entry:
+        signal_type, match = SignalType.ENTRY, Entry
+    elif Update:
+        signal_type, match = SignalType.UPDATE, Update
+    elif Deactivate:
+        signal_type, match = SignalType.DEACTIVATE, Deactivate
+    else:
+        return None
+    groups = match.groupdict()
+    mark = groups.get('Mark')
+    return Signal(signal_type = signal_type,
+                  ticker = match.group('Ticker').upper(),
+                  option_type = match.group('Type').upper(),
+                  exp_date = get_expire_date_from_string(match.group('Exp')),
+                  strike = Decimal(match.group('Strike')),
+                  mark = Decimal(mark) if mark is not None else None)
+
+def get_fields(signal):
+    return None if signal is None else (signal.signal_type, signal.ticker, signal.option_type, signal.exp_date, signal.strike, signal.mark)
+
+def build_corpus(count, noise_ratio):
+    rnd = random.Random(42)
+    return [rnd.choice(NOISE) if rnd.random() < noise_ratio else rnd.choice(SIGNALS) for _ in range(count)]
+
+def run(name, fn, corpus):
+    latencies = []
+    start = perf_counter()
+    for content in corpus:
+        t0 = perf_counter()
+        fn(content)
+        latencies.append(perf_counter() - t0)
+    elapsed = perf_counter() - start
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1e6
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+    print('{:<10} {:>12,.0f} msg/s   p50 {:>7.2f}us   p99 {:>7.2f}us'.format(name, len(corpus) / elapsed, p50, p99))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--noise', type=float, default=0.7, help='Fraction of non-signal chatter in the corpus.')
+    args = parser.parse_args()
+    corpus = build_corpus(args.messages, args.noise)
+    signal_parser = SignalParser()
+    legacy = lambda c: legacy_parse(c, Settings.EntryRegex, Settings.UpdateRegex, Settings.DeactivateRegex)
+    # Both paths have to agree on every message for the timings to compare like with like.
+    for content in SIGNALS + NOISE:
+        if get_fields(legacy(content)) != get_fields(signal_parser.parse(content)):
+            sys.exit('legacy and compiled parses differ on {!r}'.format(content))
+    run('legacy', legacy, corpus)
+    run('compiled', signal_parser.parse, corpus)
+
+if __name__ == '__main__':
+    main()
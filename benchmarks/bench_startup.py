@@ -0,0 +1,91 @@
+# Measures time from process start to the first signal being handled, cold (no state cache) and warm (cache from the
+# cold run).  Each run is a fresh interpreter driving pptwbot.RunBot() against the fake discord/tastyworks modules in
+# benchmarks/fake_modules.py, with a signal posted before Discord connects.  The old import-time startup ran the broker
+# login, account lookup and Discord login one after another; that sum is printed from the cold run's stage timings.
+# Run from the repo root: python -m benchmarks.bench_startup [--login-ms X] [--api-ms X] [--discord-login-ms X]
+import os
+import sys
+import json
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from time import perf_counter
+
+SIGNAL = '[UPDATE] SPY [TYPE] CALL [EXP] 12/18 [STRIKE] 350 [MARK] 1.50'
+
+def run_child(args):
+    started_at = perf_counter()
+    from benchmarks import fake_modules
+    fake_modules.install()
+    fake_modules.BROKER.login_latency = args.login_ms / 1000.0
+    fake_modules.BROKER.latency = args.api_ms / 1000.0
+    fake_modules.DISCORD.login_latency = args.discord_login_ms / 1000.0
+    fake_modules.DISCORD.connect_latency = args.discord_connect_ms / 1000.0
+    import pptwbot
+    from settings import Settings
+    imported = perf_counter() - started_at
+    Settings.StateCacheFile = args.cache
+    Settings.UseBrokerGateway = False
+    Settings.TracingHttpPort = 0
+    Settings.tasty_user = 'bench'
+    Settings.tasty_account_number = 'BENCH1'
+    os.chdir(os.path.dirname(args.cache))
+    pptwbot.STARTED_AT = started_at
+    pptwbot.setup_logging()
+    fake_modules.BROKER.add_position('SPY', fake_modules.OptionType.CALL)
+    fake_modules.DISCORD.post(Settings.alert_channel, SIGNAL)
+
+    async def drive():
+        bot = asyncio.ensure_future(pptwbot.RunBot())
+        while pptwbot.DISPATCHER is None or pptwbot.DISPATCHER.completed + pptwbot.DISPATCHER.failed < 1:
+            if bot.done():
+                bot.result()
+            await asyncio.sleep(0.001)
+        first_signal = perf_counter() - started_at
+        bot.cancel()
+        await pptwbot.StopBot()
+        return first_signal
+
+    first_signal = asyncio.get_event_loop().run_until_complete(drive())
+    stages = pptwbot.TRACER.snapshot()['stages']
+    timings = {name: stats['max_ms'] for name, stats in stages.items() if name.startswith('startup.')}
+    timings['import_ms'] = imported * 1000.0
+    timings['first_signal_ms'] = first_signal * 1000.0
+    timings['broker_calls'] = sum(fake_modules.BROKER.calls.values())
+    print(json.dumps(timings))
+
+def run_parent(args):
+    with tempfile.TemporaryDirectory() as directory:
+        cache = os.path.join(directory, 'state.pickle')
+        child_args = [sys.executable, '-m', 'benchmarks.bench_startup', '--child', '--cache', cache,
+                      '--login-ms', str(args.login_ms), '--api-ms', str(args.api_ms),
+                      '--discord-login-ms', str(args.discord_login_ms), '--discord-connect-ms', str(args.discord_connect_ms)]
+        results = {}
+        for name in ('cold', 'warm'):
+            output = subprocess.run(child_args, check=True, stdout=subprocess.PIPE, cwd=os.getcwd()).stdout.decode()
+            results[name] = json.loads(output.strip().splitlines()[-1])
+    keys = ('import_ms', 'startup.import_tastyworks', 'startup.session', 'startup.account', 'startup.broker_ready', 'startup.discord_ready', 'startup.first_message', 'first_signal_ms', 'broker_calls')
+    print('{:<28} {:>10} {:>10}'.format('', 'cold', 'warm'))
+    for key in keys:
+        print('{:<28} {:>10.1f} {:>10.1f}'.format(key, results['cold'].get(key, 0.0), results['warm'].get(key, 0.0)))
+    cold = results['cold']
+    sequential = cold['import_ms'] + cold.get('startup.import_tastyworks', 0.0) + cold.get('startup.session', 0.0) + cold.get('startup.account', 0.0) + args.discord_login_ms + args.discord_connect_ms
+    print('old sequential startup to Discord connected (estimated): {:.1f} ms'.format(sequential))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--login-ms', type=float, default=400.0, help='Broker session login.')
+    parser.add_argument('--api-ms', type=float, default=60.0, help='Every other broker call.')
+    parser.add_argument('--discord-login-ms', type=float, default=500.0)
+    parser.add_argument('--discord-connect-ms', type=float, default=700.0)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--cache', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args)
+    else:
+        run_parent(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# Replays a rising option price through the profit-stop exit and measures how long the position is left with no
+# working stop (including the wait for the first one), the broker calls per tick and the time to handle a tick.
+# Compares the old sequence (re-list the sell orders every tick, cancel the stop and wait for the cancel to be
+# confirmed, then place the new one) against TrailingStops with place-then-cancel and with order replacement.  Runs
+# against the fake tastyworks module in benchmarks/fake_modules.py, whose cancels sit in 'Cancel Requested' for
+# --cancel-ms like the real broker's.  With --refuse-duplicates the fake refuses a second closing order for the
+# contracts, so place-then-cancel falls back to a confirmed cancel before placing.
+# Run from the repo root: python -m benchmarks.bench_trailing_stop [--ticks N] [--api-ms X] [--cancel-ms X] [--min-step X]
+#   [--refuse-duplicates]
+import os
+import random
+import asyncio
+import argparse
+import tempfile
+from decimal import Decimal
+from time import perf_counter
+import numpy as np
+
+async def old_ratchet(pptwbot, account, position):
+    # The profit-stop branch of EvaluatePositionExit before TrailingStops.
+    stop_trigger = pptwbot.get_profit_stop_trigger(position.mark_price, position.average_open_price, account.settings)
+    orders = await pptwbot.GetSellOrdersByTicker(account, position.underlying_symbol)
+    existing_stop_order = False
+    replace_order = False
+    for order in orders:
+        if order.details.type == pptwbot.OrderType.STOP:
+            existing_stop_order = True
+            if order.details.stop_trigger < stop_trigger:
+                await pptwbot.CancelOrderByID(account, order.details.order_id)
+                replace_order = True
+    if replace_order or not existing_stop_order:
+        await pptwbot.ExitTradeWithStopMarketOrder(account, position = position, stop_trigger = stop_trigger)
+
+async def watch_coverage(broker, ticker, stop, uncovered):
+    # Adds up the time with no live stop order for the ticker, sampled every 0.5ms.
+    from benchmarks.fake_modules import OrderStatus, OrderType
+    last = perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(0.0005)
+        now = perf_counter()
+        if not any(order.details.ticker == ticker and order.details.type == OrderType.STOP and order.details.status == OrderStatus.LIVE for order in broker.orders.values()):
+            uncovered.append(now - last)
+        last = now
+
+def make_path(ticks, seed):
+    # Drifts up from 1.70 in cent steps.
+    rng = random.Random(seed)
+    mark = Decimal('1.70')
+    path = []
+    for tick in range(ticks):
+        mark = max(Decimal('1.60'), mark + Decimal(rng.choice((-2, -1, 0, 1, 1, 2, 3))) / 100)
+        path.append(mark)
+    return path
+
+async def run(pptwbot, fake_modules, account, name, mode, args):
+    from trailing_stops import TrailingStops
+    from functools import partial
+    broker = fake_modules.BROKER
+    broker.orders.clear()
+    broker.positions.clear()
+    position = broker.add_position('SPY', fake_modules.OptionType.CALL, price=Decimal('1.50'))
+    if mode == 'replace':
+        fake_modules.TradingAccount.replace_order = fake_modules.TradingAccount.replace_order_call
+    elif hasattr(fake_modules.TradingAccount, 'replace_order'):
+        del fake_modules.TradingAccount.replace_order
+    account.stops = TrailingStops(partial(pptwbot.GetStopOrders, account), partial(pptwbot.PlaceStopOrder, account), partial(pptwbot.CancelStopOrder, account),
+        partial(pptwbot.ReplaceStopOrder, account) if pptwbot.CanReplaceOrders(account) else None, cancel_confirmed = partial(pptwbot.CancelStopOrderAndConfirm, account),
+        min_step = Decimal(str(args.min_step)))
+    account.state.invalidate()
+    await asyncio.sleep(args.cancel_ms / 1000.0 + 0.05)
+    broker.calls.clear()
+    uncovered = []
+    stop = asyncio.Event()
+    watcher = asyncio.ensure_future(watch_coverage(broker, 'SPY', stop, uncovered))
+    tick_times = []
+    for mark in make_path(args.ticks, args.seed):
+        position.mark_price = mark
+        t0 = perf_counter()
+        if mode == 'old':
+            await old_ratchet(pptwbot, account, position)
+        else:
+            await account.stops.ratchet(position, pptwbot.get_profit_stop_trigger(position.mark_price, position.average_open_price, account.settings))
+        tick_times.append(perf_counter() - t0)
+    stop.set()
+    await watcher
+    tick_times = np.array(tick_times) * 1000.0
+    calls = sum(count for call, count in broker.calls.items())
+    print('{:<26} {:>8.2f} {:>8} {:>12.1f} {:>10.2f} {:>10.2f}'.format(
+        name, calls / args.ticks, broker.calls['execute_order'] + broker.calls['replace_order'], sum(uncovered) * 1000.0, np.percentile(tick_times, 50), np.percentile(tick_times, 99)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ticks', type=int, default=100)
+    parser.add_argument('--api-ms', type=float, default=30.0)
+    parser.add_argument('--cancel-ms', type=float, default=400.0, help='How long a cancel stays in Cancel Requested.')
+    parser.add_argument('--min-step', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--refuse-duplicates', action='store_true', help='Refuse a closing order while another is on the book.')
+    args = parser.parse_args()
+
+    from benchmarks import fake_modules
+    fake_modules.install()
+    fake_modules.BROKER.login_latency = 0.0
+    fake_modules.BROKER.latency = args.api_ms / 1000.0
+    fake_modules.BROKER.cancel_delay = args.cancel_ms / 1000.0
+    fake_modules.BROKER.refuse_duplicate_closes = args.refuse_duplicates
+    import pptwbot
+    from settings import Settings
+    from state_cache import StateCache
+    from trade_journal import TradeJournal
+    Settings.StateCacheFile = ''
+    Settings.UseBrokerGateway = False
+    Settings.UseStreamingQuotes = False
+    Settings.ReplaceStopOrders = True
+    Settings.tasty_user = 'bench'
+    Settings.tasty_account_number = 'BENCH1'
+    directory = tempfile.mkdtemp()
+    pptwbot.STATE_CACHE = StateCache()
+    pptwbot.JOURNAL = TradeJournal(os.path.join(directory, 'journal.sqlite3'))
+
+    async def drive():
+        await pptwbot.StartBroker()
+        account = pptwbot.ACCOUNTS[0]
+        print('{} ticks, {}ms per broker call, cancels confirm after {}ms'.format(args.ticks, args.api_ms, args.cancel_ms))
+        print('{:<26} {:>8} {:>8} {:>12} {:>10} {:>10}'.format('', 'calls/tick', 'orders', 'no stop ms', 'tick p50', 'tick p99'))
+        await run(pptwbot, fake_modules, account, 'cancel, confirm, place', 'old', args)
+        await run(pptwbot, fake_modules, account, 'place then cancel', 'place', args)
+        await run(pptwbot, fake_modules, account, 'replace', 'replace', args)
+
+    asyncio.get_event_loop().run_until_complete(drive())
+    pptwbot.JOURNAL.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,502 @@
+# In-process stand-ins for the discord and tastyworks packages, so pptwbot can be started and driven end to end
+# without network access or credentials.  install() puts them in sys.modules before pptwbot imports them.
+# Every broker call goes through FakeBroker.call(), which adds the configured latency (plus jitter) and fails a
+# configurable fraction of calls.  Blocking calls (session login/validate) sleep on the calling thread, like requests does.
+# The models answer from the module's BROKER.  backtest.py swaps in its SimulatedBroker, a FakeBroker with no latency or
+# errors whose orders fill against recorded marks.
+import sys
+import time
+import enum
+import types
+import random
+import asyncio
+from decimal import Decimal
+from collections import Counter
+from dataclasses import dataclass
+
+
+class FakeBroker(object):
+    def __init__(self, latency: float = 0.02, jitter: float = 0.0, error_rate: float = 0.0, login_latency: float = 0.3, seed: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.login_latency = login_latency
+        # Extra latency per account number, for accounts that answer slower than the rest.
+        self.account_latency = {}
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.positions = []
+        self.orders = {}
+        # The last orders to leave the book, for get_order().
+        self.done_orders = {}
+        self.done_orders_kept = 10000
+        self.alerts = []
+        self.next_order_id = 1
+        self.fill_entries = True
+        # A filled entry's position is only listed this many seconds after the fill, like a lagging positions endpoint.
+        self.position_lag = 0.0
+        # When set, a cancel first leaves the order in 'Cancel Requested' for this many seconds, like the real broker.
+        self.cancel_delay = 0.0
+        # When set, a stop or limit closing order is refused while another one for the ticker is still on the book.
+        self.refuse_duplicate_closes = False
+        # Each positions listing moves every mark by up to this fraction, and each alert listing triggers this
+        # fraction of the alerts, so the exit watchers have something to act on.
+        self.mark_volatility = 0.0
+        self.alert_trigger_rate = 0.0
+        # The fake quote streamer sends a quote for every subscribed symbol this often.
+        self.quote_interval = 1.0
+        # Base URL the fake sessions report, e.g. a mock_broker_server serving this broker, for the broker gateway.
+        self.api_url = None
+
+    def get_delay(self, latency: float) -> float:
+        return max(0.0, latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def check_error(self, name: str):
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors[name] += 1
+            raise Exception('Injected broker error in {}'.format(name))
+
+    async def call(self, name: str, account = None):
+        self.calls[name] += 1
+        delay = self.get_delay(self.latency + self.account_latency.get(getattr(account, 'account_number', None), 0.0))
+        # With no latency the call answers without yielding, like backtest.py's replays expect.
+        if delay:
+            await asyncio.sleep(delay)
+        self.check_error(name)
+
+    def call_blocking(self, name: str, latency: float = None):
+        self.calls[name] += 1
+        time.sleep(self.get_delay(self.latency if latency is None else latency))
+
+    def add_position(self, ticker: str, option_type, quantity: int = 1, price: Decimal = Decimal('1.50'), account_number: str = None):
+        # A position or order without an account number is seen by every account.
+        option = Option(ticker=ticker, quantity=quantity, expiry=None, strike=Decimal('100'), option_type=option_type, underlying_type=UnderlyingType.EQUITY)
+        position = Position(ticker, quantity, price, price, option)
+        position.account_number = account_number
+        self.positions.append(position)
+        return position
+
+    def owns(self, account_number: str, item) -> bool:
+        return account_number is None or item.account_number in (None, account_number)
+
+    def execute(self, order, account_number: str = None):
+        if self.refuse_duplicate_closes and order.details.price_effect == OrderPriceEffect.CREDIT and order.details.type != OrderType.MARKET:
+            for live in self.orders.values():
+                if live.details.ticker == order.details.ticker and live.details.price_effect == OrderPriceEffect.CREDIT and self.owns(account_number, live):
+                    raise Exception('Order would exceed the position: {} already has closing order {}'.format(order.details.ticker, live.details.order_id))
+        order_id = self.next_order_id
+        self.next_order_id += 1
+        order.details.order_id = order_id
+        order.account_number = account_number
+        leg = order.legs[0] if order.legs else None
+        if order.details.price_effect == OrderPriceEffect.DEBIT and leg is not None and self.fill_entries:
+            order.details.status = OrderStatus.FILLED
+            self.retire(order)
+            if self.position_lag:
+                asyncio.get_event_loop().call_later(self.position_lag, self.add_position, leg.ticker, leg.option_type, leg.quantity, order.details.price or Decimal('1.00'), account_number)
+            else:
+                self.add_position(leg.ticker, leg.option_type, leg.quantity, order.details.price or Decimal('1.00'), account_number)
+        elif order.details.price_effect == OrderPriceEffect.CREDIT and order.details.type == OrderType.MARKET:
+            order.details.status = OrderStatus.FILLED
+            self.retire(order)
+            self.positions = [position for position in self.positions if position.underlying_symbol != order.details.ticker or not self.owns(account_number, position)]
+            # Closing orders left for a position that no longer exists are rejected.
+            for live_id, live in list(self.orders.items()):
+                if live.details.ticker == order.details.ticker and live.details.price_effect == OrderPriceEffect.CREDIT and self.owns(account_number, live):
+                    live.details.status = OrderStatus.REJECTED
+                    self.retire(self.orders.pop(live_id))
+        else:
+            order.details.status = OrderStatus.LIVE
+            self.orders[order_id] = order
+        return {'order': {'id': order_id, 'status': order.details.status.value}}
+
+    def retire(self, order):
+        self.done_orders[order.details.order_id] = order
+        if len(self.done_orders) > self.done_orders_kept:
+            del self.done_orders[next(iter(self.done_orders))]
+
+    def move_marks(self):
+        if not self.mark_volatility:
+            return
+        for position in self.positions:
+            change = Decimal(str(round(self.random.uniform(-self.mark_volatility, self.mark_volatility), 4)))
+            position.mark_price = max(Decimal('0.01'), (position.mark_price * (1 + change)).quantize(Decimal('0.01')))
+
+    def trigger_alerts(self):
+        if not self.alert_trigger_rate:
+            return
+        for alert in self.alerts:
+            if self.random.random() < self.alert_trigger_rate:
+                alert.triggered = True
+
+    def cancel(self, order_id):
+        order = self.orders.get(order_id)
+        if order is None or order.details.status != OrderStatus.LIVE:
+            raise Exception('Order {} not found'.format(order_id))
+        if self.cancel_delay:
+            order.details.status = OrderStatus.CANCEL_REQUESTED
+            asyncio.get_event_loop().call_later(self.cancel_delay, self.finish_cancel, order_id)
+            return OrderStatus.CANCEL_REQUESTED
+        self.finish_cancel(order_id)
+        return OrderStatus.CANCELLED
+
+    def finish_cancel(self, order_id):
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            order.details.status = OrderStatus.CANCELLED
+            self.retire(order)
+
+    def replace(self, order_id, order, account_number: str = None):
+        old = self.orders.get(order_id)
+        if old is None or old.details.status != OrderStatus.LIVE:
+            raise Exception('Order {} not found'.format(order_id))
+        self.finish_cancel(order_id)
+        return self.execute(order, account_number)
+
+BROKER = FakeBroker()
+
+
+# tastyworks
+
+class OptionType(enum.Enum):
+    CALL = 'C'
+    PUT = 'P'
+
+class UnderlyingType(enum.Enum):
+    EQUITY = 'Equity'
+
+class OrderType(enum.Enum):
+    LIMIT = 'Limit'
+    MARKET = 'Market'
+    STOP = 'Stop'
+    STOP_LIMIT = 'Stop Limit'
+
+class OrderPriceEffect(enum.Enum):
+    CREDIT = 'Credit'
+    DEBIT = 'Debit'
+
+class OrderStatus(enum.Enum):
+    RECEIVED = 'Received'
+    LIVE = 'Live'
+    FILLED = 'Filled'
+    CANCEL_REQUESTED = 'Cancel Requested'
+    CANCELLED = 'Cancelled'
+    REJECTED = 'Rejected'
+
+    def is_active(self) -> bool:
+        return self in (OrderStatus.RECEIVED, OrderStatus.LIVE, OrderStatus.CANCEL_REQUESTED)
+
+
+class Option(object):
+    def __init__(self, ticker, quantity, expiry, strike, option_type, underlying_type):
+        self.ticker = ticker
+        self.quantity = quantity
+        self.expiry = expiry
+        self.strike = strike
+        self.option_type = option_type
+        self.underlying_type = underlying_type
+
+    def get_dxfeed_symbol(self) -> str:
+        return '.{}{}{}'.format(self.ticker, self.option_type.value, self.strike)
+
+
+class OrderDetails(object):
+    def __init__(self, type = None, price = None, price_effect = None, stop_trigger = None, ticker = None):
+        self.type = type
+        self.price = price
+        self.price_effect = price_effect
+        self.stop_trigger = stop_trigger
+        self.ticker = ticker
+        self.order_id = None
+        self.status = OrderStatus.RECEIVED
+
+
+class Order(object):
+    def __init__(self, details: OrderDetails):
+        self.details = details
+        self.legs = []
+        self.account_number = None
+
+    def add_leg(self, leg):
+        self.legs.append(leg)
+        if self.details.ticker is None:
+            self.details.ticker = leg.ticker
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        details = OrderDetails(type=OrderType(data['order-type']), price=Decimal(data['price']) if data.get('price') else None, price_effect=OrderPriceEffect(data['price-effect']),
+            stop_trigger=Decimal(data['stop-trigger']) if data.get('stop-trigger') else None, ticker=data['underlying-symbol'])
+        details.order_id = data['id']
+        details.status = OrderStatus(data['status'])
+        return cls(details)
+
+    def to_dict(self) -> dict:
+        # The REST API's order fields that from_dict reads.
+        details = self.details
+        data = {'id': details.order_id, 'status': details.status.value, 'underlying-symbol': details.ticker, 'order-type': details.type.value, 'price-effect': details.price_effect.value}
+        if details.price is not None:
+            data['price'] = str(details.price)
+        if details.stop_trigger is not None:
+            data['stop-trigger'] = str(details.stop_trigger)
+        return data
+
+    @classmethod
+    async def get_live_orders(cls, session, account) -> list:
+        await BROKER.call('get_live_orders', account)
+        return [order for order in BROKER.orders.values() if BROKER.owns(account.account_number, order)]
+
+    @classmethod
+    async def get_order(cls, session, account, order_id):
+        await BROKER.call('get_order', account)
+        order = BROKER.orders.get(order_id) or BROKER.done_orders.get(order_id)
+        if order is None:
+            order = Order(OrderDetails())
+            order.details.order_id = order_id
+            order.details.status = OrderStatus.CANCELLED
+        return order
+
+    @classmethod
+    async def cancel_order(cls, session, account, order_id):
+        await BROKER.call('cancel_order', account)
+        return BROKER.cancel(order_id)
+
+
+class Alert(object):
+    def __init__(self, symbol, threshold, field = 'Last', operator = '<', triggered = False):
+        self.symbol = symbol
+        self.threshold = threshold
+        self.field = field
+        self.operator = operator
+        self.triggered = triggered
+
+
+class Position(object):
+    def __init__(self, underlying_symbol, quantity, average_open_price, mark_price, option):
+        self.underlying_symbol = underlying_symbol
+        self.quantity = quantity
+        self.average_open_price = average_open_price
+        self.mark_price = mark_price
+        self.multiplier = 100
+        self.option = option
+        self.account_number = None
+
+    def get_option_obj(self) -> Option:
+        return self.option
+
+    def get_closing_order_object(self, price = None, stop_trigger = None, order_type = OrderType.LIMIT):
+        order = Order(OrderDetails(type=order_type, price=price, price_effect=OrderPriceEffect.CREDIT, stop_trigger=stop_trigger, ticker=self.underlying_symbol))
+        order.add_leg(Option(self.option.ticker, self.quantity, self.option.expiry, self.option.strike, self.option.option_type, self.option.underlying_type))
+        return order
+
+    def get_last_stock_price_alert_oobject(self, price):
+        return Alert(self.underlying_symbol, price, operator='<' if self.option.option_type == OptionType.CALL else '>')
+
+
+class TastyAPISession(object):
+    def __init__(self, username: str, password: str, API_url = None):
+        self.API_url = API_url or BROKER.api_url or 'https://api.example.invalid'
+        self.username = username
+        self.password = password
+        BROKER.call_blocking('login', BROKER.login_latency)
+        self.logged_in = True
+        self.logged_in_at = None
+        self.session_token = 'token-{}'.format(BROKER.calls['login'])
+
+    def is_active(self):
+        BROKER.call_blocking('validate')
+        return True
+
+    def get_request_headers(self):
+        return {'Authorization': self.session_token}
+
+
+@dataclass
+class TradingAccount(object):
+    account_number: str
+    is_margin: bool = False
+
+    async def execute_order(self, order, session, dry_run = True):
+        await BROKER.call('execute_order', self)
+        return BROKER.execute(order, self.account_number)
+
+    async def replace_order_call(self, order_id, order, session):
+        # Attached as replace_order by benchmarks that model a broker API with order replacement.
+        await BROKER.call('replace_order', self)
+        return BROKER.replace(order_id, order, self.account_number)
+
+    @classmethod
+    async def get_remote_accounts(cls, session) -> list:
+        await BROKER.call('get_remote_accounts')
+        from account_context import get_account_specs
+        return [TradingAccount(spec['account_number']) for spec in get_account_specs() if spec['tasty_user'] == session.username]
+
+    @classmethod
+    async def get_positions(cls, session, account) -> list:
+        await BROKER.call('get_positions', account)
+        BROKER.move_marks()
+        return [position for position in BROKER.positions if BROKER.owns(account.account_number, position)]
+
+    @classmethod
+    async def get_quote_alert(cls, session) -> list:
+        await BROKER.call('get_quote_alert')
+        BROKER.trigger_alerts()
+        return list(BROKER.alerts)
+
+    @classmethod
+    async def set_quote_alert(cls, session, alert):
+        await BROKER.call('set_quote_alert')
+        BROKER.alerts.append(alert)
+        return alert
+
+    @classmethod
+    async def delete_quote_alert(cls, session, alert):
+        await BROKER.call('delete_quote_alert')
+        if alert in BROKER.alerts:
+            BROKER.alerts.remove(alert)
+
+
+class QuoteItem(object):
+    def __init__(self, data: list):
+        self.data = data
+
+
+def get_execute_order_json(order) -> dict:
+    # Like the library's private builder, which the gateway uses to replace orders.  It too always formats the price.
+    return {
+        'order-type': order.details.type.value,
+        'price': '{:.2f}'.format(order.details.price),
+        'price-effect': order.details.price_effect.value,
+        'time-in-force': 'Day',
+        'legs': [{'symbol': leg.get_dxfeed_symbol(), 'quantity': leg.quantity, 'action': 'Sell to Close'} for leg in order.legs],
+    }
+
+
+class DataStreamer(object):
+    # Every BROKER.quote_interval, sends a Quote for each subscribed option from the position's mark, moved like a
+    # positions listing moves it, and for each subscribed underlying with an alert a price just short of the alert, or
+    # at it for BROKER.alert_trigger_rate of them.
+    def __init__(self, session):
+        session.is_active()
+        self.tasty_session = session
+        self.logged_in = False
+        self.subscribed = set()
+
+    async def _setup_connection(self):
+        await BROKER.call('streamer_connect')
+        self.logged_in = True
+
+    async def add_data_sub(self, values):
+        BROKER.calls['add_data_sub'] += 1
+        self.subscribed.update(values.get('Quote', ()))
+
+    async def remove_data_sub(self, values):
+        BROKER.calls['remove_data_sub'] += 1
+        self.subscribed.difference_update(values.get('Quote', ()))
+
+    async def listen(self):
+        while True:
+            await asyncio.sleep(BROKER.quote_interval)
+            BROKER.move_marks()
+            quotes = []
+            for position in BROKER.positions:
+                symbol = position.get_option_obj().get_dxfeed_symbol()
+                if symbol in self.subscribed:
+                    quotes.append(get_quote(symbol, position.mark_price))
+            for alert in BROKER.alerts:
+                if alert.symbol.upper() in self.subscribed:
+                    price = Decimal(str(alert.threshold))
+                    if BROKER.random.random() >= BROKER.alert_trigger_rate:
+                        price = price * (Decimal('1.02') if alert.operator == '<' else Decimal('0.98'))
+                    quotes.append(get_quote(alert.symbol.upper(), price))
+            if quotes:
+                yield QuoteItem(quotes)
+
+def get_quote(symbol: str, mark: Decimal) -> dict:
+    return {'eventSymbol': symbol, 'bidPrice': float(mark) - 0.01, 'askPrice': float(mark) + 0.01}
+
+
+def create_new_session(username, password):
+    return TastyAPISession(username, password)
+
+
+# discord
+
+class FakeDiscord(object):
+    # Shared by every fake Client.  post() delivers a message to connected clients, or holds it until one connects.
+    def __init__(self, login_latency: float = 0.5, connect_latency: float = 0.5):
+        self.login_latency = login_latency
+        self.connect_latency = connect_latency
+        self.clients = []
+        self.pending = []
+
+    def post(self, channel: str, content: str, author: str = 'AlgoAlly'):
+        message = types.SimpleNamespace(channel=types.SimpleNamespace(name=channel), content=content, author=types.SimpleNamespace(name=author))
+        connected = [client for client in self.clients if client.connected]
+        if not connected:
+            self.pending.append(message)
+        for client in connected:
+            client.dispatch('on_message', message)
+
+DISCORD = FakeDiscord()
+
+
+class Client(object):
+    def __init__(self):
+        self.user = types.SimpleNamespace(name='bench', id='1')
+        self.servers = []
+        self.connected = False
+        self.closed = asyncio.Event()
+        DISCORD.clients.append(self)
+
+    def event(self, coro):
+        setattr(self, coro.__name__, coro)
+        return coro
+
+    def dispatch(self, name: str, *args):
+        handler = getattr(self, name, None)
+        if handler is not None:
+            asyncio.ensure_future(handler(*args))
+
+    async def start(self, token, bot = True):
+        await asyncio.sleep(DISCORD.login_latency)
+        await asyncio.sleep(DISCORD.connect_latency)
+        self.connected = True
+        self.dispatch('on_ready')
+        pending, DISCORD.pending = DISCORD.pending, []
+        for message in pending:
+            self.dispatch('on_message', message)
+        await self.closed.wait()
+
+    async def add_reaction(self, message, emoji):
+        pass
+
+    async def logout(self):
+        self.connected = False
+        self.closed.set()
+
+    async def close(self):
+        self.closed.set()
+
+
+def make_module(name: str, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+def install():
+    make_module('discord', Client=Client)
+    make_module('tastyworks')
+    make_module('tastyworks.models')
+    make_module('tastyworks.models.option', Option=Option, OptionType=OptionType)
+    make_module('tastyworks.models.order', Order=Order, OrderDetails=OrderDetails, OrderPriceEffect=OrderPriceEffect, OrderType=OrderType, OrderStatus=OrderStatus)
+    make_module('tastyworks.models.session', TastyAPISession=TastyAPISession)
+    make_module('tastyworks.models.trading_account', TradingAccount=TradingAccount, _get_execute_order_json=get_execute_order_json)
+    make_module('tastyworks.models.alert', Alert=Alert)
+    make_module('tastyworks.models.position', Position=Position)
+    make_module('tastyworks.models.underlying', UnderlyingType=UnderlyingType)
+    make_module('tastyworks.streamer', DataStreamer=DataStreamer)
+    make_module('tastyworks.tastyworks_api')
+    make_module('tastyworks.tastyworks_api.tasty_session', create_new_session=create_new_session)
+    sys.modules['tastyworks.tastyworks_api'].tasty_session = sys.modules['tastyworks.tastyworks_api.tasty_session']
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import aiohttp
+from settings import Settings
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BrokerError(Exception):
+    def __init__(self, method: str, url: str, status: int, text: str):
+        super().__init__('{} {} failed with status {}: {}'.format(method, url, status, text))
+        self.status = status
+
+
+class BrokerGateway(object):
+    # One warm, pooled keep-alive HTTP session for all broker REST calls.
+    # Identical GETs that are already in flight are shared instead of being sent again, and coalesce() does the
+    # same for any other awaitable keyed by the caller.  headers is a callable so a refreshed session token is picked up.
+    # A read is never shared with one sent before the last write, since that one may not show the write.  Writes sent
+    # through the gateway count themselves.  Writes made any other way must call invalidate() once they complete.
+    def __init__(self, base_url: str, headers, pool_size: int = None, keepalive: float = None, timeout: float = 30.0):
+        self.base_url = base_url.rstrip('/')
+        self.headers = headers
+        self.pool_size = Settings.BrokerPoolSize if pool_size is None else pool_size
+        self.keepalive = Settings.BrokerKeepAliveSeconds if keepalive is None else keepalive
+        self.timeout = timeout
+        self.requests = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.generation = 0
+        self._session = None
+        self._inflight = {}
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # Created on first use so it binds to the running loop.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def warm_up(self, path: str = '/'):
+        # Opens a pooled connection ahead of the first real call so it doesn't pay for DNS and the TLS handshake.
+        try:
+            async with self.get_session().head(self.base_url + path, headers=self.headers()) as resp:
+                await resp.read()
+        except Exception as ex:
+            LOGGER.info('Broker connection warm-up failed: %s', ex)
+
+    async def request(self, method: str, path: str, json = None, params = None, expect = (200, 201)):
+        url = self.base_url + path
+        self.requests += 1
+        try:
+            async with self.get_session().request(method, url, json=json, params=params, headers=self.headers()) as resp:
+                if resp.status not in expect:
+                    self.errors += 1
+                    raise BrokerError(method, url, resp.status, await resp.text())
+                if resp.content_type == 'application/json':
+                    return await resp.json()
+                return await resp.text()
+        finally:
+            # Even a failed write may have reached the broker.
+            if method != 'GET':
+                self.invalidate()
+
+    def invalidate(self):
+        self.generation += 1
+
+    async def get(self, path: str, params = None):
+        key = ('GET', path, tuple(sorted(params.items())) if params else None)
+        return await self.coalesce(key, lambda: self.request('GET', path, params=params))
+
+    async def post(self, path: str, json = None):
+        return await self.request('POST', path, json=json)
+
+    async def put(self, path: str, json = None):
+        return await self.request('PUT', path, json=json)
+
+    async def delete(self, path: str):
+        return await self.request('DELETE', path)
+
+    async def coalesce(self, key, factory):
+        # Callers asking for the same key while a call is outstanding all get that call's result, unless there has been
+        # a write since it was sent.
+        key = (self.generation, key)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        future = asyncio.ensure_future(factory())
+        self._inflight[key] = future
+        future.add_done_callback(lambda done: self._inflight.pop(key, None) if self._inflight.get(key) is done else None)
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        return {'requests': self.requests, 'coalesced': self.coalesced, 'errors': self.errors, 'in_flight': len(self._inflight)}
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
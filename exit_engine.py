@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from time import monotonic
+from decimal import Decimal, InvalidOperation
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_stream_symbol(position) -> str:
+    return position.get_option_obj().get_dxfeed_symbol()
+
+def get_quote_mark(quote: dict) -> Decimal:
+    try:
+        bid = Decimal(str(quote['bidPrice']))
+        ask = Decimal(str(quote['askPrice']))
+    except (KeyError, InvalidOperation):
+        return None
+    if not bid.is_finite() or not ask.is_finite() or ask <= 0:
+        return None
+    return (bid + ask) / 2
+
+
+class ExitEngine(object):
+    # Keeps the held option and underlying symbols subscribed on the quote streamer and runs the exit rules on every tick.
+    # Positions are held per group (one per account), so the same contract held in two accounts is evaluated for each.
+    # on_position_tick(position, group) is awaited after position.mark_price has been updated from the tick.
+    # on_underlying_stop(ticker, price, group) is awaited once when an underlying crosses a stop registered with
+    # set_underlying_stop().  Each group has its own stop per underlying.
+    # A position marked with set_exiting() gets no more ticks until a listing fetched after the mark is synced, so one
+    # crossing sends one exit order rather than one per tick.
+    def __init__(self, streamer, on_position_tick, on_underlying_stop = None, symbol_for = get_stream_symbol):
+        self.streamer = streamer
+        self.on_position_tick = on_position_tick
+        self.on_underlying_stop = on_underlying_stop
+        self.symbol_for = symbol_for
+        self.positions = {}
+        self.underlying_stops = {}
+        self.subscribed = set()
+        self.last_prices = {}
+        self.tick_count = 0
+        self.listening = False
+        self.exiting = {}
+        self._running = {}
+        self._dirty = set()
+
+    async def sync_positions(self, positions: list, group = None, listed_at: float = None):
+        # Replaces the group's positions.  listed_at is the monotonic() time the listing was requested, if known.
+        positions_by_symbol = {}
+        for position in positions:
+            positions_by_symbol[self.symbol_for(position)] = position
+        self.positions[group] = positions_by_symbol
+        if listed_at is not None:
+            for key, exited_at in list(self.exiting.items()):
+                if key[0] == group and exited_at < listed_at:
+                    del self.exiting[key]
+        wanted = set()
+        for group_positions in self.positions.values():
+            wanted.update(group_positions)
+            wanted.update(position.underlying_symbol.upper() for position in group_positions.values())
+        wanted.update(self.underlying_stops)
+        added = wanted - self.subscribed
+        removed = self.subscribed - wanted
+        if added:
+            LOGGER.info('Subscribing to quotes for %s', sorted(added))
+            await self.streamer.add_data_sub({'Quote': sorted(added)})
+        if removed:
+            LOGGER.info('Unsubscribing from quotes for %s', sorted(removed))
+            await self.streamer.remove_data_sub({'Quote': sorted(removed)})
+            for symbol in removed:
+                self.last_prices.pop(symbol, None)
+        self.subscribed = wanted
+
+    async def set_underlying_stop(self, ticker: str, price: Decimal, below: bool, group = None):
+        # below=True exits when the underlying trades at or under price (calls), False at or over it (puts).
+        ticker = ticker.upper()
+        self.underlying_stops.setdefault(ticker, {})[group] = (price, below)
+        if ticker not in self.subscribed:
+            await self.streamer.add_data_sub({'Quote': [ticker]})
+            self.subscribed.add(ticker)
+
+    def set_exiting(self, position, group = None):
+        self.exiting[(group, self.symbol_for(position))] = monotonic()
+
+    def is_exiting(self, position, group = None) -> bool:
+        return (group, self.symbol_for(position)) in self.exiting
+
+    def clear_underlying_stop(self, ticker: str, group = None):
+        stops = self.underlying_stops.get(ticker.upper())
+        if stops is not None:
+            stops.pop(group, None)
+            if not stops:
+                del self.underlying_stops[ticker.upper()]
+
+    async def run(self):
+        self.listening = True
+        try:
+            async for item in self.streamer.listen():
+                for quote in getattr(item, 'data', ()):
+                    self.on_quote(quote)
+        finally:
+            self.listening = False
+
+    def on_quote(self, quote: dict):
+        symbol = quote.get('eventSymbol')
+        mark = get_quote_mark(quote)
+        if symbol is None or mark is None:
+            return
+        self.tick_count += 1
+        self.last_prices[symbol] = mark
+        for group, positions in self.positions.items():
+            position = positions.get(symbol)
+            if position is not None:
+                position.mark_price = mark
+                if (group, symbol) not in self.exiting:
+                    self._schedule((group, symbol), self.on_position_tick, position, group)
+        stops = self.underlying_stops.get(symbol)
+        if stops and self.on_underlying_stop is not None:
+            for group, (stop_price, below) in list(stops.items()):
+                if (below and mark <= stop_price) or (not below and mark >= stop_price):
+                    LOGGER.info('%s traded at $%s through the stop at $%s', symbol, mark, stop_price)
+                    del stops[group]
+                    self._schedule(('stop', group, symbol), self.on_underlying_stop, symbol, mark, group)
+            if not stops:
+                del self.underlying_stops[symbol]
+
+    def _schedule(self, key, callback, *args):
+        # Never run two evaluations of the same symbol at once.  Ticks that land mid-evaluation are coalesced into one re-run.
+        if key in self._running:
+            self._dirty.add(key)
+            return
+        self._running[key] = asyncio.ensure_future(self._evaluate(key, callback, *args))
+
+    async def _evaluate(self, key, callback, *args):
+        try:
+            while True:
+                self._dirty.discard(key)
+                try:
+                    await callback(*args)
+                except Exception as ex:
+                    LOGGER.info('Unhandled exception evaluating %s in the exit engine', key)
+                    LOGGER.fatal(ex, exc_info=True)
+                if key not in self._dirty or key in self.exiting:
+                    break
+        finally:
+            del self._running[key]
@@ -0,0 +1,56 @@
+import json
+import asyncio
+from time import perf_counter
+
+
+class ReplayItem(object):
+    __slots__ = ('data', 'emitted_at')
+
+    def __init__(self, data: list, emitted_at: float):
+        self.data = data
+        self.emitted_at = emitted_at
+
+
+class ReplayStreamer(object):
+    # Stand-in for tastyworks.streamer.DataStreamer that replays recorded Quote ticks.
+    # Each tick is a dict with 'time' (seconds from the start of the recording), 'eventSymbol', 'bidPrice' and 'askPrice'.
+    # Only ticks for subscribed symbols are emitted, like the real feed.  speed=0 replays as fast as possible.
+    def __init__(self, ticks: list, speed: float = 1.0):
+        self.ticks = sorted(ticks, key=lambda tick: tick['time'])
+        self.speed = speed
+        self.subscribed = set()
+        self.logged_in = True
+        self.sub_requests = 0
+        self.emitted = 0
+
+    @classmethod
+    def from_file(cls, path: str, speed: float = 1.0):
+        # One JSON tick per line.
+        with open(path) as f:
+            return cls([json.loads(line) for line in f if line.strip()], speed)
+
+    async def add_data_sub(self, values):
+        self.sub_requests += 1
+        self.subscribed.update(values.get('Quote', ()))
+
+    async def remove_data_sub(self, values):
+        self.sub_requests += 1
+        self.subscribed.difference_update(values.get('Quote', ()))
+
+    async def listen(self):
+        start = perf_counter()
+        for tick in self.ticks:
+            if self.speed > 0:
+                delay = tick['time'] / self.speed - (perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                # Still yield to the loop so scheduled exit evaluations get to run between ticks.
+                await asyncio.sleep(0)
+            if tick['eventSymbol'] not in self.subscribed:
+                continue
+            self.emitted += 1
+            yield ReplayItem([tick], perf_counter())
+
+    async def close(self):
+        pass
@@ -0,0 +1,111 @@
+import json
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime
+
+# Moves log formatting and disk I/O off the event loop thread.  Records are queued as-is (the message is
+# only formatted on the writer thread, so '%s'-style arguments are never formatted on the loop) and a
+# background thread writes them in batches with one flush per batch.
+
+_STOP = object()
+
+
+class AsyncLogHandler(logging.Handler):
+    def __init__(self, handlers: list, batch_size: int = 512, flush_interval: float = 0.25, max_queue: int = 100000):
+        super().__init__()
+        self.handlers = list(handlers)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def emit(self, record):
+        # Never block the caller.  If the writer falls this far behind, drop and count instead.
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            for record in batch:
+                if record is _STOP:
+                    stop = True
+                    continue
+                self._write(record)
+            for handler in self.handlers:
+                try:
+                    handler.flush()
+                except Exception:
+                    pass
+            self.batches += 1
+            if stop:
+                return
+
+    def _write(self, record):
+        for handler in self.handlers:
+            if record.levelno < handler.level or not handler.filter(record):
+                continue
+            try:
+                stream = getattr(handler, 'stream', None)
+                if stream is not None:
+                    # Write without StreamHandler.emit()'s per-record flush; the batch is flushed once above.
+                    stream.write(handler.format(record) + handler.terminator)
+                else:
+                    handler.handle(record)
+            except Exception:
+                handler.handleError(record)
+        self.written += 1
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join(5)
+        for handler in self.handlers:
+            handler.close()
+        super().close()
+
+
+class JsonLinesFormatter(logging.Formatter):
+    # One compact JSON object per line: time, event name and whatever fields were passed in extra={'fields': {...}}.
+    def format(self, record):
+        event = {'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'), 'event': record.getMessage()}
+        event.update(getattr(record, 'fields', {}))
+        return json.dumps(event, default=str, separators=(',', ':'))
+
+
+def enable_async_logging(logger: logging.Logger, **kwargs) -> AsyncLogHandler:
+    # Moves the logger's current handlers behind one AsyncLogHandler.
+    handler = AsyncLogHandler(logger.handlers, **kwargs)
+    for existing in list(logger.handlers):
+        logger.removeHandler(existing)
+    logger.addHandler(handler)
+    return handler
+
+def create_trade_logger(name: str, filename: str, async_writer: bool = True) -> logging.Logger:
+    trade_logger = logging.getLogger(name)
+    trade_logger.setLevel(logging.INFO)
+    trade_logger.propagate = False
+    fh = logging.FileHandler(filename)
+    fh.setFormatter(JsonLinesFormatter())
+    trade_logger.addHandler(fh)
+    if async_writer:
+        enable_async_logging(trade_logger)
+    return trade_logger
@@ -0,0 +1,99 @@
+import asyncio
+import argparse
+from aiohttp import web
+
+# A stand-in for the broker REST API with a fixed per-request latency, for benchmarking the broker gateway.
+# Serves the endpoints pptwbot reads through the gateway and counts requests and TCP connections.
+# Run it on its own with: python mock_broker_server.py [--port N] [--latency-ms X]
+
+
+class MockBroker(object):
+    def __init__(self, latency_ms: float = 20.0, positions: int = 5, orders: int = 5, alerts: int = 5, finished_orders: int = 5):
+        self.latency = latency_ms / 1000.0
+        self.requests = 0
+        self.connections = set()
+        self.positions = [{'symbol': 'SPY   201218C00350000', 'underlying-symbol': 'SPY', 'quantity': 1, 'average-open-price': '1.5', 'mark-price': '1.6'} for _ in range(positions)]
+        self.orders = {str(order_id): {'id': order_id, 'status': 'Live', 'underlying-symbol': 'SPY'} for order_id in range(1, orders + 1)}
+        # Like the real endpoint, /orders/live also lists the day's filled and cancelled orders.
+        for order_id in range(orders + 1, orders + finished_orders + 1):
+            self.orders[str(order_id)] = {'id': order_id, 'status': 'Filled' if order_id % 2 else 'Cancelled', 'underlying-symbol': 'SPY'}
+        self.alerts = [{'symbol': 'SPY', 'field': 'Last', 'operator': '<', 'threshold': '340.0', 'triggered-at': None} for _ in range(alerts)]
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests += 1
+        self.connections.add(id(request.transport))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    async def ping(self, request):
+        return web.Response()
+
+    async def get_positions(self, request):
+        return web.json_response({'data': {'items': self.positions}})
+
+    async def get_live_orders(self, request):
+        return web.json_response({'data': {'items': list(self.orders.values())}})
+
+    async def get_order(self, request):
+        order = self.orders.get(request.match_info['order_id'])
+        if order is None:
+            return web.json_response({'error': {'message': 'Order not found'}}, status=404)
+        return web.json_response({'data': order})
+
+    async def cancel_order(self, request):
+        order = self.orders.get(request.match_info['order_id'])
+        if order is None or order['status'] != 'Live':
+            return web.json_response({'error': {'message': 'Order not found'}}, status=404)
+        order['status'] = 'Cancel Requested'
+        return web.json_response({'data': order})
+
+    async def replace_order(self, request):
+        # Like the real endpoint, the reply holds the new order itself under 'data'.
+        order = self.orders.get(request.match_info['order_id'])
+        if order is None or order['status'] != 'Live':
+            return web.json_response({'error': {'message': 'Order not found'}}, status=404)
+        body = await request.json()
+        order['status'] = 'Cancelled'
+        order_id = max(int(order_id) for order_id in self.orders) + 1
+        self.orders[str(order_id)] = dict(body, id=order_id, status='Live', **{'underlying-symbol': order['underlying-symbol']})
+        return web.json_response({'data': self.orders[str(order_id)]})
+
+    async def get_alerts(self, request):
+        return web.json_response({'data': {'items': self.alerts}})
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_route('HEAD', '/', self.ping)
+        app.router.add_get('/accounts/{account}/positions', self.get_positions)
+        app.router.add_get('/accounts/{account}/orders/live', self.get_live_orders)
+        app.router.add_get('/accounts/{account}/orders/{order_id}', self.get_order)
+        app.router.add_delete('/accounts/{account}/orders/{order_id}', self.cancel_order)
+        app.router.add_put('/accounts/{account}/orders/{order_id}', self.replace_order)
+        app.router.add_get('/quote-alerts', self.get_alerts)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        # Returns the base URL.  Port 0 picks a free one.
+        self.runner = web.AppRunner(self.create_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return 'http://{}:{}'.format(host, port)
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    args = parser.parse_args()
+    web.run_app(MockBroker(args.latency_ms).create_app(), host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+from decimal import Decimal
+from settings import Settings
+from strategy import PROFIT_EXIT, LOSS_EXIT, get_exit_action, get_profit_percent, get_profit_stop_trigger
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Batched version of get_profit_percent / get_exit_action / get_profit_stop_trigger for many positions at once.
+# Prices are held as integers in 1/10000ths of a dollar and thresholds as integer hundredths of a percent,
+# so every comparison is exact integer arithmetic.  A row whose prices don't convert exactly (e.g. an averaged
+# open price with more than 4 decimals) is flagged and evaluated with the Decimal functions instead.
+# Uses numpy when it's installed and falls back to plain Python integer columns when it isn't.
+
+PRICE_SCALE = 10000
+PERCENT_SCALE = 100
+NO_EXIT = 0
+PROFIT = 1
+LOSS = 2
+ACTIONS = {NO_EXIT: None, PROFIT: PROFIT_EXIT, LOSS: LOSS_EXIT}
+# Same fee model as get_profit_percent: $1 per contract, capped at $10.
+FEE_PER_CONTRACT = 1 * PRICE_SCALE
+FEE_CAP = 10 * PRICE_SCALE
+# Beyond this, products of the scaled columns could overflow int64.
+INT64_SAFE = 2 ** 62
+
+
+def to_units(value: Decimal, scale: int):
+    # Returns the exact integer value * scale, or None if it isn't a whole number of units.
+    if not isinstance(value, Decimal):
+        value = Decimal(value)
+    if not value.is_finite():
+        return None
+    numerator, denominator = value.as_integer_ratio()
+    units, remainder = divmod(numerator * scale, denominator)
+    return units if remainder == 0 else None
+
+
+class PortfolioBatch(object):
+    def __init__(self, positions: list):
+        self.positions = list(positions)
+        count = len(self.positions)
+        self.open_price = [0] * count
+        self.mark = [0] * count
+        self.multiplier = [0] * count
+        self.quantity = [0] * count
+        self.exact = [True] * count
+        self._arrays = None
+        for i, position in enumerate(self.positions):
+            self.multiplier[i] = int(position.multiplier)
+            self.quantity[i] = int(position.quantity)
+            open_price = to_units(position.average_open_price, PRICE_SCALE)
+            if open_price is None:
+                self.exact[i] = False
+            else:
+                self.open_price[i] = open_price
+            if self.open_price[i] * self.multiplier[i] + min(self.quantity[i] * FEE_PER_CONTRACT, FEE_CAP) <= 0:
+                # Cross-multiplying the thresholds assumes a positive entry cost.
+                self.exact[i] = False
+            self.set_mark(i, position.mark_price)
+
+    def set_mark(self, i: int, mark_price: Decimal):
+        mark = to_units(mark_price, PRICE_SCALE)
+        if mark is None:
+            self.exact[i] = False
+        else:
+            self.mark[i] = mark
+            if self._arrays is not None:
+                self._arrays[1][i] = mark
+
+    def evaluate(self, settings = Settings) -> list:
+        # Returns one (exit action, profit percent, stop trigger) tuple per position, matching the Decimal functions.
+        # profit percent is a float for display only.  The stop trigger is a Decimal for PROFIT_EXIT rows and None otherwise.
+        columns = self._evaluate_columns(settings)
+        if columns is None:
+            return [self._evaluate_decimal(i, settings) for i in range(len(self.positions))]
+        codes, profit_percent, stops = columns
+        results = []
+        for i in range(len(self.positions)):
+            if not self.exact[i]:
+                results.append(self._evaluate_decimal(i, settings))
+                continue
+            action = ACTIONS[int(codes[i])]
+            stop = Decimal(int(stops[i])) / PRICE_SCALE if action == PROFIT_EXIT else None
+            results.append((action, float(profit_percent[i]), stop))
+        return results
+
+    def get_exit_rows(self, settings = Settings) -> list:
+        # Indices of the positions that have an exit action, without building a result per position.
+        columns = self._evaluate_columns(settings)
+        if columns is None:
+            return [i for i in range(len(self.positions)) if self._evaluate_decimal(i, settings)[0] is not None]
+        codes = columns[0]
+        if numpy is not None and isinstance(codes, numpy.ndarray):
+            rows = numpy.flatnonzero(codes).tolist()
+        else:
+            rows = [i for i, code in enumerate(codes) if code != NO_EXIT]
+        if all(self.exact):
+            return rows
+        rows = [i for i in rows if self.exact[i]]
+        rows.extend(i for i, exact in enumerate(self.exact) if not exact and self._evaluate_decimal(i, settings)[0] is not None)
+        return sorted(rows)
+
+    def _evaluate_columns(self, settings):
+        profit_at = to_units(settings.AutoCloseAtProfitPercent, PERCENT_SCALE)
+        loss_at = to_units(settings.AutoCloseAtLossPercent, PERCENT_SCALE)
+        delta = to_units(settings.ProfitPercentExitTriggerPriceDelta, PRICE_SCALE)
+        if profit_at is None or loss_at is None or delta is None:
+            # The thresholds don't fit the integer grid, so the whole batch takes the exact Decimal path.
+            return None
+        if numpy is not None and self._fits_int64(profit_at, loss_at):
+            return self._evaluate_numpy(profit_at, loss_at, delta)
+        return self._evaluate_python(profit_at, loss_at, delta)
+
+    def _evaluate_decimal(self, i: int, settings):
+        position = self.positions[i]
+        profit_percent = get_profit_percent(position)
+        action = get_exit_action(profit_percent, settings)
+        stop = get_profit_stop_trigger(position.mark_price, position.average_open_price, settings) if action == PROFIT_EXIT else None
+        return action, float(profit_percent), stop
+
+    def _fits_int64(self, profit_at: int, loss_at: int) -> bool:
+        if not self.positions:
+            return True
+        price = max(max(map(abs, self.open_price)), max(map(abs, self.mark)), 1)
+        multiplier = max(max(map(abs, self.multiplier)), 1)
+        largest_pl = 2 * price * multiplier * 100 * PERCENT_SCALE
+        largest_threshold = max(profit_at, loss_at, 1) * (price * multiplier + FEE_CAP)
+        return max(largest_pl, largest_threshold) < INT64_SAFE
+
+    def _evaluate_numpy(self, profit_at: int, loss_at: int, delta: int):
+        if self._arrays is None:
+            # Built once and kept in step by set_mark(), so re-evaluating on new marks doesn't copy the lists again.
+            self._arrays = tuple(numpy.array(column, dtype=numpy.int64) for column in (self.open_price, self.mark, self.multiplier, self.quantity))
+        open_price, mark, multiplier, quantity = self._arrays
+        entry = open_price * multiplier + numpy.minimum(quantity * FEE_PER_CONTRACT, FEE_CAP)
+        pl = (mark - open_price) * multiplier
+        # profit % >= threshold  <=>  pl * 100 * PERCENT_SCALE >= threshold * entry, since entry is always positive.
+        scaled_pl = pl * (100 * PERCENT_SCALE)
+        codes = numpy.zeros(len(self.positions), dtype=numpy.int8)
+        if loss_at > 0:
+            codes[-scaled_pl >= loss_at * entry] = LOSS
+        if profit_at > 0:
+            codes[scaled_pl >= profit_at * entry] = PROFIT
+        stops = mark - delta
+        stops = numpy.where(stops <= open_price, open_price + PRICE_SCALE // 100, stops)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            profit_percent = pl * 100.0 / entry
+        return codes, profit_percent, stops
+
+    def _evaluate_python(self, profit_at: int, loss_at: int, delta: int):
+        codes = []
+        profit_percent = []
+        stops = []
+        for open_price, mark, multiplier, quantity in zip(self.open_price, self.mark, self.multiplier, self.quantity):
+            entry = open_price * multiplier + min(quantity * FEE_PER_CONTRACT, FEE_CAP)
+            pl = (mark - open_price) * multiplier
+            scaled_pl = pl * (100 * PERCENT_SCALE)
+            if profit_at > 0 and scaled_pl >= profit_at * entry:
+                codes.append(PROFIT)
+            elif loss_at > 0 and -scaled_pl >= loss_at * entry:
+                codes.append(LOSS)
+            else:
+                codes.append(NO_EXIT)
+            profit_percent.append(pl * 100.0 / entry if entry else 0.0)
+            stop = mark - delta
+            stops.append(open_price + PRICE_SCALE // 100 if stop <= open_price else stop)
+        return codes, profit_percent, stops
@@ -1,412 +1,1014 @@
-import re
+from __future__ import annotations
 import time
-import discord
 import asyncio
-import calendar
 import logging
 import logging.config
-from os import environ
-from datetime import date, timedelta, datetime
+from datetime import datetime
 from decimal import Decimal
-from tastyworks.models import option_chain, underlying
-from tastyworks.models.option import Option, OptionType
-from tastyworks.models.order import Order, OrderDetails, OrderPriceEffect, OrderType, OrderStatus
-from tastyworks.models.session import TastyAPISession
-from tastyworks.models.trading_account import TradingAccount
-from tastyworks.models.alert import Alert, AlertField, Operator
-from tastyworks.models.position import Position
-from tastyworks.models.underlying import UnderlyingType
-from tastyworks.streamer import DataStreamer
-from tastyworks.tastyworks_api import tasty_session
+from functools import partial
+from contextlib import contextmanager
 from settings import Settings
+from account_state import AccountState
+from account_context import AccountContext, get_account_specs
+from alert_manager import AlertManager, get_enum_value
+from exit_engine import ExitEngine
+from signal_dispatcher import SignalDispatcher
+from portfolio_eval import PortfolioBatch
+from state_cache import StateCache
+from trade_journal import TradeJournal
+from trailing_stops import TrailingStops
+from tracing import TRACER
+from log_pipeline import create_trade_logger, enable_async_logging
+from strategy import PROFIT_EXIT, LOSS_EXIT, get_entry_order, get_exit_action, get_profit_percent, get_profit_stop_trigger, get_stock_stop_price, has_entry_price_drifted
+from signal_parser import Signal, SignalType, parse_signal
+
+# discord, tastyworks and aiohttp are imported by main() rather than here, so importing this module stays cheap and the
+# broker modules load on a worker thread while Discord logs in.  See create_discord_client() and import_tastyworks().
 
-# Create logger.
 LOGGER = logging.getLogger(__name__)
-LOGGER.setLevel(logging.DEBUG)
-# Create filehandler with desired filename.
-fh = logging.FileHandler('PPTWBot_{}.log'.format(datetime.now().strftime('%Y_%m_%d')))
-fh.setLevel(logging.DEBUG)
-log_formatter = logging.Formatter('%(asctime)s | %(levelname)-8s | %(lineno)04d | %(message)s')
-fh.setFormatter(log_formatter)
-# Add filehandler to logger.
-LOGGER.addHandler(fh)
-# LOGGER.addHandler(logging.StreamHandler())
-
-client = discord.Client()
-
-@client.event
+TRADE_LOGGER = None
+
+def setup_logging():
+    global TRADE_LOGGER
+    LOGGER.setLevel(logging.DEBUG)
+    # Create filehandler with desired filename.
+    fh = logging.FileHandler('PPTWBot_{}.log'.format(datetime.now().strftime('%Y_%m_%d')))
+    fh.setLevel(logging.DEBUG)
+    log_formatter = logging.Formatter('%(asctime)s | %(levelname)-8s | %(lineno)04d | %(message)s')
+    fh.setFormatter(log_formatter)
+    # Add filehandler to logger.
+    LOGGER.addHandler(fh)
+    # LOGGER.addHandler(logging.StreamHandler())
+    if Settings.AsyncLogging:
+        # Queue records and let a background thread format and write them, so logging never blocks the event loop.
+        enable_async_logging(LOGGER)
+    # The helper modules log under their own names.  Send them to the same file.
+    for module_name in ('exit_engine', 'signal_dispatcher', 'tracing', 'broker_gateway', 'alert_manager', 'state_cache', 'trade_journal', 'trailing_stops'):
+        module_logger = logging.getLogger(module_name)
+        module_logger.setLevel(logging.DEBUG)
+        for handler in LOGGER.handlers:
+            module_logger.addHandler(handler)
+    # Compact JSON-lines record of every signal, order, cancel and alert.
+    if Settings.TradeEventLog:
+        TRADE_LOGGER = create_trade_logger('pptwbot.trades', 'PPTWBot_trades_{}.jsonl'.format(datetime.now().strftime('%Y_%m_%d')), Settings.AsyncLogging)
+
+def log_trade_event(event: str, **fields):
+    if TRADE_LOGGER is not None:
+        TRADE_LOGGER.info(event, extra={'fields': fields})
+
+# Set up by main().
+client = None
+streamer = None
+ACCOUNTS = []
+GATEWAYS = []
+ALERT_MANAGERS = []
+PENDING_SIGNALS = []
+DISPATCHER = None
+EXIT_ENGINE = None
+BROKER_READY = None
+STATE_CACHE = None
+JOURNAL = None
+STARTED_AT = None
+FIRST_MESSAGE_SEEN = False
+# Recovery outcome of an entry whose order was still working at startup.
+ENTRY_WORKING = 'entry order still working'
+
+def create_discord_client():
+    import discord
+    discord_client = discord.Client()
+    discord_client.event(on_ready)
+    discord_client.event(on_message)
+    return discord_client
+
 async def on_ready():
+    TRACER.record('startup.discord_ready', time.perf_counter() - STARTED_AT)
     LOGGER.info('Logged in as')
     LOGGER.info(client.user.name)
     LOGGER.info(client.user.id)
     LOGGER.info('------')
     for server in client.servers:
         if server.name == 'Profit Planet Pro':
-            LOGGER.info ('{0} Server ID: {1}'.format(server.name, server.id))
+            LOGGER.info('%s Server ID: %s', server.name, server.id)
             for channel in server.channels:
                 if channel.name == Settings.alert_channel:
-                    LOGGER.info ('Signals Channel Name: {0} ID: {1}'.format(channel.name, channel.id))
+                    LOGGER.info('Signals Channel Name: %s ID: %s', channel.name, channel.id)
                 if channel.name == Settings.test_channel:
-                    LOGGER.info ('Test Channel Name: {0} ID: {1}'.format(channel.name, channel.id))
+                    LOGGER.info('Test Channel Name: %s ID: %s', channel.name, channel.id)
                 if channel.name == Settings.chat_channel:
-                    LOGGER.info ('Trading Floor Channel Name: {0} ID: {1}'.format(channel.name, channel.id))
+                    LOGGER.info('Trading Floor Channel Name: %s ID: %s', channel.name, channel.id)
 
-@client.event
 async def on_message(message):
+    global FIRST_MESSAGE_SEEN
+    if not FIRST_MESSAGE_SEEN:
+        FIRST_MESSAGE_SEEN = True
+        TRACER.record('startup.first_message', time.perf_counter() - STARTED_AT)
     if message.channel.name == Settings.alert_channel:
-        LOGGER.info ('Options signal received: {}'.format(message.content))
-        message_ucase = message.content.upper()
-        Entry = re.search(Settings.EntryRegex, message_ucase)
-        Update = re.search(Settings.UpdateRegex, message_ucase)
-        Deactivate = re.search(Settings.DeactivateRegex, message_ucase)
-        if Entry:
-            await ProcessEntrySignal(Entry)
-        elif Update:
-            await ProcessUpdateSignal(Update)
-        elif Deactivate:
-            await ProcessDeactivationSignal(Deactivate)
+        received_at = time.perf_counter()
+        LOGGER.info('Options signal received: %s', message.content)
+        with TRACER.span('parse'):
+            signal = parse_signal(message.content)
+        if signal:
+            signal.received_at = received_at
+            SubmitSignal(signal)
     elif message.channel.name == Settings.test_channel:
-        message_ucase = message.content.upper()
-        Entry = re.search(Settings.EntryRegex, message_ucase)
-        Update = re.search(Settings.UpdateRegex, message_ucase)
-        Deactivate = re.search(Settings.DeactivateRegex, message_ucase)
-        if Entry:
-            if Settings.execute_from_test_channel and message.author.name == client.user.name:
-                await ProcessEntrySignal(Entry)
-            await client.add_reaction(message, '\N{THUMBS UP SIGN}')
-        elif Update:
-            if Settings.execute_from_test_channel and message.author.name == client.user.name:
-                await ProcessUpdateSignal(Update)
-            await client.add_reaction(message, '\N{THUMBS UP SIGN}')
-        elif Deactivate:
+        received_at = time.perf_counter()
+        with TRACER.span('parse'):
+            signal = parse_signal(message.content)
+        if signal:
+            signal.received_at = received_at
             if Settings.execute_from_test_channel and message.author.name == client.user.name:
-                await ProcessDeactivationSignal(Deactivate)
+                SubmitSignal(signal)
             await client.add_reaction(message, '\N{THUMBS UP SIGN}')
     elif message.channel.name == Settings.chat_channel:
         print ('{0}:@{1} - {2}'.format(message.channel.name, message.author.name, message.content))
 
+def SubmitSignal(signal: Signal):
+    # Parsed once, then handled for every account in parallel.  Signals that arrive before the accounts are loaded are held until they are.
+    if not BROKER_READY.is_set():
+        PENDING_SIGNALS.append(signal)
+        return
+    log_trade_event('signal', type=signal.signal_type.value, ticker=signal.ticker, option_type=signal.option_type, exp=signal.exp_date, strike=signal.strike, mark=signal.mark)
+    for account in ACCOUNTS:
+        DISPATCHER.submit(signal, account)
+
+async def ProcessSignal(signal: Signal, account: AccountContext):
+    account.signals += 1
+    with account.span('signal'), JOURNAL.operation('signal', account.name, type=signal.signal_type.value, ticker=signal.ticker, option_type=signal.option_type, exp=signal.exp_date, strike=signal.strike, mark=signal.mark):
+        if signal.signal_type == SignalType.ENTRY:
+            await ProcessEntrySignal(signal, account)
+        elif signal.signal_type == SignalType.UPDATE:
+            await ProcessUpdateSignal(signal, account)
+        elif signal.signal_type == SignalType.DEACTIVATE:
+            await ProcessDeactivationSignal(signal, account)
+
 # Entry Processing
 
-async def ProcessEntrySignal(Entry):
-    Ticker = Entry.group('Ticker').upper()
-    ExpDate = get_expire_date_from_string(Entry.group('Exp'))
-    Strike = Decimal(Entry.group('Strike'))
-    Mark = Decimal(Entry.group('Mark'))
-    Price = Decimal(Entry.group('Mark')) + Settings.IncreaseEntryLimitOrderBy
-    Quantity = int(Settings.MaxBet/(Price * 100))
-    if Quantity > Settings.MaxContracts:
-        Quantity = Settings.MaxContracts
-    if Entry.group('Type').upper() == 'CALL':
-        opt_type = OptionType.CALL
-    elif Entry.group('Type').upper() == 'PUT':
-        opt_type = OptionType.PUT
-    LOGGER.info ('{} Entry signal received. Ticker: {} Strike: {} Exp: {} Mark: {}'.format(opt_type, Ticker, Strike, ExpDate, Mark))
+async def ProcessEntrySignal(Entry: Signal, account: AccountContext):
+    Ticker = Entry.ticker
+    ExpDate = Entry.exp_date
+    Strike = Entry.strike
+    Mark = Entry.mark
+    Price, Quantity = get_entry_order(Mark, account.settings)
+    opt_type = get_option_type(Entry)
+    account.log.info('%s Entry signal received. Ticker: %s Strike: %s Exp: %s Mark: %s', opt_type, Ticker, Strike, ExpDate, Mark)
     if Quantity > 0:
-        if not Ticker in Settings.AvoidStocks:
-            LOGGER.info ('Canceling any existing orders for the ticker')
-            await CancelOrderByTicker(Ticker)
-            LOGGER.info ('Removing any alerts previously set for the ticker.')
-            await DeleteAlertByTicker(Ticker)
-            LOGGER.info ('Executing order with qty of {}'.format(Quantity))
-            ret = await EnterTrade(Ticker, Price, ExpDate, Strike, opt_type, Quantity)
-            LOGGER.info('Returned Data: {}'.format(ret))
-            # Sleep for 5 seconds to allow time to get a fill.
-            await asyncio.sleep(5)
-            LOGGER.info('Calling ProcessUpdateSignal to place initial stop alerts...')
-            await ProcessUpdateSignal(Entry)
+        if not Ticker in account.settings.AvoidStocks:
+            account.log.info ('Canceling any existing orders and removing any alerts previously set for the ticker.')
+            await asyncio.gather(TraceStage('cancel_existing', CancelOrderByTicker(account, Ticker)), TraceStage('delete_alert', DeleteAlertByTicker(account, Ticker)))
+            account.log.info('Executing order with qty of %s', Quantity)
+            with TRACER.span('execute_order'):
+                ret = await EnterTrade(account, Ticker, Price, ExpDate, Strike, opt_type, Quantity)
+            if Entry.received_at is not None and TRACER.enabled:
+                TRACER.record('signal_to_order', time.perf_counter() - Entry.received_at)
+                account.record('signal_to_order', time.perf_counter() - Entry.received_at)
+            account.log.info('Returned Data: %s', ret)
+            with TRACER.span('fill_wait'), account.span('fill_wait'):
+                filled = await WaitForFill(account, Ticker, get_order_id(ret))
+            if filled:
+                account.fills += 1
+            else:
+                account.unfilled += 1
+            account.log.info('Entry order for %s %s', Ticker, 'filled' if filled else 'not filled yet')
+            account.log.info('Calling ProcessUpdateSignal to place initial stop alerts...')
+            await ProcessUpdateSignal(Entry, account)
         else:
-            LOGGER.info ('Ticker is in the Avoid list.  Skipping.')
+            account.log.info ('Ticker is in the Avoid list.  Skipping.')
     else:
-        LOGGER.info ('Quantity is 0 due to max bet.  No action taken.')
+        account.log.info ('Quantity is 0 due to max bet.  No action taken.')
+async def WaitForFill(account: AccountContext, ticker: str, order_id = None, timeout: float = None) -> bool:
+    # Returns True once a position shows up for the ticker, False if the buy order leaves the book unfilled or the timeout passes.
+    # An order that left the book filled keeps the positions polled until the timeout, since they can lag the fill.
+    timeout = account.settings.EntryFillTimeout if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    filled = False
+    while True:
+        positions = await account.state.get_positions(ticker, max_age=0)
+        if positions:
+            return True
+        if not filled and not await GetBuyOrdersByTicker(account, ticker):
+            if order_id is None:
+                return False
+            order = await FetchOrder(account, order_id)
+            if order.details.status != OrderStatus.FILLED:
+                account.log.info('Entry order %s for %s left the book as %s', order_id, ticker, order.details.status)
+                return False
+            filled = True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, 1.0)
+
 # Update Processing
 
-async def ProcessUpdateSignal(Update):
-    Ticker = Update.group('Ticker').upper()
-    ExpDate = get_expire_date_from_string(Update.group('Exp'))
-    Strike = Decimal(Update.group('Strike'))
-    CurrentPrice = Decimal(Update.group('Mark'))
-    LOGGER.info ('Update received for {0} Mark: {1}'.format(Ticker, CurrentPrice))
-    LOGGER.info ('Getting Positions for {}...'.format(Ticker))
-    positions = await GetPositions(Ticker)
-    LOGGER.info ('Getting Orders for {}...'.format(Ticker))
-    orders = await GetActiveOrders(Ticker)
+async def ProcessUpdateSignal(Update: Signal, account: AccountContext):
+    Ticker = Update.ticker
+    ExpDate = Update.exp_date
+    Strike = Update.strike
+    CurrentPrice = Update.mark
+    account.log.info('Update received for %s Mark: %s', Ticker, CurrentPrice)
+    account.log.info('Getting Positions for %s...', Ticker)
+    positions = await GetPositions(account, Ticker)
+    account.log.info('Getting Orders for %s...', Ticker)
+    orders = await GetActiveOrders(account, Ticker)
     if positions:
-        LOGGER.info ('Found {} open position(s) for {}...'.format(len(positions), Ticker))
+        account.log.info('Found %s open position(s) for %s...', len(positions), Ticker)
+        # The ticker holds a single underlying alert, so the positions' thresholds collapse into one update.
         for position in positions:
             option_obj = position.get_option_obj()
-            if option_obj.option_type == OptionType.CALL:
-                stockstop_adjusted = CurrentPrice - Settings.AdjustStockPriceAlertBy
-            elif option_obj.option_type == OptionType.PUT:
-                stockstop_adjusted = CurrentPrice + Settings.AdjustStockPriceAlertBy
-            LOGGER.info('Setting an alert for {} at adjusted stock price of ${}'.format(Ticker, stockstop_adjusted))
-            ret = await SetAlertForPosition(position, stockstop_adjusted)
-            LOGGER.info('Returned Data: {}'.format(ret))
+            stockstop_adjusted = get_stock_stop_price(CurrentPrice, option_obj.option_type == OptionType.CALL, account.settings)
+            alert = position.get_last_stock_price_alert_oobject(stockstop_adjusted)
+        account.log.info('Setting an alert for %s at adjusted stock price of $%s', Ticker, stockstop_adjusted)
+        with TRACER.span('set_alert'):
+            ret = await SetAlerts(account, {Ticker: alert})
+        account.log.info('Returned Data: %s', ret)
+        if EXIT_ENGINE is not None and account.settings.MarketSellOnAlert:
+            await EXIT_ENGINE.set_underlying_stop(Ticker, stockstop_adjusted, below = option_obj.option_type == OptionType.CALL, group = account)
     elif orders:
-        LOGGER.info ('Found {} open order(s) for {}...'.format(len(orders), Ticker))
+        account.log.info('Found %s open order(s) for %s...', len(orders), Ticker)
+        drifted = []
         for order in orders:
-            if (CurrentPrice - order.details.price) > Settings.EntryPriceDriftLimit:
-                LOGGER.info ('The price has drifted more than ${} without taking a position.  Cancelling order {}.'.format(Settings.EntryPriceDriftLimit, order.details.order_id))
-                result = await CancelOrderByID(order.details.order_id)
-                LOGGER.info('Final Result: {}'.format(result))
+            if has_entry_price_drifted(CurrentPrice, order.details.price, account.settings):
+                account.log.info('The price has drifted more than $%s without taking a position.  Cancelling order %s.', account.settings.EntryPriceDriftLimit, order.details.order_id)
+                drifted.append(order.details.order_id)
+        await CancelOrdersByID(account, drifted)
     else:
-        LOGGER.info('No orders or positions found.  No action taken.')
+        account.log.info('No orders or positions found.  No action taken.')
 
 # Exit Strategies
 
-async def ProcessDeactivationSignal(Deactivate):
-    Ticker = Deactivate.group('Ticker')
-    ExpDate = get_expire_date_from_string(Deactivate.group('Exp'))
-    Strike = Decimal(Deactivate.group('Strike'))
-    LOGGER.info('Received deactivate message for {}'.format(Ticker))
-    positions = await GetPositions(Ticker)
+async def ProcessDeactivationSignal(Deactivate: Signal, account: AccountContext):
+    Ticker = Deactivate.ticker
+    ExpDate = Deactivate.exp_date
+    Strike = Deactivate.strike
+    account.log.info('Received deactivate message for %s', Ticker)
+    positions = await GetPositions(account, Ticker)
     if positions:
         for position in positions:
-            LOGGER.info('Position found. Canceling all buy orders for {}'.format(Ticker))
-            await CancelBuyOrdersByTicker(Ticker)
-            if Settings.MarketSellOnDeactivate:
-                LOGGER.info('Closing {} contract(s) for {} at market price'.format(position.quantity, Ticker))
-                result = await ExitTradeWithMarketOrder(position)
-                LOGGER.info('Returned Data: {}'.format(result))
+            account.log.info('Position found. Canceling all buy orders for %s', Ticker)
+            await CancelBuyOrdersByTicker(account, Ticker)
+            if account.settings.MarketSellOnDeactivate:
+                account.log.info('Closing %s contract(s) for %s at market price', position.quantity, Ticker)
+                result = await ExitTradeWithMarketOrder(account, position)
+                account.log.info('Returned Data: %s', result)
                 if result:
-                    LOGGER.info('Removing any alerts that were set.')
-                    await DeleteAlertByTicker(Ticker)
+                    account.log.info('Removing any alerts that were set.')
+                    await DeleteAlertByTicker(account, Ticker)
                 else:
-                    LOGGER.info('Error creating a market sell order.')
+                    account.log.info('Error creating a market sell order.')
     else:
-        LOGGER.info('No open positions for {}. Cancelling any orders.'.format(Ticker))
-        await CancelOrderByTicker(Ticker)
-        LOGGER.info('Removing any alerts....')
-        await DeleteAlertByTicker(Ticker)
+        account.log.info('No open positions for %s. Cancelling any orders.', Ticker)
+        await CancelOrderByTicker(account, Ticker)
+        account.log.info('Removing any alerts....')
+        await DeleteAlertByTicker(account, Ticker)
 
 async def WatchAlertsAndExitIfTriggered():
     await asyncio.sleep(5)
     LOGGER.info('Starting Alerts Monitor')
-    while Settings.MarketSellOnAlert:
-        try:
-            alerts = await GetTriggeredAlerts()
-            for alert in alerts:
-                LOGGER.info('The alert for {} at ${} has triggered.  Checking for and closing any opened positions.'.format(alert.symbol, alert.threshold))
-                positions = await GetPositions(alert.symbol)
-                if positions:
-                    for position in positions:
-                        LOGGER.info('Closing {} contract(s) for {} at market price'.format(position.quantity, alert.symbol))
-                        await CancelOrderByTicker(alert.symbol)
-                        result = await ExitTradeWithMarketOrder(position)
-                        if result:
-                            LOGGER.info('Removing the alert.')
-                            await DeleteAlertByTicker(alert.symbol)
-                else:
-                    LOGGER.info('No open positions for {}.  Removing the alert.'.format(alert.symbol))
-                    await DeleteAlertByTicker(alert.symbol)
-        except Exception as ex:
-            LOGGER.info('Unhandled exception in WatchAlertsAndExitIfTriggered()')
-            LOGGER.fatal(ex, exc_info=True)
+    while any(account.settings.MarketSellOnAlert for account in ACCOUNTS):
+        # Quote alerts belong to a login, so each login's alerts are checked once.  A trigger closes the ticker in those
+        # of its accounts whose own stop it crossed.
+        for alerts in ALERT_MANAGERS:
+            if not any(account.settings.MarketSellOnAlert for account in ACCOUNTS if account.alerts is alerts):
+                continue
+            try:
+                # Stops held by a live exit engine are already checked on every streamed tick, so the broker's alert list is
+                # only polled while it holds symbols the engine isn't watching, and otherwise re-listed every AlertResyncSeconds.
+                if alerts.is_stale() or alerts.symbols() - GetStreamedStops(alerts):
+                    await alerts.sync()
+                for alert in alerts.get_triggered():
+                    LOGGER.info('The alert for %s at $%s has triggered.  Checking for and closing any opened positions.', alert.symbol, alert.threshold)
+                    crossed = [account for account in ACCOUNTS if account.alerts is alerts and is_stop_crossed(account, alert)]
+                    if crossed:
+                        await ExitPositionsForTriggeredAlert(alert.symbol, accounts = crossed)
+                    else:
+                        # None of the accounts' stops has been reached, e.g. an earlier run left the alert at another threshold.  Put back the one they want.
+                        account = next(account for account in ACCOUNTS if account.alerts is alerts)
+                        await SetAlerts(account, {alert.symbol: account.stock_alerts.get(alert.symbol.upper())})
+            except Exception as ex:
+                LOGGER.info('Unhandled exception in WatchAlertsAndExitIfTriggered()')
+                LOGGER.fatal(ex, exc_info=True)
         await asyncio.sleep(2)
 
+async def ExitPositionsForTriggeredAlert(ticker: str, price: Decimal = None, accounts: list = None):
+    # Accounts with MarketSellOnAlert off only have the stop that fired removed.
+    accounts = ACCOUNTS if accounts is None else accounts
+    results = await asyncio.gather(*[ExitAccountPositionsForTriggeredAlert(account, ticker) if account.settings.MarketSellOnAlert else DeleteAlertByTicker(account, ticker) for account in accounts], return_exceptions=True)
+    for account, result in zip(accounts, results):
+        if isinstance(result, Exception):
+            account.log.info('Unhandled exception closing %s after its alert triggered.', ticker)
+            account.log.fatal(result, exc_info=result)
+
+async def ExitForStreamedStop(ticker: str, price: Decimal, account: AccountContext):
+    await ExitPositionsForTriggeredAlert(ticker, price, accounts = [account])
+
+def is_stop_crossed(account: AccountContext, alert: Alert) -> bool:
+    # Whether a login's alert that fired at its threshold has also crossed the account's own stop.  An account with no
+    # stop recorded for the ticker, e.g. one set by an earlier run, is taken to be crossed.
+    stop = account.stock_alerts.get(alert.symbol.upper())
+    if stop is None:
+        return True
+    if is_below_alert(stop):
+        return Decimal(str(stop.threshold)) >= Decimal(str(alert.threshold))
+    return Decimal(str(stop.threshold)) <= Decimal(str(alert.threshold))
+
+def is_below_alert(alert: Alert) -> bool:
+    return str(get_enum_value(getattr(alert, 'operator', '<'))) == '<'
+
+async def ExitAccountPositionsForTriggeredAlert(account: AccountContext, ticker: str):
+    positions = await GetPositions(account, ticker)
+    if positions:
+        for position in positions:
+            account.log.info('Closing %s contract(s) for %s at market price', position.quantity, ticker)
+            await CancelOrderByTicker(account, ticker)
+            result = await ExitTradeWithMarketOrder(account, position)
+            if result:
+                account.log.info('Removing the alert.')
+                await DeleteAlertByTicker(account, ticker)
+    else:
+        account.log.info('No open positions for %s.  Removing the alert.', ticker)
+        await DeleteAlertByTicker(account, ticker)
+
 async def WatchPositionsAndExitAtPercentage():
     await asyncio.sleep(10)
     LOGGER.info('Starting Position Profit/Loss Monitor')
-    while Settings.AutoCloseAtProfitPercent > 0 or Settings.AutoCloseAtLossPercent > 0:
-        try:
-            positions = await TradingAccount.get_positions(tasty_client, tasty_acct)
-            for position in positions:
-                profit_percent = get_profit_percent(position)
-                LOGGER.info('Current profit for {} is {:.3f}%. Mark: ${:.3f} Entry: {} @ ${:.3f}'.format(position.underlying_symbol, profit_percent, position.mark_price, position.quantity, position.average_open_price))
-                if Settings.AutoCloseAtProfitPercent > 0 and profit_percent >= Settings.AutoCloseAtProfitPercent:
-                    if Settings.UseStopMarketOrderForProfitPercentExit:
-                        existing_stop_order = False
-                        replace_order = False
-                        orders = await GetSellOrdersByTicker(position.underlying_symbol)
-                        stop_trigger = position.mark_price - Settings.ProfitPercentExitTriggerPriceDelta
-                        if stop_trigger <= position.average_open_price:
-                            stop_trigger = position.average_open_price + Decimal('.01')
-                        if orders:
-                            for order in orders:
-                                if order.details.type == OrderType.STOP:
-                                    existing_stop_order = True
-                                    if order.details.stop_trigger < stop_trigger:
-                                        LOGGER.info('Increasing the stop trigger for {} from ${:.3f} to ${:.3f}'.format(position.underlying_symbol, order.details.stop_trigger, stop_trigger))
-                                        await CancelOrderByID(order.details.order_id)
-                                        replace_order = True
-                            if replace_order:
-                                await ExitTradeWithStopMarketOrder(position = position, stop_trigger = stop_trigger)
-                        if existing_stop_order == False and replace_order == False:
-                            LOGGER.info('Creating initial stop order for {} with a stop trigger of ${:.3f}'.format(position.underlying_symbol, stop_trigger))
-                            await ExitTradeWithStopMarketOrder(position = position, stop_trigger = stop_trigger)
-                            # await ExitTradeWithStopLimitOrder(position = position, price = limit_price, stop_trigger = stop_trigger)
-                    else:
-                        LOGGER.info('Canceling all opened orders for {}...'.format(position.underlying_symbol))
-                        await CancelOrderByTicker(position.underlying_symbol)
-                        LOGGER.info('Creating exit limit order for {}...'.format(position.underlying_symbol))
-                        await ExitTradeWithLimitOrder(position = position, price = position.mark_price)
-                elif Settings.AutoCloseAtLossPercent > 0 and (profit_percent * -1) >= Settings.AutoCloseAtLossPercent:
-                    LOGGER.info('A loss of {:.3f}% or greater has been detected for {} at market price of ${:.3f}.  Closing position with market sell order.'.format(Settings.AutoCloseAtLossPercent, position.underlying_symbol, position.mark_price))
-                    await CancelSellOrdersByTicker(position.underlying_symbol)
-                    await ExitTradeWithMarketOrder(position = position)
-        except Exception as ex:
-            LOGGER.info('Unhandled exception in WatchPositionsAndExitAtPercentage()')
-            LOGGER.fatal(ex, exc_info=True)
+    if EXIT_ENGINE is not None:
+        await StreamPositionsAndExitAtPercentage()
+        LOGGER.info('Quote stream stopped.  Falling back to polling positions every 2 seconds.')
+    while any(HasPositionExits(account) for account in ACCOUNTS):
+        for account in ACCOUNTS:
+            if not HasPositionExits(account):
+                continue
+            try:
+                positions = await account.state.get_positions()
+                account.stops.retain(position.underlying_symbol for position in positions)
+                # Screen every position in one batched pass and only run the full exit logic for those that crossed a threshold.
+                for row in PortfolioBatch(positions).get_exit_rows(account.settings):
+                    await EvaluatePositionExit(positions[row], account)
+            except Exception as ex:
+                account.log.info('Unhandled exception in WatchPositionsAndExitAtPercentage()')
+                account.log.fatal(ex, exc_info=True)
         await asyncio.sleep(2)
 
+async def StreamPositionsAndExitAtPercentage():
+    # Exit rules run on every quote tick.  Positions are only re-listed to keep the subscriptions in step with what is held.
+    try:
+        if not getattr(streamer, 'logged_in', False):
+            await streamer._setup_connection()
+    except Exception as ex:
+        LOGGER.info('Could not connect to the quote streamer.')
+        LOGGER.fatal(ex, exc_info=True)
+        return
+    listen_task = asyncio.ensure_future(EXIT_ENGINE.run())
+    while not listen_task.done():
+        for account in ACCOUNTS:
+            try:
+                positions = await account.state.get_positions()
+                account.stops.retain(position.underlying_symbol for position in positions)
+                # The engine also streams the underlying stops, so it runs whether or not the account has position exits.
+                await EXIT_ENGINE.sync_positions(positions if HasPositionExits(account) else [], account, listed_at = account.state.fetched_at)
+            except Exception as ex:
+                account.log.info('Unhandled exception in StreamPositionsAndExitAtPercentage()')
+                account.log.fatal(ex, exc_info=True)
+        await asyncio.wait([listen_task], timeout=Settings.StreamPositionSyncSeconds)
+    if listen_task.exception():
+        LOGGER.fatal(listen_task.exception(), exc_info=listen_task.exception())
+
+def HasPositionExits(account: AccountContext) -> bool:
+    return account.settings.AutoCloseAtProfitPercent > 0 or account.settings.AutoCloseAtLossPercent > 0
+
+async def EvaluatePositionExit(position: Position, account: AccountContext):
+    settings = account.settings
+    if not HasPositionExits(account):
+        return
+    profit_percent = get_profit_percent(position)
+    # Runs on every streamed tick, so only at DEBUG.  The exits below log what they do.
+    account.log.debug('Current profit for %s is %.3f%%. Mark: $%.3f Entry: %s @ $%.3f', position.underlying_symbol, profit_percent, position.mark_price, position.quantity, position.average_open_price)
+    exit_action = get_exit_action(profit_percent, settings)
+    if exit_action == PROFIT_EXIT:
+        if settings.UseStopMarketOrderForProfitPercentExit:
+            # The stop is only moved up, and only by TrailingStopMinStep or more, without waiting on a cancel in between.
+            stop_trigger = get_profit_stop_trigger(position.mark_price, position.average_open_price, settings)
+            await account.stops.ratchet(position, stop_trigger)
+        else:
+            account.log.info('Canceling all opened orders for %s...', position.underlying_symbol)
+            await CancelOrderByTicker(account, position.underlying_symbol)
+            account.log.info('Creating exit limit order for %s...', position.underlying_symbol)
+            await ExitTradeWithLimitOrder(account, position = position, price = position.mark_price)
+            SetExiting(position, account)
+    elif exit_action == LOSS_EXIT:
+        account.log.info('A loss of %.3f%% or greater has been detected for %s at market price of $%.3f.  Closing position with market sell order.', settings.AutoCloseAtLossPercent, position.underlying_symbol, position.mark_price)
+        await CancelSellOrdersByTicker(account, position.underlying_symbol)
+        await ExitTradeWithMarketOrder(account, position = position)
+        SetExiting(position, account)
+
+def SetExiting(position: Position, account: AccountContext):
+    # The streamed ticks that follow would otherwise send the exit again until the next position resync.
+    if EXIT_ENGINE is not None:
+        EXIT_ENGINE.set_exiting(position, account)
+
 # End Exits
 
-async def EnterTrade(ticker, price: Decimal, expiry, strike: Decimal, opt_type: OptionType, quantity = 1):
+async def EnterTrade(account: AccountContext, ticker, price: Decimal, expiry, strike: Decimal, opt_type: OptionType, quantity = 1):
     sub_values = {"Quote": ["/ES"]}
-    if Settings.EnterWithMarketOrder:
+    if account.settings.EnterWithMarketOrder:
         details = OrderDetails(type=OrderType.MARKET, price=None, price_effect=OrderPriceEffect.DEBIT)
     else:
         details = OrderDetails(type=OrderType.LIMIT, price=price, price_effect=OrderPriceEffect.DEBIT)
     new_order = Order(details)
     opt = Option(ticker=ticker, quantity=quantity, expiry=expiry, strike=strike, option_type=opt_type, underlying_type=UnderlyingType.EQUITY)
     new_order.add_leg(opt)
-    return await tasty_acct.execute_order(new_order, tasty_client, dry_run=False)
+    return await ExecuteOrder(account, new_order)
 
-async def ExitTradeWithLimitOrder(position: Position, price: Decimal):
+async def ExitTradeWithLimitOrder(account: AccountContext, position: Position, price: Decimal):
     new_order = position.get_closing_order_object(price)
-    return await tasty_acct.execute_order(new_order, tasty_client, dry_run=False)
+    return await ExecuteOrder(account, new_order)
 
-async def ExitTradeWithStopLimitOrder(position: Position, price: Decimal, stop_trigger: Decimal):
+async def ExitTradeWithStopLimitOrder(account: AccountContext, position: Position, price: Decimal, stop_trigger: Decimal):
     new_order = position.get_closing_order_object(price, stop_trigger, OrderType.STOP_LIMIT)
-    return await tasty_acct.execute_order(new_order, tasty_client, dry_run=False)
+    return await ExecuteOrder(account, new_order)
 
-async def ExitTradeWithStopMarketOrder(position: Position, stop_trigger: Decimal):
+async def ExitTradeWithStopMarketOrder(account: AccountContext, position: Position, stop_trigger: Decimal):
     new_order = position.get_closing_order_object(price=None, stop_trigger=stop_trigger, order_type=OrderType.STOP)
-    return await tasty_acct.execute_order(new_order, tasty_client, dry_run=False)
+    return await ExecuteOrder(account, new_order)
 
-async def ExitTradeWithMarketOrder(position: Position):
+async def ExitTradeWithMarketOrder(account: AccountContext, position: Position):
     new_order = position.get_closing_order_object(price=None, order_type=OrderType.MARKET)
-    return await tasty_acct.execute_order(new_order, tasty_client, dry_run=False)
+    return await ExecuteOrder(account, new_order)
 
-async def GetPositions(ticker: str) -> list:
-    sub_values = {"Quote": ["/ES"]}
-    positions = await TradingAccount.get_positions(tasty_client, tasty_acct)
-    ret = []
-    for position in positions:
-        if position.underlying_symbol.upper() == ticker.upper():
-            ret.append(position)
-    return ret
-
-async def GetActiveOrders(ticker: str) -> list:
-    orders = await Order.get_live_orders(tasty_client, tasty_acct)
-    ret = []
-    for order in orders:
-        if order.details.ticker.upper() == ticker.upper():
-            ret.append(order)
-    return ret
-
-async def GetBuyOrdersByTicker(ticker: str) -> list:
-    orders = await Order.get_live_orders(tasty_client, tasty_acct)
-    ret = []
-    for order in orders:
-        if order.details.ticker.upper() == ticker.upper() and order.details.price_effect == OrderPriceEffect.DEBIT:
-            ret.append(order)
-    return ret
-
-async def GetSellOrdersByTicker(ticker: str) -> list:
-    orders = await Order.get_live_orders(tasty_client, tasty_acct)
-    ret = []
-    for order in orders:
-        if order.details.ticker.upper() == ticker.upper() and order.details.price_effect == OrderPriceEffect.CREDIT:
-            ret.append(order)
-    return ret
-
-async def CancelBuyOrdersByTicker(ticker: str, orders = None):
+async def PlaceStopOrder(account: AccountContext, position: Position, stop_trigger: Decimal):
+    return get_order_id(await ExitTradeWithStopMarketOrder(account, position = position, stop_trigger = stop_trigger))
+
+async def ReplaceStopOrder(account: AccountContext, order_id, position: Position, stop_trigger: Decimal):
+    new_order = position.get_closing_order_object(price=None, stop_trigger=stop_trigger, order_type=OrderType.STOP)
+    return get_order_id(await ExecuteOrder(account, new_order, replaces = order_id))
+
+async def CancelStopOrder(account: AccountContext, order_id) -> OrderStatus:
+    # Sent without waiting for the confirmation, since the replacement stop is already working.
+    with JOURNAL.operation('cancel', account.name, order_ids=[order_id]):
+        status = await SendCancelOrder(account, order_id)
+    log_trade_event('cancel', account=account.name, order_id=order_id, status=status)
+    account.state.invalidate()
+    return status
+
+async def CancelStopOrderAndConfirm(account: AccountContext, order_id) -> bool:
+    # For when the new stop can only be placed once the old one is gone.
+    return await CancelOrderByID(account, order_id) == OrderStatus.CANCELLED
+
+async def GetStopOrders(account: AccountContext, ticker: str) -> list:
+    # The quantity isn't read back, so the first ratchet after a restart also replaces the stop it finds.
+    orders = await GetSellOrdersByTicker(account, ticker)
+    return [(order.details.order_id, order.details.stop_trigger, None) for order in orders if order.details.type == OrderType.STOP]
+
+def CanReplaceOrders(account: AccountContext) -> bool:
+    return account.settings.ReplaceStopOrders and (hasattr(account.account, 'replace_order') or (account.gateway is not None and order_to_json is not None))
+
+def get_order_id(result: dict):
+    return result['order']['id']
+
+async def ExecuteOrder(account: AccountContext, new_order: Order, replaces = None):
+    # With replaces, the order takes the place of that working order in one call.  Only used when CanReplaceOrders().
+    details = new_order.details
+    fields = {'account': account.name, 'ticker': getattr(details, 'ticker', None), 'type': details.type, 'price_effect': details.price_effect, 'price': details.price, 'stop_trigger': getattr(details, 'stop_trigger', None)}
+    if replaces is not None:
+        fields['replaces'] = replaces
+    account.orders += 1
+    op = JOURNAL.begin('order', **fields)
+    try:
+        if account.settings.JournalWaitForOrders:
+            await JOURNAL.flush()
+        with account.span('execute_order'):
+            result = await SendOrder(account, new_order, replaces)
+        log_trade_event('order', result=result, **fields)
+        JOURNAL.end(op, result=result)
+        return result
+    except Exception as ex:
+        account.order_errors += 1
+        log_trade_event('order_error', error=ex, **fields)
+        JOURNAL.end(op, error=ex)
+        raise
+    finally:
+        account.state.invalidate()
+
+async def SendOrder(account: AccountContext, new_order: Order, replaces = None):
+    if replaces is None:
+        with gateway_write(account.gateway):
+            return await CallBroker('execute_order', account.account.execute_order(new_order, account.session, dry_run=False))
+    if hasattr(account.account, 'replace_order'):
+        with gateway_write(account.gateway):
+            return await CallBroker('replace_order', account.account.replace_order(replaces, new_order, account.session))
+    data = await CallBroker('replace_order', account.gateway.put('/accounts/{}/orders/{}'.format(account.account.account_number, replaces), json=get_order_json(new_order)))
+    # The replace reply has the order itself under 'data', not under 'data' -> 'order' like a new order's.
+    return {'order': data['data']}
+
+def get_order_json(order: Order) -> dict:
+    # The library's builder always formats the price, which a stop market order doesn't have, and leaves out the trigger.
+    details = order.details
+    price = details.price
+    if price is None:
+        details.price = Decimal(0)
+    try:
+        body = order_to_json(order)
+    finally:
+        details.price = price
+    if price is None:
+        body.pop('price', None)
+    if getattr(details, 'stop_trigger', None) is not None:
+        body['stop-trigger'] = '{:.2f}'.format(details.stop_trigger)
+    return body
+
+async def TraceStage(stage: str, call):
+    with TRACER.span(stage):
+        return await call
+
+async def CallBroker(endpoint: str, call):
+    with TRACER.span('broker.' + endpoint):
+        return await call
+
+# Reads go over the gateway's pooled session when the model can be built from the raw JSON.  Otherwise the
+# model's own call is used, with identical in-flight calls still shared through the gateway.
+
+async def FetchPositions(account: AccountContext) -> list:
+    gateway = account.gateway
+    if gateway is None:
+        return await CallBroker('get_positions', TradingAccount.get_positions(account.session, account.account))
+    if hasattr(Position, 'from_dict'):
+        data = await CallBroker('get_positions', gateway.get('/accounts/{}/positions'.format(account.account.account_number)))
+        return [Position.from_dict(item) for item in data['data']['items']]
+    return await CallBroker('get_positions', gateway.coalesce(('get_positions', account.name), lambda: TradingAccount.get_positions(account.session, account.account)))
+
+async def FetchLiveOrders(account: AccountContext) -> list:
+    gateway = account.gateway
+    if gateway is None:
+        return await CallBroker('get_live_orders', Order.get_live_orders(account.session, account.account))
+    if hasattr(Order, 'from_dict'):
+        data = await CallBroker('get_live_orders', gateway.get('/accounts/{}/orders/live'.format(account.account.account_number)))
+        # The endpoint also lists the day's filled, cancelled and rejected orders, which the model call leaves out.
+        return [order for order in (Order.from_dict(item) for item in data['data']['items']) if order.details.status.is_active()]
+    return await CallBroker('get_live_orders', gateway.coalesce(('get_live_orders', account.name), lambda: Order.get_live_orders(account.session, account.account)))
+
+async def FetchOrder(account: AccountContext, order_id) -> Order:
+    gateway = account.gateway
+    if gateway is None:
+        return await CallBroker('get_order', Order.get_order(account.session, account.account, order_id))
+    if hasattr(Order, 'from_dict'):
+        data = await CallBroker('get_order', gateway.get('/accounts/{}/orders/{}'.format(account.account.account_number, order_id)))
+        return Order.from_dict(data['data'])
+    return await CallBroker('get_order', gateway.coalesce(('get_order', account.name, order_id), lambda: Order.get_order(account.session, account.account, order_id)))
+
+async def FetchQuoteAlerts(session: TastyAPISession, gateway) -> list:
+    if gateway is None:
+        return await CallBroker('get_quote_alert', TradingAccount.get_quote_alert(session))
+    if hasattr(Alert, 'from_dict'):
+        data = await CallBroker('get_quote_alert', gateway.get('/quote-alerts'))
+        return [Alert.from_dict(item) for item in data['data']['items']]
+    return await CallBroker('get_quote_alert', gateway.coalesce('get_quote_alert', lambda: TradingAccount.get_quote_alert(session)))
+
+async def SendCreateAlert(session: TastyAPISession, alert: Alert, gateway = None):
+    with gateway_write(gateway):
+        return await CallBroker('set_quote_alert', TradingAccount.set_quote_alert(session, alert))
+
+async def SendDeleteAlert(session: TastyAPISession, alert: Alert, gateway = None):
+    with gateway_write(gateway):
+        return await CallBroker('delete_quote_alert', TradingAccount.delete_quote_alert(session, alert))
+
+@contextmanager
+def gateway_write(gateway):
+    # For writes made through the tastyworks models, which the gateway doesn't see.  Reads sent before the write
+    # finished aren't shared with later ones.
+    try:
+        yield
+    finally:
+        if gateway is not None:
+            gateway.invalidate()
+
+async def SendCancelOrder(account: AccountContext, order_id) -> OrderStatus:
+    account.cancels += 1
+    if account.gateway is None:
+        return await CallBroker('cancel_order', Order.cancel_order(account.session, account.account, order_id))
+    data = await CallBroker('cancel_order', account.gateway.delete('/accounts/{}/orders/{}'.format(account.account.account_number, order_id)))
+    return OrderStatus(data['data']['status'])
+
+async def GetPositions(account: AccountContext, ticker: str) -> list:
+    return await account.state.get_positions(ticker)
+
+async def GetActiveOrders(account: AccountContext, ticker: str) -> list:
+    return await account.state.get_orders(ticker)
+
+async def GetBuyOrdersByTicker(account: AccountContext, ticker: str) -> list:
+    orders = await account.state.get_orders(ticker)
+    return [order for order in orders if order.details.price_effect == OrderPriceEffect.DEBIT]
+
+async def GetSellOrdersByTicker(account: AccountContext, ticker: str) -> list:
+    orders = await account.state.get_orders(ticker)
+    return [order for order in orders if order.details.price_effect == OrderPriceEffect.CREDIT]
+
+async def CancelBuyOrdersByTicker(account: AccountContext, ticker: str, orders = None):
     if orders == None:
-        orders = await GetActiveOrders(ticker)
-    for order in orders:
-        if order.details.ticker.upper() == ticker.upper() and order.details.price_effect == OrderPriceEffect.DEBIT:
-            result = await CancelOrderByID(order.details.order_id)
-            LOGGER.info ('Final Result: {}'.format(result))
+        orders = await GetActiveOrders(account, ticker)
+    order_ids = [order.details.order_id for order in orders if order.details.ticker.upper() == ticker.upper() and order.details.price_effect == OrderPriceEffect.DEBIT]
+    return await CancelOrdersByID(account, order_ids)
 
-async def CancelSellOrdersByTicker(ticker: str, orders = None):
+async def CancelSellOrdersByTicker(account: AccountContext, ticker: str, orders = None):
     if orders == None:
-        orders = await GetActiveOrders(ticker)
-    for order in orders:
-        if order.details.ticker.upper() == ticker.upper() and order.details.price_effect == OrderPriceEffect.CREDIT:
-            result = await CancelOrderByID(order.details.order_id)
-            LOGGER.info ('Final Result: {}'.format(result))
+        orders = await GetActiveOrders(account, ticker)
+    order_ids = [order.details.order_id for order in orders if order.details.ticker.upper() == ticker.upper() and order.details.price_effect == OrderPriceEffect.CREDIT]
+    return await CancelOrdersByID(account, order_ids)
 
-async def CancelOrderByTicker(ticker: str, orders = None):
+async def CancelOrderByTicker(account: AccountContext, ticker: str, orders = None):
     if orders == None:
-        orders = await GetActiveOrders(ticker)
-    for order in orders:
-        result = await CancelOrderByID(order.details.order_id)
-        LOGGER.info ('Final Result: {}'.format(result))
-
-async def CancelOrderByID(order_id):
-    result = await Order.cancel_order(tasty_client, tasty_acct, order_id)
-    LOGGER.info ('Canceling order id {}.  Initial Result: {}'.format(order_id, result))
-    while result == OrderStatus.CANCEL_REQUESTED:
-        await asyncio.sleep(1)
-        order = await Order.get_order(tasty_client, tasty_acct, order_id)
-        result = order.details.status
+        orders = await GetActiveOrders(account, ticker)
+    return await CancelOrdersByID(account, [order.details.order_id for order in orders])
+
+async def CancelOrderByID(account: AccountContext, order_id):
+    result = (await CancelOrdersByID(account, [order_id]))[order_id]
+    if isinstance(result, Exception):
+        raise result
     return result
 
-async def DeleteAlertByTicker(ticker: str):
-    alerts = await TradingAccount.get_quote_alert(tasty_client)
-    for alert in alerts:
-        if alert.symbol.upper() == ticker.upper():
-            await TradingAccount.delete_quote_alert(tasty_client, alert)
-
-async def SetAlertForPosition(position: Position, price: Decimal):
-    await DeleteAlertByTicker(position.underlying_symbol)
-    alert = position.get_last_stock_price_alert_oobject(price)
-    return await TradingAccount.set_quote_alert(tasty_client, alert)
-
-async def GetTriggeredAlerts() -> list:
-    ret = []
-    alerts = await TradingAccount.get_quote_alert(tasty_client)
-    for alert in alerts:
-        if alert.triggered == True:
-            ret.append(alert)
-    return ret
-
-def get_expire_date_from_string(d):
-    this_year = int(date.today().year)
-    month = int(d.split('/')[0])
-    day = int(d.split('/')[1])
-    if date(this_year, month, day) >= date.today():
-        return date(this_year, month, day)
-    else:
-        next_year = this_year + 1
-        return date(next_year, month, day)
-
-def get_profit_percent(position: Position):
-    entry_fee = Decimal('1.00') * Decimal(position.quantity)
-    entry = position.average_open_price * position.multiplier
-    if entry_fee > 10:
-        entry = entry + Decimal('10')
-    else:
-        entry = entry + entry_fee
-    currentpl = (position.mark_price - position.average_open_price) * position.multiplier
-    return Decimal((currentpl / entry) * 100)
-
-tasty_client = tasty_session.create_new_session(Settings.tasty_user, Settings.tasty_password)
-streamer = DataStreamer(tasty_client)
-LOGGER.info('TW Streamer token: %s' % streamer.get_streamer_token())
-tw_accounts = asyncio.new_event_loop().run_until_complete(TradingAccount.get_remote_accounts(tasty_client))
-tasty_acct = None
-for account in tw_accounts:
-    if account.account_number == Settings.tasty_account_number and account.is_margin == False:
-        tasty_acct = account
-        LOGGER.info('TW Account found: %s', tasty_acct)
-if not tasty_acct:
-    raise Exception('Could not find a TastyWorks cash account with account number {} in the list of accounts: {}'.format(Settings.tasty_account_number, tw_accounts))
-
-loop = asyncio.get_event_loop()
-
-try:
-    task1 = loop.create_task(client.start(Settings.Discord_Token, bot=False))
-    task2 = loop.create_task(WatchAlertsAndExitIfTriggered())
-    task3 = loop.create_task(WatchPositionsAndExitAtPercentage())
-    loop.run_until_complete(asyncio.gather(task1, task2, task3))
-except KeyboardInterrupt:
-    pass
-except Exception as ex:
-    LOGGER.error('An unexpected error occurred in the main loop: {}'.format(ex))
-    LOGGER.fatal(ex, exc_info=True)
-finally:
-    loop.run_until_complete(client.logout())
-    loop.run_until_complete(client.close())
-    time.sleep(3)
-    loop.close()
\ No newline at end of file
+async def CancelOrdersByID(account: AccountContext, order_ids: list) -> dict:
+    # Sends every cancel at once, then confirms them all with one shared live-order poll per round, backing off from 0.1s to 1s.
+    # Returns {order_id: final OrderStatus}, or the exception raised for that order's cancel.
+    if not order_ids:
+        return {}
+    op = JOURNAL.begin('cancel', account.name, order_ids=order_ids)
+    try:
+        statuses = await ConfirmCancels(account, order_ids)
+    except Exception as ex:
+        JOURNAL.end(op, error=ex)
+        raise
+    JOURNAL.end(op, statuses=statuses)
+    return statuses
+
+async def ConfirmCancels(account: AccountContext, order_ids: list) -> dict:
+    results = await asyncio.gather(*[SendCancelOrder(account, order_id) for order_id in order_ids], return_exceptions=True)
+    account.state.invalidate()
+    account.stops.discard_orders(order_ids)
+    statuses = {}
+    pending = set()
+    for order_id, result in zip(order_ids, results):
+        account.log.info('Canceling order id %s.  Initial Result: %s', order_id, result)
+        statuses[order_id] = result
+        if result == OrderStatus.CANCEL_REQUESTED:
+            pending.add(order_id)
+    delay = 0.1
+    deadline = time.monotonic() + account.settings.CancelConfirmTimeout
+    while pending and time.monotonic() < deadline:
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 1.0)
+        try:
+            live_orders = {order.details.order_id: order for order in await account.state.get_orders(max_age=0)}
+        except Exception as ex:
+            # Left pending for the next round.
+            account.log.info('Could not list live orders to confirm cancels: %s', ex)
+            continue
+        missing = []
+        for order_id in list(pending):
+            order = live_orders.get(order_id)
+            if order is None:
+                missing.append(order_id)
+            elif order.details.status != OrderStatus.CANCEL_REQUESTED:
+                statuses[order_id] = order.details.status
+                pending.discard(order_id)
+        if missing:
+            # Orders that dropped off the live list are looked up directly for their final status.  A failed lookup is
+            # recorded for that order and tried again next round.
+            orders = await asyncio.gather(*[FetchOrder(account, order_id) for order_id in missing], return_exceptions=True)
+            for order_id, order in zip(missing, orders):
+                if isinstance(order, Exception):
+                    statuses[order_id] = order
+                    continue
+                statuses[order_id] = order.details.status
+                if order.details.status != OrderStatus.CANCEL_REQUESTED:
+                    pending.discard(order_id)
+    if pending:
+        account.log.info('Cancels still pending after %ss: %s', account.settings.CancelConfirmTimeout, sorted(pending))
+    for order_id in order_ids:
+        account.log.info('Final Result for order id %s: %s', order_id, statuses[order_id])
+        log_trade_event('cancel', account=account.name, order_id=order_id, status=statuses[order_id])
+    account.state.invalidate()
+    return statuses
+
+async def DeleteAlertByTicker(account: AccountContext, ticker: str):
+    await SetAlerts(account, {ticker: None})
+
+async def SetAlerts(account: AccountContext, alerts: dict) -> list:
+    # Maps ticker -> the one stop alert the account wants, or None for none.  Alerts belong to the login, so accounts that
+    # share one also share its alerts: each ticker gets the alert of whichever of them would be stopped out first.  Only
+    # the differences are sent to the broker.
+    for ticker, alert in alerts.items():
+        if alert is None:
+            account.stock_alerts.pop(ticker.upper(), None)
+            if EXIT_ENGINE is not None:
+                EXIT_ENGINE.clear_underlying_stop(ticker, account)
+        else:
+            account.stock_alerts[ticker.upper()] = alert
+            log_trade_event('alert', account=account.name, ticker=ticker, threshold=alert.threshold)
+    with JOURNAL.operation('alerts', account.name, alerts={ticker: getattr(alert, 'threshold', None) for ticker, alert in alerts.items()}):
+        return await account.alerts.apply({ticker: GetLoginAlert(account, ticker) for ticker in alerts})
+
+def GetLoginAlert(account: AccountContext, ticker: str) -> Alert:
+    # The stop that fires first of those wanted by the accounts on the account's login.  The accounts all trade the same
+    # signal, so the stops are either all below the price (calls) or all above it (puts).
+    sharing = [account] + [other for other in ACCOUNTS if other is not account and other.alerts is account.alerts]
+    wanted = [other.stock_alerts[ticker.upper()] for other in sharing if ticker.upper() in other.stock_alerts]
+    if not wanted:
+        return None
+    if is_below_alert(wanted[0]):
+        return max(wanted, key=lambda alert: Decimal(str(alert.threshold)))
+    return min(wanted, key=lambda alert: Decimal(str(alert.threshold)))
+
+def GetStreamedStops(alerts: AlertManager) -> set:
+    # The tickers a live exit engine holds a stop for in any account on the login.
+    if EXIT_ENGINE is None or not EXIT_ENGINE.listening:
+        return set()
+    return set(ticker for ticker, stops in EXIT_ENGINE.underlying_stops.items() if any(account.alerts is alerts for account in stops))
+
+def get_option_type(signal: Signal) -> OptionType:
+    if signal.option_type == 'CALL':
+        return OptionType.CALL
+    elif signal.option_type == 'PUT':
+        return OptionType.PUT
+
+def import_tastyworks():
+    # Runs on an executor thread during startup, while Discord is logging in.
+    global Option, OptionType, Order, OrderDetails, OrderPriceEffect, OrderType, OrderStatus, TastyAPISession, TradingAccount, Alert, Position, UnderlyingType, DataStreamer, tasty_session, order_to_json
+    from tastyworks.models.option import Option, OptionType
+    from tastyworks.models.order import Order, OrderDetails, OrderPriceEffect, OrderType, OrderStatus
+    from tastyworks.models.session import TastyAPISession
+    from tastyworks.models.trading_account import TradingAccount
+    from tastyworks.models.alert import Alert
+    from tastyworks.models.position import Position
+    from tastyworks.models.underlying import UnderlyingType
+    from tastyworks.streamer import DataStreamer
+    from tastyworks.tastyworks_api import tasty_session
+    # Builds the order body the REST API takes, so the gateway can replace orders when the model has no call for it.
+    from tastyworks.models import trading_account
+    order_to_json = getattr(trading_account, '_get_execute_order_json', None)
+
+def create_session(cached: dict, username: str, password: str) -> TastyAPISession:
+    # Reuses the cached session token while the broker still accepts it, otherwise logs in again.  Blocking.
+    if cached:
+        try:
+            session = TastyAPISession.__new__(TastyAPISession)
+            session.API_url = cached['api_url']
+            session.username = username
+            session.password = password
+            session.logged_in = True
+            session.logged_in_at = cached['logged_in_at']
+            session.session_token = cached['session_token']
+            if session.is_active():
+                LOGGER.info('Reusing the cached TW session for %s.', username)
+                return session
+        except Exception as ex:
+            LOGGER.info('The cached TW session for %s is no longer valid: %s', username, ex)
+    return tasty_session.create_new_session(username, password)
+
+async def ResolveAccounts(specs: list, sessions: dict, cached: dict) -> dict:
+    # account_number -> TradingAccount.  Each login's accounts are listed at most once, and not at all when every one is cached.
+    resolved = {}
+    missing = {}
+    for spec in specs:
+        account = cached.get(spec['account_number'])
+        if account is not None:
+            resolved[spec['account_number']] = account
+        else:
+            missing.setdefault(spec['tasty_user'], []).append(spec['account_number'])
+    listings = await asyncio.gather(*[TradingAccount.get_remote_accounts(sessions[user]) for user in missing])
+    for (user, account_numbers), tw_accounts in zip(missing.items(), listings):
+        for account_number in account_numbers:
+            for account in tw_accounts:
+                if account.account_number == account_number and account.is_margin == False:
+                    resolved[account_number] = account
+            if account_number not in resolved:
+                raise Exception('Could not find a TastyWorks cash account with account number {} in the list of accounts: {}'.format(account_number, tw_accounts))
+    return resolved
+
+async def StartBroker():
+    global streamer, EXIT_ENGINE
+    loop = asyncio.get_event_loop()
+    with TRACER.span('startup.import_tastyworks'):
+        await loop.run_in_executor(None, import_tastyworks)
+    # The cache holds tastyworks objects, so it can only be read once they are importable.
+    cached = STATE_CACHE.load()
+    specs = get_account_specs()
+    logins = {}
+    for spec in specs:
+        logins.setdefault(spec['tasty_user'], spec['tasty_password'])
+    cached_sessions = cached.get('sessions', {})
+    with TRACER.span('startup.session'):
+        sessions = await asyncio.gather(*[loop.run_in_executor(None, create_session, cached_sessions.get(user), user, password) for user, password in logins.items()])
+        sessions = dict(zip(logins, sessions))
+        streamer = await loop.run_in_executor(None, DataStreamer, sessions[specs[0]['tasty_user']])
+    STATE_CACHE.update(sessions={user: {'api_url': session.API_url, 'logged_in_at': session.logged_in_at, 'session_token': session.session_token} for user, session in sessions.items()})
+    with TRACER.span('startup.account'):
+        tw_accounts = await ResolveAccounts(specs, sessions, cached.get('accounts', {}))
+    STATE_CACHE.update(accounts=tw_accounts)
+    gateways = {}
+    alert_managers = {}
+    for user, session in sessions.items():
+        gateway = None
+        if Settings.UseBrokerGateway:
+            from broker_gateway import BrokerGateway
+            gateway = BrokerGateway(session.API_url, session.get_request_headers)
+            TRACER.add_gauge('broker_gateway.{}'.format(user), gateway.stats)
+            GATEWAYS.append(gateway)
+        gateways[user] = gateway
+        alert_managers[user] = AlertManager(partial(FetchQuoteAlerts, session, gateway), partial(SendCreateAlert, session, gateway = gateway), partial(SendDeleteAlert, session, gateway = gateway))
+        TRACER.add_gauge('alerts.{}'.format(user), alert_managers[user].stats)
+        ALERT_MANAGERS.append(alert_managers[user])
+    await asyncio.gather(*[gateway.warm_up() for gateway in GATEWAYS])
+    for spec in specs:
+        user = spec['tasty_user']
+        account = CreateAccount(spec, sessions[user], tw_accounts[spec['account_number']], gateways[user], alert_managers[user], tag_logs = len(specs) > 1)
+        LOGGER.info('TW Account found: %s', account.account)
+        TRACER.add_gauge('account.{}'.format(account.name), account.stats)
+        TRACER.add_gauge('stops.{}'.format(account.name), account.stops.stats)
+        ACCOUNTS.append(account)
+    if Settings.UseStreamingQuotes:
+        EXIT_ENGINE = ExitEngine(streamer, EvaluatePositionExit, ExitForStreamedStop)
+    # Last run's positions, orders and alerts are only a starting point.  They stay marked stale, and fresh copies are
+    # fetched straight away so they are usually in hand before the first signal needs them.
+    for account in ACCOUNTS:
+        if account.name in cached.get('positions', {}) and account.name in cached.get('orders', {}):
+            account.state.load(cached['positions'][account.name], cached['orders'][account.name])
+        asyncio.ensure_future(account.state.refresh())
+    for user, alerts in alert_managers.items():
+        if user in cached.get('alerts', {}):
+            alerts.load(cached['alerts'][user])
+        asyncio.ensure_future(alerts.sync())
+    with TRACER.span('startup.recover'):
+        await RecoverFromJournal()
+    await SaveState()
+
+def CreateAccount(spec: dict, session: TastyAPISession, tw_account: TradingAccount, gateway, alerts: AlertManager, tag_logs: bool = False) -> AccountContext:
+    # Also used by backtest.py, with a simulated broker behind the tastyworks models.
+    account = AccountContext(spec, session, tw_account, gateway, alerts, LOGGER, tag_logs = tag_logs)
+    account.state = AccountState(partial(FetchPositions, account), partial(FetchLiveOrders, account), ttl = account.settings.AccountStateTTL)
+    account.stops = TrailingStops(partial(GetStopOrders, account), partial(PlaceStopOrder, account), partial(CancelStopOrder, account),
+        partial(ReplaceStopOrder, account) if CanReplaceOrders(account) else None, cancel_confirmed = partial(CancelStopOrderAndConfirm, account),
+        min_step = account.settings.TrailingStopMinStep, logger = account.log)
+    return account
+
+async def RecoverFromJournal():
+    # Finishes what the last run was cut off in the middle of, going by the journal's unfinished operations and the
+    # account as it is now.  Runs before any new signal is handled.
+    operations = await asyncio.get_event_loop().run_in_executor(None, JOURNAL.recover)
+    if operations:
+        LOGGER.info('Recovering %s operation(s) left unfinished by the last run.', len(operations))
+    accounts = {account.name: account for account in ACCOUNTS}
+    oldest = time.time() - Settings.JournalRecoverMaxAgeMinutes * 60.0
+    for operation in operations:
+        account = accounts.get(operation['account'])
+        try:
+            if account is None:
+                outcome = 'account not loaded'
+            elif operation['ts'] < oldest:
+                outcome = 'too old to re-run, left as the broker has it'
+            else:
+                outcome = await ReconcileOperation(operation['kind'], operation['fields'], account)
+        except Exception as ex:
+            LOGGER.info('Could not recover %s operation %s.', operation['kind'], operation['op'])
+            LOGGER.fatal(ex, exc_info=True)
+            outcome = 'failed: {}'.format(ex)
+        LOGGER.info('Recovered %s operation %s %s: %s', operation['kind'], operation['op'], operation['fields'], outcome)
+        if outcome == ENTRY_WORKING:
+            # Stays open until the order resolves, so a restart before then recovers it again.
+            asyncio.ensure_future(FinishRecoveredEntry(operation, account))
+        else:
+            JOURNAL.end(operation['op'], recovered=outcome)
+
+async def FinishRecoveredEntry(operation: dict, account: AccountContext):
+    # Waits out an entry order that was still working at startup, then places its stop alerts as the entry would have.
+    signal = get_journal_signal(operation['fields'])
+    try:
+        while True:
+            if await WaitForFill(account, signal.ticker):
+                await ProcessUpdateSignal(signal, account)
+                outcome = 'entry filled, stops placed'
+                break
+            if not await GetBuyOrdersByTicker(account, signal.ticker):
+                outcome = 'entry order left the book unfilled'
+                break
+            await asyncio.sleep(2)
+    except Exception as ex:
+        account.log.info('Could not finish recovering the entry for %s.', signal.ticker)
+        account.log.fatal(ex, exc_info=True)
+        outcome = 'failed: {}'.format(ex)
+    account.log.info('Recovered signal operation %s %s: %s', operation['op'], operation['fields'], outcome)
+    JOURNAL.end(operation['op'], recovered=outcome)
+
+def get_journal_signal(fields: dict) -> Signal:
+    return Signal(SignalType(fields['type']), fields['ticker'], fields['option_type'], fields['exp'] and datetime.strptime(fields['exp'], '%Y-%m-%d').date(), fields['strike'] and Decimal(fields['strike']), fields['mark'] and Decimal(fields['mark']))
+
+async def ReconcileOperation(kind: str, fields: dict, account: AccountContext) -> str:
+    if kind == 'signal':
+        signal = get_journal_signal(fields)
+        positions = await account.state.get_positions(signal.ticker, max_age=0)
+        if signal.signal_type == SignalType.DEACTIVATE:
+            await ProcessDeactivationSignal(signal, account)
+            return 'deactivation rerun'
+        if positions:
+            # Whether the entry filled before or after the crash, the stop alerts may not have been placed.
+            await ProcessUpdateSignal(signal, account)
+            return 'position held, stops reset'
+        if signal.signal_type == SignalType.ENTRY and await GetBuyOrdersByTicker(account, signal.ticker):
+            return ENTRY_WORKING
+        orders = await account.state.get_orders(signal.ticker, max_age=0)
+        return 'order still working' if orders else 'no position or order'
+    if kind == 'cancel':
+        # Cancels that never went out are sent again.  A cancel-and-replace stop left without its replacement is
+        # placed again by the position monitor.
+        live = [order.details.order_id for order in await account.state.get_orders(max_age=0) if order.details.order_id in fields['order_ids']]
+        if live:
+            await CancelOrdersByID(account, live)
+            return 'cancels resent for {}'.format(live)
+        return 'all cancelled'
+    if kind == 'order':
+        # The order may or may not have reached the broker.  Either way it's left as the broker has it.
+        ticker = fields.get('ticker')
+        positions = await account.state.get_positions(ticker, max_age=0)
+        orders = await account.state.get_orders(ticker, max_age=0)
+        return 'ticker has {} position(s) and {} live order(s)'.format(len(positions), len(orders))
+    if kind == 'alerts':
+        # The next alert sync picks up whatever the broker ended up with.
+        account.alerts.invalidate()
+        return 'alerts resynced'
+    return 'nothing to do'
+
+async def SaveState():
+    try:
+        STATE_CACHE.update(
+            positions={account.name: account.state.positions for account in ACCOUNTS},
+            orders={account.name: account.state.orders for account in ACCOUNTS},
+            alerts={account.user: account.alerts.get_all() for account in ACCOUNTS},
+        )
+        await asyncio.get_event_loop().run_in_executor(None, STATE_CACHE.write, STATE_CACHE.dump())
+    except Exception as ex:
+        LOGGER.info('Could not save the state cache.')
+        LOGGER.fatal(ex, exc_info=True)
+
+async def SaveStatePeriodically():
+    while True:
+        await asyncio.sleep(Settings.StateCacheSaveSeconds)
+        await SaveState()
+
+async def RunBot():
+    global client, DISPATCHER, BROKER_READY, STATE_CACHE, JOURNAL
+    BROKER_READY = asyncio.Event()
+    STATE_CACHE = StateCache()
+    JOURNAL = TradeJournal()
+    # The per-account limit only matters when accounts compete for the workers.  A single account may use them all.
+    DISPATCHER = SignalDispatcher(ProcessSignal, max_per_account = Settings.MaxConcurrentSignalsPerAccount if len(get_account_specs()) > 1 else Settings.MaxConcurrentSignals)
+
+    TRACER.add_gauge('dispatcher', DISPATCHER.stats)
+    TRACER.add_gauge('journal', JOURNAL.stats)
+    if TRACER.enabled:
+        TRACER.install_signal_handler(asyncio.get_event_loop())
+        if Settings.TracingHttpPort:
+            await TRACER.serve()
+
+    # Discord logs in while the broker sessions are set up.  Signals that arrive first are held until the accounts are loaded.
+    with TRACER.span('startup.import_discord'):
+        client = create_discord_client()
+    discord_task = asyncio.ensure_future(client.start(Settings.Discord_Token, bot=False))
+    await StartBroker()
+    BROKER_READY.set()
+    TRACER.record('startup.broker_ready', time.perf_counter() - STARTED_AT)
+    LOGGER.info('Broker ready with %s account(s).  Startup timings:\n%s', len(ACCOUNTS), TRACER.format_report())
+    for signal in PENDING_SIGNALS:
+        SubmitSignal(signal)
+    del PENDING_SIGNALS[:]
+    await asyncio.gather(discord_task, WatchAlertsAndExitIfTriggered(), WatchPositionsAndExitAtPercentage(), SaveStatePeriodically())
+
+async def StopBot():
+    if client is not None:
+        await client.logout()
+        await client.close()
+    if BROKER_READY is not None and BROKER_READY.is_set():
+        await SaveState()
+    for gateway in GATEWAYS:
+        await gateway.close()
+    if JOURNAL is not None:
+        await asyncio.get_event_loop().run_in_executor(None, JOURNAL.close)
+
+def main():
+    global STARTED_AT
+    STARTED_AT = time.perf_counter()
+    setup_logging()
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(RunBot())
+    except KeyboardInterrupt:
+        pass
+    except Exception as ex:
+        LOGGER.error('An unexpected error occurred in the main loop: %s', ex)
+        LOGGER.fatal(ex, exc_info=True)
+    finally:
+        loop.run_until_complete(StopBot())
+        time.sleep(3)
+        loop.close()
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
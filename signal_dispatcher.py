@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+from settings import Settings
+
+LOGGER = logging.getLogger(__name__)
+
+
+class NullLock(object):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+NULL_LOCK = NullLock()
+
+
+class SignalDispatcher(object):
+    # Runs signals for different tickers in parallel while keeping each ticker's signals strictly in arrival order.
+    # Every ticker gets its own queue drained by a single worker, and a global semaphore caps how many handlers run at once.
+    # A signal submitted for an account is queued per (account, ticker), handled as handler(signal, account) and also
+    # held to that account's own limit, so one slow account can't take every worker.
+    def __init__(self, handler, max_concurrency: int = None, max_per_account: int = None, sample_size: int = 1000):
+        self.handler = handler
+        self.max_concurrency = Settings.MaxConcurrentSignals if max_concurrency is None else max_concurrency
+        self.max_per_account = Settings.MaxConcurrentSignalsPerAccount if max_per_account is None else max_per_account
+        self.semaphore = None
+        self.account_semaphores = {}
+        self.queues = {}
+        self.workers = {}
+        self.wait_times = deque(maxlen=sample_size)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_depth = 0
+
+    def submit(self, signal, account = None):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        key = signal.ticker if account is None else (account, signal.ticker)
+        queue = self.queues.setdefault(key, deque())
+        queue.append((signal, account, monotonic()))
+        self.submitted += 1
+        if len(queue) > self.max_depth:
+            self.max_depth = len(queue)
+        if len(queue) > 1:
+            LOGGER.info('%s signal(s) queued for %s', len(queue), signal.ticker)
+        if key not in self.workers:
+            self.workers[key] = asyncio.ensure_future(self._drain(key))
+
+    async def _drain(self, key):
+        queue = self.queues[key]
+        try:
+            while queue:
+                signal, account, queued_at = queue[0]
+                async with self._get_account_semaphore(account), self.semaphore:
+                    self.wait_times.append(monotonic() - queued_at)
+                    try:
+                        if account is None:
+                            await self.handler(signal)
+                        else:
+                            await self.handler(signal, account)
+                        self.completed += 1
+                    except Exception as ex:
+                        self.failed += 1
+                        LOGGER.info('Unhandled exception processing %s', signal)
+                        LOGGER.fatal(ex, exc_info=True)
+                    finally:
+                        queue.popleft()
+        finally:
+            del self.workers[key]
+            if not queue:
+                del self.queues[key]
+
+    def _get_account_semaphore(self, account):
+        if account is None:
+            return NULL_LOCK
+        semaphore = self.account_semaphores.get(account)
+        if semaphore is None:
+            semaphore = self.account_semaphores[account] = asyncio.Semaphore(self.max_per_account)
+        return semaphore
+
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self) -> dict:
+        waits = sorted(self.wait_times)
+        return {
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'in_flight_tickers': len(self.workers),
+            'queue_depth': self.queue_depth(),
+            'max_queue_depth': self.max_depth,
+            'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+            'wait_p99': waits[int(len(waits) * 0.99)] if waits else 0.0,
+            'wait_max': waits[-1] if waits else 0.0,
+        }
+
+    async def join(self):
+        while self.workers:
+            await asyncio.gather(*list(self.workers.values()), return_exceptions=True)
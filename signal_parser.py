@@ -0,0 +1,78 @@
+import re
+from enum import Enum
+from datetime import date
+from decimal import Decimal
+from settings import Settings
+
+
+class SignalType(Enum):
+    ENTRY = 'OPEN'
+    UPDATE = 'UPDATE'
+    DEACTIVATE = 'CLOSE'
+
+
+class Signal(object):
+    __slots__ = ('signal_type', 'ticker', 'option_type', 'exp_date', 'strike', 'mark', 'received_at')
+
+    def __init__(self, signal_type: SignalType, ticker: str, option_type: str, exp_date: date, strike: Decimal, mark: Decimal = None):
+        self.signal_type = signal_type
+        self.ticker = ticker
+        # 'CALL' or 'PUT'.  Mapped to tastyworks' OptionType by the caller so this module stays free of broker imports.
+        self.option_type = option_type
+        self.exp_date = exp_date
+        self.strike = strike
+        # CLOSE signals don't carry a mark.
+        self.mark = mark
+        # perf_counter() when the message arrived, set by the caller for latency tracing.
+        self.received_at = None
+
+    def __repr__(self):
+        return 'Signal({}, {}, {}, {}, {}, {})'.format(self.signal_type.name, self.ticker, self.option_type, self.exp_date, self.strike, self.mark)
+
+
+class SignalParser(object):
+    def __init__(self, entry_regex: str = None, update_regex: str = None, deactivate_regex: str = None):
+        # Compile once.  The regexes are anchored on their leading tag so the tag alone picks the pattern to run.
+        self.patterns = {
+            '[OPEN]': (SignalType.ENTRY, re.compile(entry_regex or Settings.EntryRegex)),
+            '[UPDATE]': (SignalType.UPDATE, re.compile(update_regex or Settings.UpdateRegex)),
+            '[CLOSE]': (SignalType.DEACTIVATE, re.compile(deactivate_regex or Settings.DeactivateRegex)),
+        }
+
+    def parse(self, content: str) -> Signal:
+        if not content or content[0] != '[':
+            return None
+        message_ucase = content.upper()
+        end = message_ucase.find(']')
+        if end < 0:
+            return None
+        dispatch = self.patterns.get(message_ucase[:end + 1])
+        if dispatch is None:
+            return None
+        signal_type, pattern = dispatch
+        match = pattern.match(message_ucase)
+        if not match:
+            return None
+        groups = match.groupdict()
+        mark = groups.get('Mark')
+        return Signal(signal_type = signal_type,
+                      ticker = groups['Ticker'],
+                      option_type = groups['Type'],
+                      exp_date = get_expire_date_from_string(groups['Exp']),
+                      strike = Decimal(groups['Strike']),
+                      mark = Decimal(mark) if mark is not None else None)
+
+
+def get_expire_date_from_string(d):
+    today = date.today()
+    month, day = d.split('/')
+    expire_date = date(today.year, int(month), int(day))
+    if expire_date >= today:
+        return expire_date
+    else:
+        return date(today.year + 1, int(month), int(day))
+
+PARSER = SignalParser()
+
+def parse_signal(content: str) -> Signal:
+    return PARSER.parse(content)
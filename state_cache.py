@@ -0,0 +1,54 @@
+import os
+import pickle
+import logging
+from time import time
+from settings import Settings
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StateCache(object):
+    # What a restart needs to get going without waiting on the broker: the session token, the account and the
+    # last-known positions, orders and alerts.  Kept as one pickle, written atomically and readable by the owner only.
+    # dump() snapshots on the caller's thread so write() can run on an executor.
+    def __init__(self, path: str = None, max_age: float = None):
+        self.path = Settings.StateCacheFile if path is None else path
+        self.max_age = Settings.StateCacheMaxAge if max_age is None else max_age
+        self.values = {}
+
+    def load(self) -> dict:
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, 'rb') as f:
+                values = pickle.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as ex:
+            LOGGER.info('Ignoring unreadable state cache %s: %s', self.path, ex)
+            return {}
+        age = time() - values.get('saved_at', 0)
+        if age > self.max_age:
+            LOGGER.info('Ignoring state cache %s saved %.0fs ago.', self.path, age)
+            return {}
+        self.values = values
+        return dict(values)
+
+    def update(self, **values):
+        self.values.update(values)
+
+    def dump(self) -> bytes:
+        self.values['saved_at'] = time()
+        return pickle.dumps(self.values, pickle.HIGHEST_PROTOCOL)
+
+    def write(self, data: bytes):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def save(self):
+        self.write(self.dump())
@@ -0,0 +1,49 @@
+from decimal import Decimal
+from settings import Settings
+
+# Trading decisions used by the bot's handlers, and so by backtest.py's replays of them.  Everything here is pure: it only looks at its arguments and the settings passed in.
+
+PROFIT_EXIT = 'PROFIT'
+LOSS_EXIT = 'LOSS'
+
+
+def get_entry_order(mark: Decimal, settings = Settings):
+    # Returns (limit price, quantity) for an entry signal.  A quantity of 0 means the max bet can't cover one contract.
+    price = mark + settings.IncreaseEntryLimitOrderBy
+    quantity = int(settings.MaxBet/(price * 100))
+    if quantity > settings.MaxContracts:
+        quantity = settings.MaxContracts
+    return price, quantity
+
+def get_stock_stop_price(current_price: Decimal, is_call: bool, settings = Settings) -> Decimal:
+    if is_call:
+        return current_price - settings.AdjustStockPriceAlertBy
+    else:
+        return current_price + settings.AdjustStockPriceAlertBy
+
+def has_entry_price_drifted(current_price: Decimal, order_price: Decimal, settings = Settings) -> bool:
+    return (current_price - order_price) > settings.EntryPriceDriftLimit
+
+def get_profit_percent(position):
+    entry_fee = Decimal('1.00') * Decimal(position.quantity)
+    entry = position.average_open_price * position.multiplier
+    if entry_fee > 10:
+        entry = entry + Decimal('10')
+    else:
+        entry = entry + entry_fee
+    currentpl = (position.mark_price - position.average_open_price) * position.multiplier
+    return Decimal((currentpl / entry) * 100)
+
+def get_exit_action(profit_percent: Decimal, settings = Settings) -> str:
+    if settings.AutoCloseAtProfitPercent > 0 and profit_percent >= settings.AutoCloseAtProfitPercent:
+        return PROFIT_EXIT
+    elif settings.AutoCloseAtLossPercent > 0 and (profit_percent * -1) >= settings.AutoCloseAtLossPercent:
+        return LOSS_EXIT
+    return None
+
+def get_profit_stop_trigger(mark_price: Decimal, average_open_price: Decimal, settings = Settings) -> Decimal:
+    # Trail the mark by the configured delta, but never let the stop sit at or below the entry price.
+    stop_trigger = mark_price - settings.ProfitPercentExitTriggerPriceDelta
+    if stop_trigger <= average_open_price:
+        stop_trigger = average_open_price + Decimal('.01')
+    return stop_trigger
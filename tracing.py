@@ -0,0 +1,161 @@
+import signal
+import random
+import asyncio
+import logging
+from bisect import bisect_left
+from time import perf_counter
+from settings import Settings
+
+LOGGER = logging.getLogger(__name__)
+
+# Upper bounds, in milliseconds, of the latency histogram buckets.  The last bucket catches everything slower.
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, float('inf'))
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'errors', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms: float, error: bool = False):
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        if error:
+            self.errors += 1
+
+    def percentile(self, fraction: float) -> float:
+        # Upper bound of the bucket holding the requested rank, capped at the largest value seen.
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'mean_ms': self.total / self.count if self.count else 0.0,
+            'p50_ms': self.percentile(0.50),
+            'p90_ms': self.percentile(0.90),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': self.max,
+        }
+
+
+class Span(object):
+    __slots__ = ('tracer', 'name', 'started')
+
+    def __init__(self, tracer, name: str):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer.record(self.name, perf_counter() - self.started, exc_type is not None)
+        return False
+
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+    # Times named stages of the signal-to-order path and broker endpoints into per-name histograms.
+    # When disabled, or when a span isn't sampled, span() hands back a shared no-op context manager.
+    def __init__(self, enabled: bool = None, sample_rate: float = None):
+        self.enabled = Settings.TracingEnabled if enabled is None else enabled
+        self.sample_rate = Settings.TracingSampleRate if sample_rate is None else sample_rate
+        self.histograms = {}
+        self.gauges = {}
+
+    def span(self, name: str):
+        if not self.enabled or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            return NULL_SPAN
+        return Span(self, name)
+
+    def record(self, name: str, seconds: float, error: bool = False):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds * 1000.0, error)
+
+    def add_gauge(self, name: str, source):
+        # source() is called at dump time and should return a dict of current values.
+        self.gauges[name] = source
+
+    def snapshot(self) -> dict:
+        gauges = {}
+        for name, source in self.gauges.items():
+            try:
+                gauges[name] = source()
+            except Exception as ex:
+                gauges[name] = {'error': str(ex)}
+        return {
+            'stages': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+            'gauges': gauges,
+        }
+
+    def format_report(self) -> str:
+        snapshot = self.snapshot()
+        lines = ['{:<32} {:>8} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('stage', 'count', 'errors', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+        for name, stats in snapshot['stages'].items():
+            lines.append('{:<32} {count:>8} {errors:>6} {mean_ms:>10.2f} {p50_ms:>10.2f} {p90_ms:>10.2f} {p99_ms:>10.2f} {max_ms:>10.2f}'.format(name, **stats))
+        for name, values in snapshot['gauges'].items():
+            lines.append('{}: {}'.format(name, ', '.join('{}={}'.format(key, value) for key, value in values.items())))
+        return '\n'.join(lines)
+
+    def reset(self):
+        self.histograms = {}
+
+    def install_signal_handler(self, loop, signum = getattr(signal, 'SIGUSR1', None)):
+        # kill -USR1 <pid> writes the report to the log.  Not available on Windows.
+        if signum is None:
+            return False
+        try:
+            loop.add_signal_handler(signum, lambda: LOGGER.info('Latency report:\n{}'.format(self.format_report())))
+        except (NotImplementedError, RuntimeError):
+            return False
+        return True
+
+    async def serve(self, host: str = '127.0.0.1', port: int = None):
+        # Plain-text report on any request to http://host:port/.
+        port = Settings.TracingHttpPort if port is None else port
+
+        async def handle(reader, writer):
+            try:
+                await reader.readline()
+                body = self.format_report().encode() + b'\n'
+                writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        LOGGER.info('Latency report available at http://{}:{}/'.format(host, port))
+        return server
+
+TRACER = Tracer()
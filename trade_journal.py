@@ -0,0 +1,172 @@
+import json
+import queue
+import atexit
+import asyncio
+import logging
+import sqlite3
+import threading
+from time import time
+from contextlib import contextmanager
+from settings import Settings
+
+LOGGER = logging.getLogger(__name__)
+
+_STOP = object()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS journal (
+    id INTEGER PRIMARY KEY,
+    op INTEGER NOT NULL,
+    phase TEXT NOT NULL,
+    ts REAL NOT NULL,
+    account TEXT,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS journal_op ON journal (op);
+'''
+
+
+class TradeJournal(object):
+    # Append-only record of what the bot set out to do and how it ended, so a restart can tell what a crash cut off.
+    # Each operation (a signal being handled, an order, a cancel, an alert update) is a 'begin' row and an 'end' row
+    # sharing one op number.  recover() returns the earlier runs' begins that never ended.
+    # begin() and end() only queue the row.  One writer thread commits whatever has queued since its last commit in
+    # one transaction, so under load many rows share one fsync (SQLite WAL, synchronous=FULL).  flush() waits until
+    # everything queued so far is on disk, for callers that must not act before their row is.
+    def __init__(self, path: str = None, batch_size: int = 5000):
+        self.path = Settings.JournalFile if path is None else path
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.queued = 0
+        self.committed = 0
+        self.batches = 0
+        self.errors = 0
+        self.open_ops = {}
+        self._waiters = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self.next_op = 1
+        if self.path:
+            self.connection = self._connect()
+            self.next_op = (self.connection.execute('SELECT MAX(op) FROM journal').fetchone()[0] or 0) + 1
+            self._thread = threading.Thread(target=self._run, name='journal-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        # Ops below this were started by an earlier run.
+        self.first_op = self.next_op
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=10.0, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=FULL')
+        connection.executescript(SCHEMA)
+        return connection
+
+    def begin(self, kind: str, account: str = None, **fields) -> int:
+        op = self.next_op
+        self.next_op += 1
+        self.open_ops[op] = (kind, account)
+        self._put((op, 'begin', time(), account, kind, fields))
+        return op
+
+    def end(self, op: int, **fields):
+        kind, account = self.open_ops.pop(op, ('', None))
+        self._put((op, 'end', time(), account, kind, fields))
+
+    @contextmanager
+    def operation(self, kind: str, account: str = None, **fields):
+        # Ends the operation with the error when the body raises.  A cancelled task leaves it open, the same as a crash.
+        op = self.begin(kind, account, **fields)
+        try:
+            yield op
+        except Exception as ex:
+            self.end(op, error=ex)
+            raise
+        self.end(op)
+
+    def _put(self, row: tuple):
+        if self._thread is None:
+            return
+        self.queued += 1
+        self.queue.put(row)
+
+    async def flush(self):
+        if self._thread is None:
+            return
+        with self._lock:
+            if self.committed >= self.queued:
+                return
+            future = asyncio.get_event_loop().create_future()
+            self._waiters.append((self.queued, future))
+        await future
+
+    def _run(self):
+        while True:
+            rows = [self.queue.get()]
+            while len(rows) < self.batch_size:
+                try:
+                    rows.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = _STOP in rows
+            rows = [row for row in rows if row is not _STOP]
+            if rows:
+                self._write(rows)
+            if stop:
+                return
+
+    def _write(self, rows: list):
+        try:
+            with self.connection:
+                self.connection.executemany('INSERT INTO journal (op, phase, ts, account, kind, data) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(op, phase, ts, account, kind, json.dumps(fields, default=str, separators=(',', ':'))) for op, phase, ts, account, kind, fields in rows])
+            self.batches += 1
+        except Exception as ex:
+            # Trading carries on without the journal rather than stalling on it.
+            self.errors += 1
+            LOGGER.error('Could not write %s journal rows: %s', len(rows), ex)
+        with self._lock:
+            self.committed += len(rows)
+            ready = [future for target, future in self._waiters if target <= self.committed]
+            self._waiters = [(target, future) for target, future in self._waiters if target > self.committed]
+        for future in ready:
+            future.get_loop().call_soon_threadsafe(self._resolve, future)
+
+    @staticmethod
+    def _resolve(future):
+        if not future.done():
+            future.set_result(None)
+
+    def recover(self, retention: float = None) -> list:
+        # Drops operations that finished more than retention seconds ago, then returns the earlier runs' unfinished ones
+        # oldest first, as dicts of op, ts, account, kind and the begin's fields.  Blocking.
+        if not self.path:
+            return []
+        retention = Settings.JournalRetentionDays * 86400.0 if retention is None else retention
+        connection = sqlite3.connect(self.path, timeout=10.0)
+        try:
+            with connection:
+                connection.execute("DELETE FROM journal WHERE op IN (SELECT op FROM journal WHERE phase = 'end' AND ts < ?)", (time() - retention,))
+            rows = connection.execute(
+                "SELECT op, ts, account, kind, data FROM journal WHERE phase = 'begin' AND op < ? AND op NOT IN (SELECT op FROM journal WHERE phase = 'end') ORDER BY op",
+                (self.first_op,)).fetchall()
+        finally:
+            connection.close()
+        for op, ts, account, kind, data in rows:
+            self.open_ops[op] = (kind, account)
+        return [{'op': op, 'ts': ts, 'account': account, 'kind': kind, 'fields': json.loads(data)} for op, ts, account, kind, data in rows]
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.queued,
+            'committed': self.committed,
+            'batches': self.batches,
+            'errors': self.errors,
+            'open': len(self.open_ops),
+        }
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join(5)
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+from decimal import Decimal
+from settings import Settings
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StopRecord(object):
+    __slots__ = ('order_id', 'trigger', 'quantity')
+
+    def __init__(self, order_id, trigger: Decimal, quantity):
+        self.order_id = order_id
+        self.trigger = trigger
+        self.quantity = quantity
+
+    def __repr__(self):
+        return 'StopRecord({}, {}, {})'.format(self.order_id, self.trigger, self.quantity)
+
+
+class TrailingStops(object):
+    # Local symbol -> StopRecord of the stop order protecting each position, so a tick doesn't re-list the sell orders.
+    # The broker is only asked (fetch_stops) for a symbol with no record yet.
+    # ratchet() only ever raises a stop, and only once the new trigger clears the current one by min_step or the
+    # position size has changed.  Raising replaces the order in one call when replace_stop is given, and if that fails
+    # the symbol's stops are listed again, since the replace may still have gone through.  Otherwise the new
+    # stop is placed before the old one is cancelled, so the position is never left without a stop; a cancel that
+    # fails is retried on the symbol's next ratchet.  If the broker refuses the second closing order, the old stop is
+    # cancelled with cancel_confirmed, which waits for the broker to confirm, and only then is the new one placed.  A
+    # failure along the way leaves the old stop working, or puts it back, rather than raising.
+    def __init__(self, fetch_stops, place_stop, cancel_stop, replace_stop = None, cancel_confirmed = None, min_step: Decimal = None, logger = LOGGER):
+        # fetch_stops(symbol) -> [(order_id, trigger, quantity)], place_stop(position, trigger) -> order_id,
+        # cancel_stop(order_id), replace_stop(order_id, position, trigger) -> new order_id,
+        # cancel_confirmed(order_id) -> True once the order is confirmed cancelled.  Defaults to cancel_stop.
+        self.fetch_stops = fetch_stops
+        self.place_stop = place_stop
+        self.cancel_stop = cancel_stop
+        self.replace_stop = replace_stop
+        self.cancel_confirmed = cancel_stop if cancel_confirmed is None else cancel_confirmed
+        self.min_step = Settings.TrailingStopMinStep if min_step is None else min_step
+        self.log = logger
+        self.stops = {}
+        self.stale_orders = {}
+        self.placed = 0
+        self.replaced = 0
+        self.cancelled = 0
+        self.unchanged = 0
+        self.fetches = 0
+        self.errors = 0
+        self._locks = {}
+
+    def get(self, symbol: str) -> StopRecord:
+        return self.stops.get(symbol.upper())
+
+    def forget(self, symbol: str):
+        self.stops.pop(symbol.upper(), None)
+
+    def discard_orders(self, order_ids):
+        # Called when orders are cancelled elsewhere, so a stop cancelled by ticker isn't ratcheted from a dead order.
+        order_ids = set(order_ids)
+        for symbol, record in list(self.stops.items()):
+            if record.order_id in order_ids:
+                del self.stops[symbol]
+
+    def retain(self, symbols):
+        # Drops the records of positions no longer held, e.g. after a stop filled.
+        symbols = set(symbol.upper() for symbol in symbols)
+        for symbol in list(self.stops):
+            if symbol not in symbols:
+                del self.stops[symbol]
+
+    def _get_lock(self, symbol: str) -> asyncio.Lock:
+        lock = self._locks.get(symbol)
+        if lock is None:
+            lock = self._locks[symbol] = asyncio.Lock()
+        return lock
+
+    async def ratchet(self, position, trigger: Decimal) -> str:
+        # Returns 'placed', 'replaced', 'unchanged', or 'failed' when the stop couldn't be raised.
+        symbol = position.underlying_symbol.upper()
+        async with self._get_lock(symbol):
+            await self._retry_cancels(symbol)
+            record = self.stops.get(symbol)
+            if record is None:
+                record = await self._load(symbol)
+            if record is None:
+                self.log.info('Creating initial stop order for %s with a stop trigger of $%.3f', symbol, trigger)
+                self.stops[symbol] = StopRecord(await self.place_stop(position, trigger), trigger, position.quantity)
+                self.placed += 1
+                return 'placed'
+            if record.quantity == position.quantity and trigger - record.trigger < self.min_step:
+                self.unchanged += 1
+                return 'unchanged'
+            trigger = max(trigger, record.trigger)
+            self.log.info('Increasing the stop trigger for %s from $%.3f to $%.3f', symbol, record.trigger, trigger)
+            if self.replace_stop is not None:
+                try:
+                    self.stops[symbol] = StopRecord(await self.replace_stop(record.order_id, position, trigger), trigger, position.quantity)
+                    self.replaced += 1
+                    return 'replaced'
+                except Exception as ex:
+                    # The replace may have reached the broker even though the call failed, so the stops are listed again
+                    # rather than placing another.  Only a ticker left with none gets a fresh stop.
+                    self.errors += 1
+                    self.log.info('Could not replace stop order %s for %s: %s', record.order_id, symbol, ex)
+                    del self.stops[symbol]
+                    record = await self._load(symbol)
+                    if record is not None:
+                        return 'replaced' if record.trigger >= trigger else 'failed'
+                    self.log.info('No stop order left for %s.  Placing a new one with a stop trigger of $%.3f', symbol, trigger)
+                    self.stops[symbol] = StopRecord(await self.place_stop(position, trigger), trigger, position.quantity)
+                    self.placed += 1
+                    return 'placed'
+            try:
+                order_id = await self.place_stop(position, trigger)
+            except Exception as ex:
+                # The broker may refuse a second closing order for the same contracts.  Cancel first in that case.
+                self.errors += 1
+                self.log.info('Could not place the new stop for %s before cancelling the old one: %s', symbol, ex)
+                return await self._cancel_then_place(symbol, record, position, trigger)
+            self.stops[symbol] = StopRecord(order_id, trigger, position.quantity)
+            self.placed += 1
+            await self._cancel(symbol, record.order_id)
+            return 'replaced'
+
+    async def _cancel_then_place(self, symbol: str, record: StopRecord, position, trigger: Decimal) -> str:
+        try:
+            confirmed = await self.cancel_confirmed(record.order_id)
+        except Exception as ex:
+            confirmed = False
+            self.log.info('Could not cancel stop order %s for %s: %s', record.order_id, symbol, ex)
+        if not confirmed:
+            # The old stop may still be working (or have filled), so nothing new is placed.  The next ratchet tries again.
+            self.errors += 1
+            self.log.info('Keeping stop order %s for %s at $%.3f', record.order_id, symbol, record.trigger)
+            self.stops[symbol] = record
+            return 'failed'
+        self.cancelled += 1
+        self.stops.pop(symbol, None)
+        for new_trigger in (trigger, record.trigger):
+            try:
+                self.stops[symbol] = StopRecord(await self.place_stop(position, new_trigger), new_trigger, position.quantity)
+                self.placed += 1
+                if new_trigger == trigger:
+                    return 'replaced'
+                self.log.info('Put back the stop for %s at $%.3f', symbol, new_trigger)
+                return 'failed'
+            except Exception as ex:
+                self.errors += 1
+                self.log.info('Could not place a stop for %s at $%.3f: %s', symbol, new_trigger, ex)
+        # With no record, the next ratchet looks the stops up again and places one if there still is none.
+        self.log.info('%s has no stop order working', symbol)
+        return 'failed'
+
+    async def _load(self, symbol: str) -> StopRecord:
+        # Adopts the highest existing stop and cancels any others.
+        self.fetches += 1
+        stops = sorted(await self.fetch_stops(symbol), key=lambda stop: stop[1])
+        if not stops:
+            return None
+        for order_id, trigger, quantity in stops[:-1]:
+            await self._cancel(symbol, order_id)
+        self.stops[symbol] = StopRecord(*stops[-1])
+        return self.stops[symbol]
+
+    async def _cancel(self, symbol: str, order_id, retry: bool = True):
+        try:
+            await self.cancel_stop(order_id)
+            self.cancelled += 1
+        except Exception as ex:
+            self.errors += 1
+            if retry:
+                self.log.info('Could not cancel replaced stop order %s for %s, will retry: %s', order_id, symbol, ex)
+                self.stale_orders.setdefault(symbol, []).append(order_id)
+            else:
+                self.log.info('Could not cancel replaced stop order %s for %s: %s', order_id, symbol, ex)
+
+    async def _retry_cancels(self, symbol: str):
+        for order_id in self.stale_orders.pop(symbol, ()):
+            await self._cancel(symbol, order_id, retry=False)
+
+    def stats(self) -> dict:
+        return {
+            'stops': len(self.stops),
+            'placed': self.placed,
+            'replaced': self.replaced,
+            'cancelled': self.cancelled,
+            'unchanged': self.unchanged,
+            'fetches': self.fetches,
+            'errors': self.errors,
+            'stale_orders': sum(len(order_ids) for order_ids in self.stale_orders.values()),
+        }